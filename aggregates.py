@@ -0,0 +1,470 @@
+import json
+import logging
+import os
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+from bookings import BookingFrame, with_first_visits
+from cohorts import daily_cohort_activity, COHORT_COLUMNS
+from crm_script_monthly import monthly_rows, ltv_metrics, MONTHLY_COLUMNS
+from crm_script_weekly import weekly_daily, weekly_frames, week_bins, week_ordinals, weekly_rows, CUTOFF_DATE, WEEKLY_COLUMNS
+from metric_params import metric_params, MetricParams
+from period_engine import daily_aggregates, DailyAggregates
+
+
+logger = logging.getLogger(__name__)
+
+# Metric state persisted between incremental syncs: per-customer visit state,
+# the daily aggregates (one row per customer per day, revenue per day), the
+# cohort cells and the already computed monthly and weekly rows. A sync only
+# recomputes the days, customers and periods its delta touches:
+#
+# - Incremental bookings come from the store in visit date order, so the
+#   bookings of a day, week or month are found by binary search, and the
+#   first and last customer bookings span the weekly report.
+# - Customers and their days are stored sorted by key (a 64-bit hash of the
+#   email), so the days of a customer are found the same way.
+# - Each period's row depends only on that period's bookings and the first
+#   visit dates of its customers, and is recomputed from those bookings with
+#   the same period engine code as a full build, so a patched result equals a
+#   full recompute.
+#
+# Only the computation is incremental. Each sync still reads the whole booking
+# store and rewrites every state file (see update_metrics()).
+AGGREGATES_DIR = os.getenv('AGGREGATES_DIR', os.path.join('data', 'aggregates'))
+
+# Set to 1 to check every incremental update against a full recompute (slow; for debugging)
+VERIFY = os.getenv('AGGREGATES_VERIFY', '0') == '1'
+
+DAY_COLUMNS = ['key', 'day', 'visits', 'revenue', 'first_value', 'first_visit_at', 'last_visit_at']
+CUSTOMER_COLUMNS = ['key', 'email', 'first_visit', 'last_visit', 'visit_count', 'revenue_sum',
+                    'gap_days_sum', 'gap_count']
+
+
+@dataclass(frozen=True)
+class MetricState:
+    # Sorted by key: email, first_visit, last_visit, visit_count, revenue_sum, gap_days_sum, gap_count
+    customers: pd.DataFrame
+    # Sorted by (key, day): visits, revenue, first_value, first_visit_at and last_visit_at of each customer day
+    customer_days: pd.DataFrame
+    # Sorted by day: revenue of every booking (valid email or not)
+    day_totals: pd.DataFrame
+    # Monthly rows indexed by month period, weekly rows indexed by week ordinal
+    monthly: pd.DataFrame
+    weekly: pd.DataFrame
+    # cohort_activity() cells
+    cohorts: pd.DataFrame
+    # Earliest visit the week bins were anchored on (weekly ordinals shift if it changes)
+    week_anchor: pd.Timestamp
+    high_water_mark: str
+    window_end: pd.Timestamp
+    # Metric parameters the state was computed with; a state saved with others is rebuilt
+    params: MetricParams = None
+
+
+def customer_keys(emails):
+    """ Key each customer is stored under: a 64-bit hash of the email """
+    if isinstance(emails.dtype, pd.CategoricalDtype) and len(emails.cat.categories) <= len(emails):
+        # Each distinct email is hashed once
+        return customer_keys(pd.Series(emails.cat.categories))[emails.cat.codes.to_numpy()]
+    return pd.util.hash_array(np.asarray(emails, dtype=object))
+
+
+def _ranges(starts, ends):
+    # Positions start..end-1 of every [start, end) range, in order
+    lengths = ends - starts
+    return np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+
+
+def _key_positions(frame, keys):
+    # Rows of `keys` in a frame sorted by key
+    sorted_keys = frame['key'].to_numpy()
+    keys = np.sort(keys)
+    keys = keys[np.r_[True, keys[1:] != keys[:-1]]] if len(keys) else keys
+    return _ranges(np.searchsorted(sorted_keys, keys, 'left'), np.searchsorted(sorted_keys, keys, 'right'))
+
+
+def _splice(frame, positions, rows):
+    """ `frame` (sorted by key) with the rows at `positions` replaced by `rows`
+
+    `rows` is sorted like `frame`, and `positions` hold every row of the keys
+    in `rows`, so each key's block goes back in one place.
+    """
+    keep = np.ones(len(frame), dtype=bool)
+    keep[positions] = False
+    rest = frame[keep]
+    if len(rest) == 0 or len(rows) == 0:
+        return (rows if len(rest) == 0 else rest).reset_index(drop=True)
+    at = np.searchsorted(rest['key'].to_numpy(), rows['key'].to_numpy())
+    order = np.insert(np.arange(len(rest)), at, np.arange(len(rest), len(rest) + len(rows)))
+    return pd.concat([rest, rows], ignore_index=True).take(order).reset_index(drop=True)
+
+
+def _rows_between(bookings, starts, ends):
+    """ The bookings visited in any [starts[i], ends[i]) (sorted, disjoint), found by binary search
+
+    Customer bookings and the other bookings are each in visit date order,
+    as loaded from the store.
+    """
+    customer_count = len(bookings.customers)
+    visits = bookings.original['visit_date'].to_numpy()
+    starts = np.asarray(pd.DatetimeIndex(starts), dtype=visits.dtype)
+    ends = np.asarray(pd.DatetimeIndex(ends), dtype=visits.dtype)
+
+    customer_visits, other_visits = visits[:customer_count], visits[customer_count:]
+    customer_rows = _ranges(np.searchsorted(customer_visits, starts), np.searchsorted(customer_visits, ends))
+    other_rows = customer_count + _ranges(np.searchsorted(other_visits, starts), np.searchsorted(other_visits, ends))
+    return BookingFrame(customers=bookings.customers.iloc[customer_rows],
+                        original=bookings.original.iloc[np.concatenate([customer_rows, other_rows])])
+
+
+def _in_visit_order(bookings):
+    visits = bookings.original['visit_date']
+    customer_count = len(bookings.customers)
+    return visits.iloc[:customer_count].is_monotonic_increasing and visits.iloc[customer_count:].is_monotonic_increasing
+
+
+def _state_days(customer_days):
+    """ daily_aggregates() customer days in state form: keyed, sorted by (key, day) """
+    days = customer_days.assign(key=customer_keys(customer_days['email']))[DAY_COLUMNS]
+    return days.take(np.lexsort((days['day'].to_numpy(), days['key'].to_numpy()))).reset_index(drop=True)
+
+
+def _customer_state(days, emails):
+    """ Per-customer visit state from state-form customer days; gaps are whole days between consecutive visits
+
+    Visits on the same day are less than a day apart (0 days); across days the
+    gap runs from the last visit of one day to the first visit of the next.
+    """
+    if len(days) == 0:
+        return pd.DataFrame(columns=CUSTOMER_COLUMNS)
+    key = days['key'].to_numpy()
+    visits = days['visits'].to_numpy().astype('int64')
+    first_at = days['first_visit_at'].to_numpy()
+    last_at = days['last_visit_at'].to_numpy()
+
+    same_customer = np.r_[False, key[1:] == key[:-1]]
+    starts = np.flatnonzero(~same_customer)
+    ends = np.r_[starts[1:], len(days)]
+    gap_days = np.zeros(len(days), dtype='int64')
+    gap_days[1:] = (first_at[1:] - last_at[:-1]) // np.timedelta64(1, 'D')
+    gap_days[~same_customer] = 0
+
+    return pd.DataFrame({
+        'key': key[starts],
+        'email': emails.reindex(key[starts]).to_numpy(),
+        'first_visit': first_at[starts],
+        'last_visit': last_at[ends - 1],
+        'visit_count': np.add.reduceat(visits, starts),
+        'revenue_sum': np.add.reduceat(days['revenue'].to_numpy(), starts),
+        'gap_days_sum': np.add.reduceat(gap_days, starts),
+        'gap_count': np.add.reduceat(visits - 1 + same_customer, starts),
+    }, columns=CUSTOMER_COLUMNS)
+
+
+def _emails_by_key(emails):
+    emails = pd.Series(emails).astype(str).drop_duplicates()
+    return pd.Series(emails.to_numpy(), index=customer_keys(emails))
+
+
+def _with_first_visits(customers, state_customers):
+    # Customer bookings with the first visit dates of the (updated) customer state
+    positions = np.searchsorted(state_customers['key'].to_numpy(), customer_keys(customers['email']))
+    return customers.assign(first_visit_date=state_customers['first_visit'].to_numpy()[positions])
+
+
+def state_ltv(customers, params):
+    """ The LTV block of monthly_breakdown() from per-customer state alone """
+    gap_count = customers['gap_count'].sum()
+    avg_days_between_visits = customers['gap_days_sum'].sum() / gap_count if gap_count > 0 else 1
+    return ltv_metrics(
+        customers['revenue_sum'].sum(),
+        len(customers),
+        int(customers['visit_count'].sum()),
+        avg_days_between_visits,
+        params.churn_threshold_days,
+    )
+
+
+def _first_visits(bookings):
+    # Bookings with first visit dates (see bookings_from_frame(first_visits=False))
+    if 'first_visit_date' in bookings.customers.columns:
+        return bookings
+    return BookingFrame(customers=with_first_visits(bookings.customers), original=bookings.original)
+
+
+def _weekly_state(bookings):
+    """ (weekly rows, week anchor) from every booking """
+    df, df_original = weekly_frames(bookings)
+    bins = week_bins(df['visit_date'])
+    if bins is None:
+        return pd.DataFrame(columns=WEEKLY_COLUMNS), None
+    week_starts, week_edges = bins
+    return weekly_rows(weekly_daily(df, df_original, week_edges), week_starts, week_edges), df['visit_date'].min()
+
+
+def _sorted_cohorts(cohorts):
+    return cohorts.sort_values(['cohort', 'months_since_first']).reset_index(drop=True)
+
+
+def build_state(bookings, high_water_mark=None, window_end=None, params=None):
+    """ Full build of the metric state """
+    bookings = _first_visits(bookings)
+    daily = daily_aggregates(bookings)
+    customer_days = _state_days(daily.customer_days)
+    weekly, week_anchor = _weekly_state(bookings)
+    return MetricState(
+        customers=_customer_state(customer_days, _emails_by_key(daily.customer_days['email'].cat.categories)),
+        customer_days=customer_days,
+        day_totals=daily.day_totals,
+        monthly=monthly_rows(daily),
+        weekly=weekly,
+        cohorts=_sorted_cohorts(daily_cohort_activity(daily)),
+        week_anchor=week_anchor,
+        high_water_mark=high_water_mark,
+        window_end=window_end,
+        params=params or metric_params(),
+    )
+
+
+def _changed_days(changed_records, previous_window_end, window_end):
+    """ (emails, days) of every booking whose contribution may have changed
+
+    Those are the new and replaced versions of the changed bookings, and the
+    stored bookings that only now fall inside the reporting window.
+    """
+    emails = changed_records["Bnow__Customer_Email__c"]
+    visit_dates = pd.to_datetime(changed_records["Bnow__All_Products_Processed__c"], utc=True).dt.tz_localize(None)
+    days = visit_dates.dropna().dt.floor('D')
+    if previous_window_end is not None and window_end is not None and window_end > previous_window_end:
+        days = pd.concat([days, pd.Series(pd.date_range(previous_window_end.floor('D'), window_end.floor('D')))])
+
+    emails = emails[emails.notna() & (emails != '')]
+    return emails, pd.DatetimeIndex(days.drop_duplicates().sort_values())
+
+
+def update_state(state, bookings, changed_records, high_water_mark=None, window_end=None):
+    """ Applies a sync delta: only the touched days, customers, months and weeks are recomputed """
+    emails, dirty_days = _changed_days(changed_records, state.window_end, window_end)
+
+    # Days: the dirty days are re-aggregated from their bookings. First visits are
+    # not known yet (they come from the updated customers) and not kept per day
+    day_bookings = _rows_between(bookings, dirty_days, dirty_days + pd.Timedelta(days=1))
+    day_daily = daily_aggregates(BookingFrame(customers=day_bookings.customers.assign(first_visit_date=pd.NaT),
+                                              original=day_bookings.original))
+    new_days = _state_days(day_daily.customer_days)
+
+    # Customers: every customer with a booking on a dirty day now or before the sync
+    keys = np.concatenate([new_days['key'].to_numpy(), customer_keys(emails)])
+    day_positions = _key_positions(state.customer_days, keys)
+    old_days = state.customer_days.iloc[day_positions]
+    touched_days = pd.concat([old_days[~old_days['day'].isin(dirty_days)], new_days])
+    touched_days = touched_days.take(np.lexsort((touched_days['day'].to_numpy(), touched_days['key'].to_numpy())))
+    customer_days = _splice(state.customer_days, day_positions, touched_days)
+
+    customer_positions = _key_positions(state.customers, keys)
+    old_customers = state.customers.iloc[customer_positions]
+    known_emails = pd.concat([pd.Series(old_customers['email'].to_numpy(), index=old_customers['key'].to_numpy()),
+                              _emails_by_key(day_bookings.customers['email'])])
+    touched_customers = _customer_state(touched_days, known_emails[~known_emails.index.duplicated()])
+    customers = _splice(state.customers, customer_positions, touched_customers)
+
+    day_totals = pd.concat([state.day_totals[~state.day_totals['day'].isin(dirty_days)], day_daily.day_totals])
+    day_totals = day_totals.sort_values('day').reset_index(drop=True)
+
+    # New/returning status only moves between a customer's old and new first visit periods;
+    # everything else that changed is in the periods of the dirty days themselves
+    old_first = old_customers.set_index('key')['first_visit']
+    new_first = touched_customers.set_index('key')['first_visit']
+    first_visits = pd.concat([old_first, new_first], axis=1, keys=['old', 'new'])
+    moved = first_visits[first_visits['old'].ne(first_visits['new'])]
+    first_visit_dates = pd.concat([moved['old'], moved['new']]).dropna()
+    dirty_dates = pd.concat([pd.Series(dirty_days), first_visit_dates], ignore_index=True)
+    # A customer whose first month moved changes cohort in every month they were active
+    moved_days = touched_days['day'][touched_days['key'].isin(moved.index)]
+    dirty_months = pd.PeriodIndex(pd.concat([dirty_dates, moved_days]).dt.to_period('M')).unique().sort_values()
+
+    # Months and cohort cells: the bookings of the dirty months are aggregated once for both
+    month_bookings = _rows_between(bookings, dirty_months.start_time, (dirty_months + 1).start_time)
+    month_daily = daily_aggregates(BookingFrame(customers=_with_first_visits(month_bookings.customers, customers),
+                                                original=month_bookings.original))
+    monthly = pd.concat([state.monthly.drop(dirty_months, errors='ignore'), monthly_rows(month_daily)]).sort_index()
+    cell_months = pd.PeriodIndex(state.cohorts['cohort'], freq='M').asi8 + state.cohorts['months_since_first'].to_numpy()
+    cohorts = pd.concat([state.cohorts[~np.isin(cell_months, dirty_months.asi8)], daily_cohort_activity(month_daily)])
+
+    # Weeks: the first and last customer bookings give the week bins
+    customer_visits = bookings.customers['visit_date']
+    bins = week_bins(customer_visits.iloc[[0, -1]]) if len(customer_visits) else None
+    week_anchor = customer_visits.iloc[0] if bins is not None else None
+    if bins is None or week_anchor != state.week_anchor or week_anchor < pd.to_datetime(CUTOFF_DATE):
+        # The week bins moved (or the cutoff applies): every week ordinal changes
+        weekly, week_anchor = _weekly_state(BookingFrame(customers=_with_first_visits(bookings.customers, customers),
+                                                         original=bookings.original))
+        dirty_weeks = weekly.index
+    else:
+        week_starts, week_edges = bins
+        # Weeks start at the anchor's time of day, so a dirty day can touch the week before too
+        day_ends = pd.Series(dirty_days + pd.Timedelta(days=1) - pd.Timedelta(microseconds=1))
+        dirty_weeks = np.unique(np.concatenate([week_ordinals(dirty_dates, week_edges), week_ordinals(day_ends, week_edges)]))
+        dirty_weeks = dirty_weeks[dirty_weeks >= 0]
+        week_bookings = _rows_between(bookings, week_edges[dirty_weeks], week_edges[dirty_weeks + 1])
+        week_daily = weekly_daily(_with_first_visits(week_bookings.customers, customers), week_bookings.original,
+                                  week_edges)
+        # Weeks past the (possibly shrunk) last week disappear along with the dirty ones
+        keep = ~state.weekly.index.isin(dirty_weeks) & (state.weekly.index < len(week_starts))
+        weekly = pd.concat([state.weekly[keep], weekly_rows(week_daily, week_starts, week_edges)]).sort_index()
+
+    logger.info("Metric state updated: %d days, %d customers, %d months and %d weeks recomputed",
+                len(dirty_days), len(touched_customers), len(dirty_months), len(dirty_weeks))
+
+    return MetricState(
+        customers=customers,
+        customer_days=customer_days,
+        day_totals=day_totals,
+        monthly=monthly,
+        weekly=weekly,
+        cohorts=_sorted_cohorts(cohorts),
+        week_anchor=week_anchor,
+        high_water_mark=high_water_mark,
+        window_end=window_end,
+        params=state.params,
+    )
+
+
+def state_daily(state):
+    """ The daily_aggregates() of a metric state
+
+    Incremental bookings are in visit date order, so a customer's earlier day
+    also comes first in row order; the day number stands in for the row
+    position of each day's first priced booking.
+    """
+    days = state.customer_days
+    customers = state.customers
+    codes = np.searchsorted(customers['key'].to_numpy(), days['key'].to_numpy())
+    day_numbers = days['day'].to_numpy().astype('datetime64[D]').astype('int64')
+    unpriced = int(day_numbers.max()) + 1 if len(days) else 0
+    customer_days = pd.DataFrame({
+        'day': days['day'].to_numpy(),
+        'email': pd.Categorical.from_codes(codes, categories=pd.Index(customers['email'].astype(str))),
+        'visits': days['visits'].to_numpy(),
+        'revenue': days['revenue'].to_numpy(),
+        'first_pos': np.where(days['first_value'].notna().to_numpy(), day_numbers, unpriced),
+        'first_visit_day': pd.Series(customers['first_visit'].to_numpy()[codes]).dt.floor('D').to_numpy(),
+        'first_visit_at': days['first_visit_at'].to_numpy(),
+        'last_visit_at': days['last_visit_at'].to_numpy(),
+        'first_value': days['first_value'].to_numpy(),
+    })
+    return DailyAggregates(customer_days=customer_days, day_totals=state.day_totals)
+
+
+def state_data(state):
+    """ The load_site() result (breakdowns, LTV block, daily aggregates, cohorts) of a metric state """
+    return {
+        'monthly_breakdown': state.monthly.reset_index(drop=True),
+        **state_ltv(state.customers, state.params),
+        'weekly_breakdown': state.weekly.reset_index(drop=True),
+        'daily_aggregates': state_daily(state),
+        'cohort_activity': state.cohorts,
+    }
+
+
+def verify_state(state, bookings):
+    """ Compares a metric state with a full recompute; returns the names of the parts that differ """
+    full = build_state(bookings, params=state.params)
+    mismatches = []
+    for name in ('customers', 'customer_days', 'day_totals', 'monthly', 'weekly', 'cohorts'):
+        ours, theirs = getattr(state, name), getattr(full, name)
+        try:
+            pd.testing.assert_frame_equal(ours, theirs, check_exact=False, check_index_type=False,
+                                          check_dtype=False)
+        except AssertionError:
+            mismatches.append(name)
+    ours, theirs = state_ltv(state.customers, state.params), state_ltv(full.customers, full.params)
+    mismatches += [name for name in ours if abs(ours[name] - theirs[name]) > 1e-9 * max(1, abs(theirs[name]))]
+    return mismatches
+
+
+FRAMES = ('customers', 'customer_days', 'day_totals', 'weekly', 'cohorts')
+
+
+def save_state(state, directory=AGGREGATES_DIR):
+    os.makedirs(directory, exist_ok=True)
+    for name in FRAMES:
+        getattr(state, name).to_parquet(os.path.join(directory, f"{name}.parquet"))
+    monthly = state.monthly.assign(month=state.monthly['month'].astype(str))
+    monthly.reset_index(drop=True).to_parquet(os.path.join(directory, 'monthly.parquet'))
+
+    meta = {
+        'week_anchor': None if state.week_anchor is None else state.week_anchor.isoformat(),
+        'high_water_mark': state.high_water_mark,
+        'window_end': None if state.window_end is None else state.window_end.isoformat(),
+        'params': state.params.as_dict(),
+    }
+    tmp_path = os.path.join(directory, 'meta.json.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(meta, f)
+    # meta.json is written last, so a state without it is treated as missing
+    os.replace(tmp_path, os.path.join(directory, 'meta.json'))
+
+
+def load_state(directory=AGGREGATES_DIR):
+    meta_path = os.path.join(directory, 'meta.json')
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as f:
+        meta = json.load(f)
+    frames = {}
+    for name in FRAMES:
+        path = os.path.join(directory, f"{name}.parquet")
+        if not os.path.exists(path):
+            # Written by an older version without it; rebuilt from the bookings
+            return None
+        frames[name] = pd.read_parquet(path)
+
+    monthly = pd.read_parquet(os.path.join(directory, 'monthly.parquet'))
+    monthly['month'] = pd.PeriodIndex(monthly['month'], freq='M')
+    monthly.index = pd.PeriodIndex(monthly['month'], name='month')
+
+    return MetricState(
+        monthly=monthly[MONTHLY_COLUMNS],
+        cohorts=frames.pop('cohorts')[COHORT_COLUMNS],
+        **frames,
+        week_anchor=None if meta['week_anchor'] is None else pd.Timestamp(meta['week_anchor']),
+        high_water_mark=meta['high_water_mark'],
+        window_end=None if meta['window_end'] is None else pd.Timestamp(meta['window_end']),
+        params=MetricParams(meta['params']['churn_threshold_days'], tuple(meta['params']['excluded_emails']))
+        if meta.get('params') else None,
+    )
+
+
+def update_metrics(bookings, results, directory=AGGREGATES_DIR, params=None):
+    """ load_site() for incremental syncs: patches the persisted state with the sync delta
+
+    Recomputation is proportional to the delta, I/O is not: `bookings` is
+    the whole store, and the state is read and written back in full.
+    """
+    params = params or metric_params()
+    window_end = pd.Timestamp(results['window_end']).tz_convert(None)
+    state = load_state(directory)
+
+    if state is None or state.high_water_mark is None or state.high_water_mark != results['previous_high_water_mark']:
+        # No state yet, or it does not line up with the store this delta applies to
+        state = build_state(bookings, results['high_water_mark'], window_end, params)
+    elif state.params is None or state.params.as_dict() != params.as_dict():
+        logger.info("Metric parameters changed since the state was saved; rebuilding the metric state")
+        state = build_state(bookings, results['high_water_mark'], window_end, params)
+    elif not _in_visit_order(bookings):
+        logger.warning("Bookings are not in visit date order; rebuilding the metric state")
+        state = build_state(bookings, results['high_water_mark'], window_end, params)
+    else:
+        state = update_state(state, bookings, results['changed_records'], results['high_water_mark'], window_end)
+        if VERIFY:
+            mismatches = verify_state(state, bookings)
+            if mismatches:
+                logger.error("Incremental metric state differs from a full recompute in %s; rebuilding", mismatches)
+                state = build_state(bookings, results['high_water_mark'], window_end, params)
+
+    save_state(state, directory)
+    return state_data(state)
@@ -1,270 +1,693 @@
-import dash
-from dash import dcc, html, dash_table
-import plotly.express as px
-import pandas as pd
-from dash.dependencies import Input, Output, State
-import time  # Simulate loading time
-from crm_script_monthly import monthly_breakdown
-from crm_script_weekly import weekly_breakdown
-from salesforce_data import get_dataframe, get_data
-
-# Function to load data
-def load_data():
-    results = get_data()
-    df = get_dataframe(results)[0]
-    df_original = get_dataframe(results)[1]
-    monthly_data = monthly_breakdown(df, df_original)
-    weekly_data = weekly_breakdown(df, df_original)
-
-
-    data = {
-        **monthly_data,
-        'weekly_breakdown': weekly_data
-    }
-    return data
-
-# Initial Data Load
-data = load_data()
-monthly_df = data['monthly_breakdown']
-monthly_df['month'] = monthly_df['month'].astype(str)
-
-
-weekly_df = data['weekly_breakdown']
-weekly_df['week'] = weekly_df['week'].astype(str)
-
-
-
-metrics = {
-    "Basic LTV": data['Basic LTV'],
-    "Advanced LTV": data['Advanced LTV'],
-    "Average Purchase Value": data['Average Purchase Value'],
-    "Average Purchase Frequency": data['Average Purchase Frequency'],
-    "Average Customer Lifespan (Months)": data['Average Customer LifeSpan(Months)']
-}
-metrics_df = pd.DataFrame(metrics.items(), columns=["Metric", "Value"])
-metrics_df["Value"] = metrics_df["Value"].round(2).astype(str)
-
-dropdown_options = [{"label": col.replace("_", " ").title(), "value": col} for col in monthly_df.columns if col != "month"]
-
-# Dash app setup
-app = dash.Dash(__name__, suppress_callback_exceptions=True)
-server = app.server
-app.title = "Customer Insights"
-
-# Main Layout
-app.layout = html.Div([
-    dcc.Location(id='url', refresh=False),
-    
-    html.Div([
-        dcc.Link('🏠 Home', href='/'),
-        " | ",
-        dcc.Link('📊 Monthly Report', href='/monthly'),
-        " | ",
-        # dcc.Link('📈 Compare Two Features', href='/dynamic'),
-        # " | ",
-        dcc.Link('📑 LTV and Key Metrics', href='/metrics'),
-        " | ",
-        dcc.Link('📆 Weekly Report', href='/weekly'),
-        " | ",
-        html.Button("🔄 Refresh Data", id="refresh-btn", n_clicks=0),
-    ], style={'padding': '10px', 'fontSize': '20px'}),
-
-    html.Div(id="refresh-status", style={"color": "blue", "fontSize": "18px", "marginTop": "10px"}),  # Loading Message
-    
-    html.Div(id='page-content')  # Page Content
-])
-
-
-def get_home_layout():
-    return html.Div([
-        # Main Container for Centering
-        html.Div([
-            # Welcome Header
-            html.H2("Welcome to Jungle World Data Dashboard", className="text-center mt-4"),
-
-            # Box for Description and Navigation Instructions
-            html.Div([
-                html.P("📊 Explore your data using the navigation bar above:"),
-                html.Ul([
-                    html.Li("Click WEEKLY for weekly metrics"),
-                    html.Li("Click MONTHLY for monthly trends")
-                ], style={"listStyleType": "none", "paddingLeft": "0"}),
-                
-                html.P("🔍 Data updates may take a few moments to process"),
-            ], style={
-                "padding": "20px",
-                "backgroundColor": "#f9f9f9",
-                "borderRadius": "10px",
-                "boxShadow": "0 4px 8px rgba(0, 0, 0, 0.1)",
-                "maxWidth": "600px",
-                "margin": "0 auto",
-                "fontSize": "16px"
-            }),
-
-            # Spacer
-            html.Br(),
-
-        
-
-            
-            # Final message with centered text
-            html.P("Navigate using the links above to view your data.", style={"textAlign": "center", "fontSize": "16px", "fontWeight": "bold"})
-        ], style={
-            "textAlign": "center",  # Center everything in this div
-            "padding": "20px",
-            "fontSize": "16px"
-        }),
-    ])
-
-
-def get_weekly_layout():
-    global weekly_df  # Ensure we're using the latest refreshed data
-    weekly_df['week'] = weekly_df['week'].astype(str)
-    
-    return html.Div([
-        html.H1("📅 Weekly CRM Report"),
-        
-        html.H2("Weekly Breakdown Table"),
-        dash_table.DataTable(
-            columns=[{"name": col.replace("_", " ").title(), "id": col} for col in weekly_df.columns],
-            data=weekly_df.round(2).astype(str).to_dict('records'),
-            style_table={'overflowX': 'auto'},
-            style_cell={'textAlign': 'left'},
-            style_header={'backgroundColor': 'lightgrey', 'fontWeight': 'bold'}
-        ),
-
-        html.H2("Insights"),
-        dcc.Graph(figure=px.line(
-            weekly_df, x='week', y=['new_customers', 'returning_customers'],
-            title="New vs Returning Customers Trend (Weekly)", markers=True
-        )),
-
-        # Optional: only if you have 'new_percentage' and 'returning_percentage'
-        dcc.Graph(figure=px.line(
-            weekly_df, x='week', y=['new_percentage', 'returning_percentage'],
-            title="Customer Type Percentages (Weekly)", markers=True
-        )) if 'new_percentage' in weekly_df.columns and 'returning_percentage' in weekly_df.columns else html.Div(),
-
-        dcc.Graph(figure=px.bar(
-            weekly_df, x='week',
-            y=['total_revenue', 'new_customer_revenue', 'returning_customer_revenue'],
-            title="Revenue Breakdown (Weekly)", barmode='group'
-        )),
-
-        dcc.Graph(figure=px.bar(
-            weekly_df, x='week',
-            y=['new_customer_revenue', 'returning_customer_revenue'],
-            title="New vs Returning Revenue (Weekly)", barmode='group'
-        )),
-    ])
-
-
-# Function to generate page layouts dynamically
-def get_insights_layout():
-    return html.Div([
-        html.H1("Monthly CRM Report"),
-        html.H2("Monthly Breakdown Table"),
-        dash_table.DataTable(
-            columns=[{"name": col, "id": col} for col in monthly_df.columns],
-            data=monthly_df.round(2).astype(str).to_dict('records'),
-            style_table={'overflowX': 'auto'}
-        ),
-        html.H2("Insights"),
-        dcc.Graph(figure=px.line(monthly_df, x='month', y=['new_customers', 'returning_customers'],
-                                 title="New vs Returning Customers Trend", markers=True)),
-        dcc.Graph(figure=px.line(monthly_df, x='month', y=['new_percentage', 'returning_percentage'],
-                                 title="New vs Returning Customers Percentage Trend", markers=True)),
-        dcc.Graph(figure=px.bar(monthly_df, x='month', y=['total_revenue', 'new_customer_revenue', 'returning_customer_revenue'],
-                                 title="Revenue Breakdown", barmode='group')),
-        dcc.Graph(figure=px.bar(monthly_df, x='month', y=['new_customer_revenue', 'returning_customer_revenue'],
-                                 title="New Customer Revenue vs Returning Customer Revenue", barmode='group')),
-    ])
-
-
-
-def get_metrics_layout():
-    return html.Div([
-        html.H1("Key Metrics"),
-        dash_table.DataTable(
-            columns=[{"name": col, "id": col} for col in metrics_df.columns],
-            data=metrics_df.to_dict('records'),
-            style_table={'overflowX': 'auto'}
-        ),
-    ])
-
-# Combined Callback for Page Navigation & Refresh Button
-@app.callback(
-    [Output('page-content', 'children'),
-     Output('refresh-status', 'children'),
-     Output("refresh-btn", "children")],  # Updates button text
-    [Input('url', 'pathname'), Input('refresh-btn', 'n_clicks')],
-    prevent_initial_call=True
-)
-def update_page(pathname, n_clicks):
-    """ Handles both page navigation and refresh button with a loading state """
-    global data, monthly_df, metrics_df  
-
-    ctx = dash.callback_context
-    if ctx.triggered and ctx.triggered[0]['prop_id'] == 'refresh-btn.n_clicks':
-        # Show "Refreshing..." Message
-        return dash.no_update, "🕛 Refreshing data... Please wait.", "Refreshing..."
-
-    if pathname == '/metrics':
-        return get_metrics_layout(), "", "🔄 Refresh Data"
-    elif pathname == '/weekly':
-        return get_weekly_layout(), "", "🔄 Refresh Data"
-    elif pathname == '/monthly':
-        return get_insights_layout(), "", "🔄 Refresh Data"
-    else:  # default to home
-        return get_home_layout(), "", "🔄 Refresh Data"
-
-# Callback to actually refresh data after some delay
-@app.callback(
-    [Output('page-content', 'children', allow_duplicate=True),
-     Output('refresh-status', 'children', allow_duplicate=True),
-     Output("refresh-btn", "children", allow_duplicate=True)],
-    Input("refresh-btn", "n_clicks"),
-    State('url', 'pathname'),
-    prevent_initial_call=True
-)
-def refresh_dashboard(n_clicks, pathname):
-    """ Simulates data reloading and updates the UI with a success message """
-    global data, monthly_df, metrics_df  
-
-    # Simulating a loading delay (Replace this with actual data fetch)
-    time.sleep(3)
-
-    # Reload data
-    data = load_data()
-    monthly_df = data['monthly_breakdown']
-    monthly_df['month'] = monthly_df['month'].astype(str)
-
-    weekly_df = data['weekly_breakdown']
-    weekly_df['week'] = weekly_df['week'].astype(str)
-
-    metrics = {
-        "Basic LTV": data['Basic LTV'],
-        "Advanced LTV": data['Advanced LTV'],
-        "Average Purchase Value": data['Average Purchase Value'],
-        "Average Purchase Frequency": data['Average Purchase Frequency'],
-        "Average Customer Lifespan (Months)": data['Average Customer LifeSpan(Months)']
-    }
-    metrics_df = pd.DataFrame(metrics.items(), columns=["Metric", "Value"])
-    metrics_df["Value"] = metrics_df["Value"].round(2).astype(str)
-
-    if pathname == '/metrics':
-        page_layout = get_metrics_layout()
-    elif pathname == '/weekly':
-        page_layout = get_weekly_layout()
-    elif pathname=='monthly':
-        page_layout = get_insights_layout()
-    else:
-        page_layout = get_home_layout()
-
-    return page_layout, "✅ Data refreshed successfully!", "🔄 Refresh Data"
-
-
-
-# Run the Dash app
-if __name__ == '__main__':
-    app.run(debug=True)
+import os
+import time
+from datetime import datetime
+
+# Process start, used to report startup and time-to-first-response
+STARTED_AT = time.monotonic()
+
+import dash
+from dash import dcc, html, dash_table
+import plotly.express as px
+import pandas as pd
+from dash.dependencies import Input, Output, State
+from dash import Patch
+from flask import jsonify, Response
+from crm_script_monthly import MONTHLY_COLUMNS
+from crm_script_weekly import WEEKLY_COLUMNS
+from salesforce_data import SITE_NAMES, SYNC_MODE
+from period_engine import period_breakdown, GRANULARITIES, BREAKDOWN_COLUMNS
+from cohorts import cohort_matrices, MAX_COHORT_MONTHS
+from pipeline import load_sites, result_cache
+from refresh import SnapshotRefresher
+from snapshot_store import SnapshotStore
+from layout_cache import LayoutCache
+from table_query import query_page, PAGE_SIZE
+from chart_data import chart_series, series_update
+from instrumentation import Instrumentation
+
+# Per-stage durations, row counts and memory of every refresh and page build
+instrumentation = Instrumentation()
+
+# Function to load data
+def load_data():
+    # Every configured site, computed in parallel worker processes when there are several
+    return load_sites(SITE_NAMES, instrumentation)
+
+# Snapshots are rebuilt on a background thread and swapped in atomically;
+# page callbacks only ever read the current one. The snapshot store is shared
+# by every gunicorn worker, so only one of them loads from Salesforce.
+refresher = SnapshotRefresher(load_data, store=SnapshotStore(), instrumentation=instrumentation)
+
+dropdown_options = [{"label": col.replace("_", " ").title(), "value": col} for col in MONTHLY_COLUMNS if col != "month"]
+
+# Dash app setup
+app = dash.Dash(__name__, suppress_callback_exceptions=True)
+server = app.server
+app.title = "Customer Insights"
+
+# Main Layout
+app.layout = html.Div([
+    dcc.Location(id='url', refresh=False),
+    
+    html.Div([
+        dcc.Link('🏠 Home', href='/'),
+        " | ",
+        dcc.Link('📊 Monthly Report', href='/monthly'),
+        " | ",
+        # dcc.Link('📈 Compare Two Features', href='/dynamic'),
+        # " | ",
+        dcc.Link('📑 LTV and Key Metrics', href='/metrics'),
+        " | ",
+        dcc.Link('📆 Weekly Report', href='/weekly'),
+        " | ",
+        dcc.Link('🔎 Explore Periods', href='/explore'),
+        " | ",
+        dcc.Link('🧩 Cohorts', href='/cohorts'),
+        " | ",
+        dcc.Link('🩺 Diagnostics', href='/diagnostics'),
+        " | ",
+        html.Button("🔄 Refresh Data", id="refresh-btn", n_clicks=0),
+        # Only shown when several sites are loaded; every site's pages are pre-rendered
+        dcc.Dropdown(id='site-selector', clearable=False, style={'display': 'none'}),
+    ], style={'padding': '10px', 'fontSize': '20px'}),
+
+    html.Div(id="refresh-status", style={"color": "blue", "fontSize": "18px", "marginTop": "10px"}),  # Loading Message
+
+    # Version of the snapshot the current page was rendered from, polled against the refresher
+    dcc.Store(id='snapshot-version'),
+    # Chart series of the current snapshot and site (see chart_data) and the digests of what was sent
+    dcc.Store(id='chart-data'),
+    dcc.Store(id='chart-digests'),
+    dcc.Interval(id='refresh-poll', interval=2000),
+    
+    html.Div(id='page-content')  # Page Content
+])
+
+
+startup_timings = {}
+
+
+@server.after_request
+def record_first_response(response):
+    if 'first_response_seconds' not in startup_timings:
+        startup_timings['first_response_seconds'] = round(time.monotonic() - STARTED_AT, 3)
+    return response
+
+
+@server.route('/healthz')
+def healthz():
+    """ Answers immediately, whether or not the first data load has finished """
+    snapshot = refresher.current()
+    first_snapshot_seconds = None
+    if refresher.first_snapshot_at is not None:
+        first_snapshot_seconds = round(refresher.first_snapshot_at - STARTED_AT, 3)
+    return jsonify({
+        'status': 'ok' if snapshot is not None else 'loading',
+        'snapshot_version': snapshot.version if snapshot is not None else None,
+        'refreshing': refresher.refreshing,
+        'last_error': str(refresher.last_error) if refresher.last_error is not None else None,
+        'first_snapshot_seconds': first_snapshot_seconds,
+        'layout_cache': layout_cache.stats(),
+        # Loads of this process only; site worker processes keep their own counts
+        'result_cache': result_cache.stats(),
+        **startup_timings,
+    })
+
+
+# Not /metrics: that path is the LTV page
+@server.route('/server-metrics')
+def server_metrics():
+    """ Prometheus text exposition of the refresh and page build instrumentation """
+    snapshot = refresher.current()
+    cache_stats = layout_cache.stats()
+    results_stats = result_cache.stats()
+    body = instrumentation.prometheus(extra_gauges=[
+        ('crm_snapshot_version', "Version of the snapshot this worker serves",
+         snapshot.version if snapshot is not None else None),
+        ('crm_snapshot_age_seconds', "Seconds since the served snapshot was built",
+         (datetime.now() - snapshot.built_at).total_seconds() if snapshot is not None else None),
+        ('crm_refreshing', "1 while a refresh is running", int(refresher.refreshing)),
+        ('crm_layout_cache_hits', "Page layouts served from the cache", cache_stats['hits']),
+        ('crm_layout_cache_misses', "Page layouts built on request", cache_stats['misses']),
+        ('crm_result_cache_hits', "Loads served from the in-memory result cache", results_stats['hits']),
+        ('crm_result_cache_disk_hits', "Loads served from the on-disk result cache", results_stats['disk_hits']),
+        ('crm_result_cache_misses', "Loads computed from the bookings", results_stats['misses']),
+    ])
+    return Response(body, mimetype='text/plain; version=0.0.4')
+
+
+def get_home_layout():
+    return html.Div([
+        # Main Container for Centering
+        html.Div([
+            # Welcome Header
+            html.H2("Welcome to Jungle World Data Dashboard", className="text-center mt-4"),
+
+            # Box for Description and Navigation Instructions
+            html.Div([
+                html.P("📊 Explore your data using the navigation bar above:"),
+                html.Ul([
+                    html.Li("Click WEEKLY for weekly metrics"),
+                    html.Li("Click MONTHLY for monthly trends")
+                ], style={"listStyleType": "none", "paddingLeft": "0"}),
+                
+                html.P("🔍 Data updates may take a few moments to process"),
+            ], style={
+                "padding": "20px",
+                "backgroundColor": "#f9f9f9",
+                "borderRadius": "10px",
+                "boxShadow": "0 4px 8px rgba(0, 0, 0, 0.1)",
+                "maxWidth": "600px",
+                "margin": "0 auto",
+                "fontSize": "16px"
+            }),
+
+            # Spacer
+            html.Br(),
+
+        
+
+            
+            # Final message with centered text
+            html.P("Navigate using the links above to view your data.", style={"textAlign": "center", "fontSize": "16px", "fontWeight": "bold"})
+        ], style={
+            "textAlign": "center",  # Center everything in this div
+            "padding": "20px",
+            "fontSize": "16px"
+        }),
+    ])
+
+
+def chart_figure(frame, x, columns, title, kind='line'):
+    """ Empty figure of one chart; the traces are filled in the browser from the chart-data store """
+    trace = {'type': 'scatter', 'mode': 'lines+markers'} if kind == 'line' else {'type': 'bar'}
+    return {
+        'data': [{**trace, 'name': column, 'x': [], 'y': []} for column in columns],
+        'layout': {
+            'title': {'text': title},
+            'barmode': 'group',
+            'xaxis': {'title': {'text': x}},
+            'yaxis': {'title': {'text': 'value'}},
+            'legend': {'title': {'text': 'variable'}},
+            # Read by RENDER_CHART: the store key and x column of this chart
+            'meta': {'frame': frame, 'x': x},
+        },
+    }
+
+
+# Charted series of the monthly and weekly pages, rendered client-side: (graph id, frame, x, columns, title, kind)
+CHARTS = [
+    ('monthly-customers-graph', 'monthly', 'month', ['new_customers', 'returning_customers'],
+     "New vs Returning Customers Trend", 'line'),
+    ('monthly-percentages-graph', 'monthly', 'month', ['new_percentage', 'returning_percentage'],
+     "New vs Returning Customers Percentage Trend", 'line'),
+    ('monthly-revenue-graph', 'monthly', 'month', ['total_revenue', 'new_customer_revenue', 'returning_customer_revenue'],
+     "Revenue Breakdown", 'bar'),
+    ('monthly-new-returning-revenue-graph', 'monthly', 'month', ['new_customer_revenue', 'returning_customer_revenue'],
+     "New Customer Revenue vs Returning Customer Revenue", 'bar'),
+    ('weekly-customers-graph', 'weekly', 'week', ['new_customers', 'returning_customers'],
+     "New vs Returning Customers Trend (Weekly)", 'line'),
+    ('weekly-percentages-graph', 'weekly', 'week', ['new_percentage', 'returning_percentage'],
+     "Customer Type Percentages (Weekly)", 'line'),
+    ('weekly-revenue-graph', 'weekly', 'week', ['total_revenue', 'new_customer_revenue', 'returning_customer_revenue'],
+     "Revenue Breakdown (Weekly)", 'bar'),
+    ('weekly-new-returning-revenue-graph', 'weekly', 'week', ['new_customer_revenue', 'returning_customer_revenue'],
+     "New vs Returning Revenue (Weekly)", 'bar'),
+]
+
+
+def chart_graphs(frame):
+    return [dcc.Graph(id=graph_id, figure=chart_figure(chart_frame, x, columns, title, kind))
+            for graph_id, chart_frame, x, columns, title, kind in CHARTS if chart_frame == frame]
+
+
+# The monthly and weekly pages are static shells: the tables are paged by
+# update_*_table and the charts drawn from the chart-data store, so the same
+# layout serves every snapshot and site and is never rebuilt
+def get_weekly_layout():
+    return html.Div([
+        html.H1("📅 Weekly CRM Report"),
+        
+        html.H2("Weekly Breakdown Table"),
+        # Rows are paged, sorted and filtered server-side by update_weekly_table
+        dash_table.DataTable(
+            id='weekly-table',
+            columns=[{"name": col.replace("_", " ").title(), "id": col} for col in WEEKLY_COLUMNS],
+            page_current=0,
+            page_size=PAGE_SIZE,
+            page_action='custom',
+            sort_action='custom',
+            sort_mode='multi',
+            filter_action='custom',
+            style_table={'overflowX': 'auto'},
+            style_cell={'textAlign': 'left'},
+            style_header={'backgroundColor': 'lightgrey', 'fontWeight': 'bold'}
+        ),
+
+        html.H2("Insights"),
+        *chart_graphs('weekly'),
+    ])
+
+
+# Function to generate page layouts dynamically
+def get_insights_layout():
+    return html.Div([
+        html.H1("Monthly CRM Report"),
+        html.H2("Monthly Breakdown Table"),
+        # Rows are paged, sorted and filtered server-side by update_monthly_table
+        dash_table.DataTable(
+            id='monthly-table',
+            columns=[{"name": col, "id": col} for col in MONTHLY_COLUMNS],
+            page_current=0,
+            page_size=PAGE_SIZE,
+            page_action='custom',
+            sort_action='custom',
+            sort_mode='multi',
+            filter_action='custom',
+            style_table={'overflowX': 'auto'}
+        ),
+        html.H2("Insights"),
+        *chart_graphs('monthly'),
+    ])
+
+
+
+def get_metrics_layout(snapshot):
+    metrics_df = snapshot.metrics_df
+    return html.Div([
+        html.H1("Key Metrics"),
+        dash_table.DataTable(
+            columns=[{"name": col, "id": col} for col in metrics_df.columns],
+            data=metrics_df.to_dict('records'),
+            style_table={'overflowX': 'auto'}
+        ),
+    ])
+
+def get_explore_layout(snapshot):
+    days = snapshot.customer_days['day'] if 'day' in snapshot.customer_days else pd.Series(dtype='datetime64[us]')
+    first_day = days.min() if not days.empty else None
+    last_day = days.max() if not days.empty else None
+    return html.Div([
+        html.H1("🔎 Explore Periods"),
+        html.Div([
+            dcc.DatePickerRange(
+                id='explore-range',
+                min_date_allowed=first_day,
+                max_date_allowed=last_day,
+                start_date=first_day,
+                end_date=last_day,
+                display_format='YYYY-MM-DD',
+            ),
+            dcc.Dropdown(
+                id='explore-granularity',
+                options=[{"label": name.title(), "value": name} for name in GRANULARITIES],
+                value='month',
+                clearable=False,
+                style={'width': '200px'},
+            ),
+            dcc.RadioItems(
+                id='explore-new-revenue',
+                options=[
+                    {"label": "New revenue: first booking", "value": 'first'},
+                    {"label": "New revenue: all bookings", "value": 'all'},
+                ],
+                value='first',
+                inline=True,
+            ),
+        ], style={'display': 'flex', 'gap': '20px', 'alignItems': 'center'}),
+        html.P(id='explore-message'),
+        # Filled in place by update_explore; hidden while there is nothing to show
+        html.Div(get_explore_results(), id='explore-results', style={'display': 'none'}),
+    ])
+
+
+EXPLORE_TABLE_COLUMNS = ['period'] + BREAKDOWN_COLUMNS
+EXPLORE_CUSTOMER_COLUMNS = ['new_customers', 'returning_customers']
+EXPLORE_REVENUE_COLUMNS = ['total_revenue', 'new_customer_revenue', 'returning_customer_revenue']
+
+
+def get_explore_results():
+    """ Table and charts of a period_breakdown() result, empty until update_explore fills them """
+    return [
+        dash_table.DataTable(
+            id='explore-table',
+            columns=[{"name": col.replace("_", " ").title(), "id": col} for col in EXPLORE_TABLE_COLUMNS],
+            data=[],
+            page_size=PAGE_SIZE,
+            sort_action='native',
+            style_table={'overflowX': 'auto'},
+            style_header={'backgroundColor': 'lightgrey', 'fontWeight': 'bold'}
+        ),
+        dcc.Graph(id='explore-customers-graph',
+                  figure=chart_figure(None, 'period', EXPLORE_CUSTOMER_COLUMNS, "New vs Returning Customers")),
+        dcc.Graph(id='explore-revenue-graph',
+                  figure=chart_figure(None, 'period', EXPLORE_REVENUE_COLUMNS, "Revenue Breakdown", 'bar')),
+    ]
+
+
+def explore_figure_patch(display_df, columns, title=None):
+    """ Patch of an explore chart: new x and y of every trace, and the title when it changed """
+    patch = Patch()
+    for i, column in enumerate(columns):
+        patch['data'][i]['x'] = display_df['period'].tolist()
+        patch['data'][i]['y'] = display_df[column].tolist()
+    if title is not None:
+        patch['layout']['title']['text'] = title
+    return patch
+
+
+def get_cohorts_layout(snapshot):
+    cohort_df = snapshot.cohort_df
+    if cohort_df.empty:
+        return html.Div([
+            html.H1("🧩 Cohort Retention"),
+            html.P("No cohort data in this snapshot yet; it appears after the next refresh."),
+        ])
+    sizes, retention, revenue_retention = cohort_matrices(cohort_df, MAX_COHORT_MONTHS)
+    labels = {"x": "Months Since First Visit", "y": "First-Visit Month", "color": "%"}
+    sizes_df = sizes.rename('customers').reset_index()
+
+    return html.Div([
+        html.H1("🧩 Cohort Retention"),
+        html.P("Each row is the customers whose first visit fell in that month. Month 0 is 100%; "
+               "later months show the share of customers who came back and their revenue relative to month 0."),
+        dcc.Graph(figure=px.imshow(
+            retention, labels=labels, text_auto=True, aspect='auto', color_continuous_scale='Blues',
+            title="Customers Returning (% of Cohort)"
+        ).update_yaxes(type='category')),
+        dcc.Graph(figure=px.imshow(
+            revenue_retention, labels=labels, text_auto=True, aspect='auto', color_continuous_scale='Greens',
+            title="Revenue (% of Month 0 Revenue)"
+        ).update_yaxes(type='category')),
+        html.H2("Cohort Sizes"),
+        dash_table.DataTable(
+            columns=[{"name": col.replace("_", " ").title(), "id": col} for col in sizes_df.columns],
+            data=sizes_df.to_dict('records'),
+            page_size=PAGE_SIZE,
+            style_table={'overflowX': 'auto'},
+            style_cell={'textAlign': 'left'},
+            style_header={'backgroundColor': 'lightgrey', 'fontWeight': 'bold'}
+        ),
+    ])
+
+
+def get_diagnostics_layout():
+    """ Stage timings of the last refresh and of the page builds; rendered fresh on every visit """
+    run = instrumentation.last_run('refresh')
+    if run is None:
+        return html.Div([
+            html.H1("🩺 Diagnostics"),
+            html.P("No refresh has run in this worker yet."),
+        ])
+
+    stages_df = pd.DataFrame([{
+        'Stage': record['stage'],
+        'Seconds': round(record['seconds'], 3),
+        'Rows': record['rows'] if record['rows'] is not None else '',
+        'RSS (MB)': round(record['rss_bytes'] / 2 ** 20, 1),
+        'Peak traced (MB)': round(record['peak_traced_bytes'] / 2 ** 20, 1) if 'peak_traced_bytes' in record else '',
+        'Error': record.get('error', ''),
+    } for record in run['stages']])
+    layouts_df = pd.DataFrame([{
+        'Page': name[len('layout '):],
+        'Last build (s)': round(record['seconds'], 3),
+        'Builds': record['count'],
+    } for name, record in sorted(instrumentation.stages.items()) if name.startswith('layout ')])
+
+    summary = (f"Last refresh {datetime.fromtimestamp(run['started_at']):%Y-%m-%d %H:%M:%S}: "
+               f"{run['seconds']:.2f}s, peak RSS {run['peak_rss_bytes'] / 2 ** 20:.0f} MB")
+    if run['error'] is not None:
+        summary += f", failed with {run['error']}"
+
+    return html.Div([
+        html.H1("🩺 Diagnostics"),
+        html.P(summary),
+        html.H2("Refresh Stages"),
+        dash_table.DataTable(
+            columns=[{"name": col, "id": col} for col in stages_df.columns],
+            data=stages_df.to_dict('records'),
+            style_table={'overflowX': 'auto'},
+            style_cell={'textAlign': 'left'},
+            style_header={'backgroundColor': 'lightgrey', 'fontWeight': 'bold'}
+        ),
+        dcc.Graph(figure=px.bar(stages_df, x='Stage', y='Seconds', title="Time per Stage (Last Refresh)")),
+        html.H2("Page Builds"),
+        dash_table.DataTable(
+            columns=[{"name": col, "id": col} for col in layouts_df.columns],
+            data=layouts_df.to_dict('records'),
+            style_table={'overflowX': 'auto'},
+            style_cell={'textAlign': 'left'},
+            style_header={'backgroundColor': 'lightgrey', 'fontWeight': 'bold'}
+        ),
+    ])
+
+
+def get_loading_layout():
+    return html.Div([
+        html.H2("⏳ Data is still loading"),
+        html.P("The first data load has not finished yet. This page updates automatically once it has."),
+    ], style={"textAlign": "center", "padding": "20px"})
+
+
+# Data pages are built once per snapshot and served from the cache until the next refresh
+PAGE_BUILDERS = {
+    '/metrics': get_metrics_layout,
+    '/explore': get_explore_layout,
+    '/cohorts': get_cohorts_layout,
+}
+PAGE_BUILDERS = {page: instrumentation.timed(f"layout {page}", build) for page, build in PAGE_BUILDERS.items()}
+layout_cache = LayoutCache()
+
+# Pages whose layout does not depend on the snapshot, built once
+STATIC_PAGES = {
+    '/monthly': get_insights_layout(),
+    '/weekly': get_weekly_layout(),
+}
+
+
+def selected_site(snapshot, site):
+    """ The picked site if the snapshot has it, else the snapshot's own (None for a single-site load) """
+    sites = snapshot.site_names()
+    if not sites:
+        return None
+    return site if site in sites else sites[0]
+
+
+def render_page(pathname, snapshot, site=None):
+    if pathname == '/diagnostics':
+        return get_diagnostics_layout()
+    if pathname not in PAGE_BUILDERS and pathname not in STATIC_PAGES:  # default to home
+        return get_home_layout()
+    if snapshot is None:
+        return get_loading_layout()
+    if pathname in STATIC_PAGES:
+        return STATIC_PAGES[pathname]
+    return layout_cache.get(pathname, snapshot, PAGE_BUILDERS[pathname], selected_site(snapshot, site))
+
+
+SITE_SELECTOR_STYLE = {'display': 'inline-block', 'width': '240px', 'verticalAlign': 'middle', 'marginLeft': '10px'}
+
+
+@app.callback(
+    [Output('site-selector', 'options'), Output('site-selector', 'value'), Output('site-selector', 'style')],
+    Input('snapshot-version', 'data'),
+    State('site-selector', 'value'),
+)
+def update_site_options(version, site):
+    """ Sites of the current snapshot; the selector stays hidden for a single site """
+    snapshot = refresher.current()
+    if snapshot is None or not snapshot.site_names():
+        return [], None, {'display': 'none'}
+    return snapshot.site_names(), selected_site(snapshot, site), SITE_SELECTOR_STYLE
+
+
+# Combined Callback for Page Navigation & Refresh Button
+@app.callback(
+    [Output('page-content', 'children'),
+     Output('refresh-status', 'children'),
+     Output("refresh-btn", "children"),  # Updates button text
+     Output('snapshot-version', 'data')],
+    [Input('url', 'pathname'), Input('refresh-btn', 'n_clicks'), Input('site-selector', 'value')],
+    prevent_initial_call=True
+)
+def update_page(pathname, n_clicks, site):
+    """ Handles both page navigation and refresh button with a loading state """
+    ctx = dash.callback_context
+    if ctx.triggered and ctx.triggered[0]['prop_id'] == 'refresh-btn.n_clicks':
+        # Start the reload in the background and show "Refreshing..." Message
+        refresher.trigger()
+        return dash.no_update, "🕛 Refreshing data... Please wait.", "Refreshing...", dash.no_update
+
+    snapshot = refresher.current()
+    version = snapshot.version if snapshot is not None else None
+    if ctx.triggered and ctx.triggered[0]['prop_id'] == 'site-selector.value' and pathname in STATIC_PAGES:
+        # The shell stays; its tables and charts follow the site themselves
+        return dash.no_update, "", "🔄 Refresh Data", version
+    return render_page(pathname, snapshot, site), "", "🔄 Refresh Data", version
+
+
+# Callback that picks up a newly swapped-in snapshot (manual or scheduled refresh)
+@app.callback(
+    [Output('page-content', 'children', allow_duplicate=True),
+     Output('refresh-status', 'children', allow_duplicate=True),
+     Output("refresh-btn", "children", allow_duplicate=True),
+     Output('snapshot-version', 'data', allow_duplicate=True)],
+    Input('refresh-poll', 'n_intervals'),
+    [State('url', 'pathname'), State('snapshot-version', 'data'), State('refresh-btn', 'children'),
+     State('site-selector', 'value')],
+    prevent_initial_call=True
+)
+def refresh_dashboard(n_intervals, pathname, rendered_version, button_text, site):
+    """ Re-renders the page once a new snapshot is available; never waits on Salesforce """
+    if refresher.refreshing:
+        return dash.no_update, dash.no_update, dash.no_update, dash.no_update
+
+    snapshot = refresher.current()
+    if snapshot is not None and snapshot.version != rendered_version:
+        # No success message for the very first render of the page
+        message = ""
+        if rendered_version is not None:
+            message = "✅ Data refreshed successfully!"
+            run = instrumentation.last_run('refresh')
+            if run is not None and run['error'] is None:
+                message += f" (took {run['seconds']:.1f}s; see Diagnostics for the breakdown)"
+        page = render_page(pathname, snapshot, site)
+        if pathname in STATIC_PAGES and rendered_version is not None:
+            # Static shells are already on the page; only the changed series are pushed (update_chart_data)
+            page = dash.no_update
+        return page, message, "🔄 Refresh Data", snapshot.version
+
+    if button_text == "Refreshing..." and refresher.last_error is not None:
+        return dash.no_update, f"⚠️ Data refresh failed: {refresher.last_error}", "🔄 Refresh Data", dash.no_update
+
+    return dash.no_update, dash.no_update, dash.no_update, dash.no_update
+
+
+def _table_page(frame_name, order_column, site, page_current, page_size, sort_by, filter_query):
+    snapshot = refresher.current()
+    if snapshot is None:
+        return [], 1
+    df = getattr(snapshot.view(selected_site(snapshot, site)), frame_name)
+    return query_page(df, page_current, page_size, sort_by, filter_query, order_columns=(order_column,))
+
+
+@app.callback(
+    [Output('monthly-table', 'data'), Output('monthly-table', 'page_count')],
+    [Input('monthly-table', 'page_current'), Input('monthly-table', 'page_size'),
+     Input('monthly-table', 'sort_by'), Input('monthly-table', 'filter_query'),
+     Input('site-selector', 'value'), Input('snapshot-version', 'data')]
+)
+def update_monthly_table(page_current, page_size, sort_by, filter_query, site, version):
+    """ Serves one page of the monthly breakdown from the current snapshot (again after a refresh) """
+    return _table_page('monthly_df', 'month', site, page_current, page_size, sort_by, filter_query)
+
+
+@app.callback(
+    [Output('weekly-table', 'data'), Output('weekly-table', 'page_count')],
+    [Input('weekly-table', 'page_current'), Input('weekly-table', 'page_size'),
+     Input('weekly-table', 'sort_by'), Input('weekly-table', 'filter_query'),
+     Input('site-selector', 'value'), Input('snapshot-version', 'data')]
+)
+def update_weekly_table(page_current, page_size, sort_by, filter_query, site, version):
+    """ Serves one page of the weekly breakdown from the current snapshot (again after a refresh) """
+    return _table_page('weekly_df', 'week', site, page_current, page_size, sort_by, filter_query)
+
+
+@app.callback(
+    [Output('explore-message', 'children'), Output('explore-results', 'style'), Output('explore-table', 'data'),
+     Output('explore-customers-graph', 'figure'), Output('explore-revenue-graph', 'figure')],
+    [Input('explore-range', 'start_date'), Input('explore-range', 'end_date'),
+     Input('explore-granularity', 'value'), Input('explore-new-revenue', 'value')],
+    State('site-selector', 'value')
+)
+def update_explore(start_date, end_date, granularity, new_revenue, site):
+    """ Breakdown of the picked range from the snapshot's daily aggregates, patched into the explore charts """
+    hidden = {'display': 'none'}
+    snapshot = refresher.current()
+    if snapshot is not None:
+        snapshot = snapshot.view(selected_site(snapshot, site))
+    if snapshot is None or snapshot.customer_days.empty:
+        if SYNC_MODE == 'stream':
+            message = "Streaming loads (SF_SYNC_MODE=stream) do not keep the daily aggregates the explorer needs."
+        else:
+            message = "No daily data yet; it appears after the next refresh."
+        return message, hidden, dash.no_update, dash.no_update, dash.no_update
+    breakdown = period_breakdown(snapshot.daily, granularity, start_date, end_date, new_revenue)
+    if breakdown.empty:
+        return "No bookings in the selected range.", hidden, dash.no_update, dash.no_update, dash.no_update
+
+    display_df = breakdown.drop(columns='period_start').assign(period=breakdown['period'].astype(str))
+    title = granularity.title()
+    revenue_figure = explore_figure_patch(display_df, EXPLORE_REVENUE_COLUMNS, f"Revenue Breakdown ({title})")
+    ctx = dash.callback_context
+    if [trigger['prop_id'] for trigger in ctx.triggered] == ['explore-new-revenue.value']:
+        # Switching how new revenue is counted leaves the periods and customer counts as they are
+        customers_figure = dash.no_update
+    else:
+        customers_figure = explore_figure_patch(display_df, EXPLORE_CUSTOMER_COLUMNS,
+                                                f"New vs Returning Customers ({title})")
+    return "", {}, display_df.round(2).to_dict('records'), customers_figure, revenue_figure
+
+
+@app.callback(
+    [Output('chart-data', 'data'), Output('chart-digests', 'data')],
+    [Input('snapshot-version', 'data'), Input('site-selector', 'value')],
+    State('chart-digests', 'data'),
+)
+def update_chart_data(version, site, digests):
+    """ Chart series of the current snapshot and site; only what the browser does not hold yet is sent """
+    snapshot = refresher.current()
+    if snapshot is None:
+        return dash.no_update, dash.no_update
+    site = selected_site(snapshot, site)
+    with instrumentation.stage('chart_data') as record:
+        series = chart_series(snapshot.view(site))
+        update, digests = series_update(series, digests)
+        record['rows'] = sum(len(values) for columns in series.values() for values in columns.values())
+    if update is None:
+        return dash.no_update, dash.no_update
+    return update, digests
+
+
+# Draws one chart of the monthly or weekly page from the chart-data store (see chart_figure())
+RENDER_CHART = """
+function(data, figure) {
+    var frame = data && figure && data[figure.layout.meta.frame];
+    if (!frame) {
+        return window.dash_clientside.no_update;
+    }
+    var x = frame[figure.layout.meta.x];
+    return Object.assign({}, figure, {
+        data: figure.data.map(function(trace) {
+            return Object.assign({}, trace, {x: x, y: frame[trace.name]});
+        })
+    });
+}
+"""
+for graph_id, *_ in CHARTS:
+    app.clientside_callback(RENDER_CHART, Output(graph_id, 'figure'), Input('chart-data', 'data'), State(graph_id, 'figure'))
+
+
+# Pre-render the pages of every snapshot this process loads
+refresher.on_swap = lambda snapshot: layout_cache.warm(snapshot, PAGE_BUILDERS)
+
+# "lazy" boots straight from the last on-disk snapshot (or a loading page) and
+# loads in the background; "blocking" waits for the first load like before
+STARTUP_MODE = os.getenv('STARTUP_MODE', 'lazy')
+
+# Initial Data Load (skipped when another worker already published a snapshot).
+# The site worker processes (spawned) import `python app.py` as __mp_main__; they never load on their own.
+if __name__ != '__mp_main__':
+    if STARTUP_MODE == 'blocking':
+        if refresher.current() is None:
+            refresher.refresh(wait_for_loader=True)
+    elif refresher.current() is None or refresher.stale():
+        refresher.trigger()
+    refresher.start()
+
+startup_timings['app_ready_seconds'] = round(time.monotonic() - STARTED_AT, 3)
+
+
+# Run the Dash app
+if __name__ == '__main__':
+    app.run(debug=True)
@@ -0,0 +1,623 @@
+import argparse
+import ctypes
+import gc
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from dataclasses import dataclass, asdict, replace
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from salesforce_data import get_dataframe, booking_frame, customer_mask
+from bookings import BookingFrame, prepare_bookings, bookings_from_frame, with_first_visits
+from crm_script_monthly import monthly_breakdown
+from crm_script_weekly import weekly_breakdown
+from period_engine import daily_aggregates, period_breakdown
+from cohorts import cohort_activity, COHORT_COLUMNS
+from metric_params import metric_params
+from aggregates import build_state, state_data
+from snapshot import build_snapshot
+from streaming import stream_metrics
+from pipeline import rollup
+from chart_data import chart_series, series_update
+from instrumentation import rss_bytes, peak_rss_bytes
+
+
+# Benchmark harness for the analytics pipeline. Synthetic Salesforce-shaped
+# bookings go through every stage (parsing, breakdowns, snapshot and page
+# layouts); each stage is timed and memory-profiled and the results are
+# written as JSON so runs can be compared for regressions.
+#
+#   python benchmark.py --sizes 10000,100000,1000000
+#   python benchmark.py --sizes 100000 --compare data/benchmarks/<earlier run>.json
+#
+# The record list alone takes several GB at 10M bookings.
+BENCHMARK_DIR = os.getenv('BENCHMARK_DIR', os.path.join('data', 'benchmarks'))
+
+DEFAULT_SIZES = (10_000, 100_000, 1_000_000, 10_000_000)
+
+# Outputs are checked against the reference implementations up to this many bookings
+# (they scan the bookings once per period, so they get slow quickly)
+CHECK_MAX_BOOKINGS = 100_000
+
+# Chunk size of the streaming stage
+STREAM_CHUNK_ROWS = 50_000
+
+EXCLUDED_EMAIL = 'hello@jungleworldpark.com'
+
+
+@dataclass(frozen=True)
+class SyntheticSpec:
+    bookings: int
+    customers: int
+    # Skew of visits per customer: 0 spreads bookings evenly, higher values
+    # concentrate them on fewer, frequently returning customers
+    repeat_skew: float = 1.0
+    null_email_rate: float = 0.05
+    empty_email_rate: float = 0.02
+    excluded_email_rate: float = 0.005
+    null_customer_id_rate: float = 0.03
+    null_value_rate: float = 0.02
+    start: str = '2023-08-28'
+    span_days: int = 730
+    seed: int = 0
+
+
+def synthetic_records(spec):
+    """ A query_all()-shaped result of random bookings following `spec` """
+    rng = np.random.default_rng(spec.seed)
+    n = spec.bookings
+
+    weights = 1.0 / np.arange(1, spec.customers + 1) ** spec.repeat_skew
+    customer = rng.choice(spec.customers, size=n, p=weights / weights.sum())
+
+    start = np.datetime64(pd.Timestamp(spec.start).to_datetime64(), 's')
+    visit = start + rng.integers(0, spec.span_days * 86400, n).astype('timedelta64[s]')
+    visit_str = np.datetime_as_string(visit, unit='s')
+
+    emails = np.array([f"customer{c}@example.com" for c in range(spec.customers)], dtype=object)[customer]
+    emails[rng.random(n) < spec.empty_email_rate] = ''
+    emails[rng.random(n) < spec.null_email_rate] = None
+    emails[rng.random(n) < spec.excluded_email_rate] = EXCLUDED_EMAIL
+
+    customer_ids = np.array([f"CUST-{c}" for c in range(spec.customers)], dtype=object)[customer]
+    customer_ids[rng.random(n) < spec.null_customer_id_rate] = None
+
+    values = np.round(rng.gamma(2.0, 20.0, n), 2).astype(object)
+    values[rng.random(n) < spec.null_value_rate] = None
+
+    # One shared attributes dict instead of one per record
+    attributes = {'type': 'Bnow__Booking__c'}
+    records = [
+        {
+            'attributes': attributes,
+            'Id': f"a0B{i:015d}",
+            'Bnow__Customer_Email__c': email,
+            'Bnow__All_Products_Processed__c': f"{visit_at}.000+0000",
+            'Bnow__Balance_Paid__c': value,
+            'Bnow__Status__c': 'Booked',
+            'Bnow__Customer_ID__c': customer_id,
+            'SystemModstamp': f"{visit_at}.000+0000",
+        }
+        for i, (email, visit_at, value, customer_id)
+        in enumerate(zip(emails, visit_str, values, customer_ids))
+    ]
+    return {"totalSize": n, "done": True, "records": records}
+
+
+def reference_monthly_breakdown(df, df_original):
+    """ The original per-month loop implementation of monthly_breakdown(), used as the correctness oracle """
+    df = df.copy()
+    df_original = df_original.copy()
+    df['visit_date'] = pd.to_datetime(df['visit_date'], errors='coerce').dt.tz_localize(None)
+    df_original['visit_date'] = pd.to_datetime(df_original['visit_date'], errors='coerce').dt.tz_localize(None)
+    df['month'] = df['visit_date'].dt.to_period('M')
+    df_original['month'] = df_original['visit_date'].dt.to_period('M')
+
+    first_visits = df.groupby('email')['visit_date'].min().reset_index()
+    first_visits.columns = ['email', 'first_visit_date']
+    first_visits['first_visit_month'] = first_visits['first_visit_date'].dt.to_period('M')
+    df = df.merge(first_visits, on='email', how='left')
+
+    monthly_results = []
+    for month in sorted(df['month'].unique()):
+        month_data = df[df['month'] == month]
+        month_data_original = df_original[df_original['month'] == month]
+
+        total_customers = month_data['email'].nunique()
+        new_customers_df = month_data[month_data['first_visit_month'] == month]
+        new_customers = new_customers_df['email'].nunique()
+        returning_customers = total_customers - new_customers
+
+        month_revenue = month_data['purchase_value'].sum()
+        new_revenue = new_customers_df.groupby('email').first()['purchase_value'].sum()
+
+        monthly_results.append({
+            'month': month,
+            'total_customers': total_customers,
+            'new_customers': new_customers,
+            'returning_customers': returning_customers,
+            'new_percentage': round((new_customers / total_customers * 100), 2) if total_customers > 0 else 0,
+            'returning_percentage': round((returning_customers / total_customers * 100), 2) if total_customers > 0 else 0,
+            'total_revenue': month_data_original['purchase_value'].sum(),
+            'new_customer_revenue': new_revenue,
+            'returning_customer_revenue': month_revenue - new_revenue
+        })
+
+    total_revenue_all = df['purchase_value'].sum()
+    unique_customers = df['email'].nunique()
+    basic_ltv = total_revenue_all / unique_customers if unique_customers > 0 else 0
+    avg_purchase_value = total_revenue_all / len(df) if len(df) > 0 else 0
+    avg_purchase_frequency = len(df) / unique_customers if unique_customers > 0 else 0
+
+    df_sorted = df.sort_values(['email', 'visit_date'])
+    df_sorted['next_visit'] = df_sorted.groupby('email')['visit_date'].shift(-1)
+    days_between_visits = (df_sorted['next_visit'] - df_sorted['visit_date']).dt.days.dropna()
+    avg_days_between_visits = days_between_visits.mean() if not days_between_visits.empty else 1
+    avg_customer_lifespan_months = 180 / avg_days_between_visits if avg_days_between_visits > 0 else 1
+
+    return {
+        'monthly_breakdown': pd.DataFrame(monthly_results),
+        'Basic LTV': basic_ltv,
+        'Advanced LTV': avg_purchase_value * avg_purchase_frequency * avg_customer_lifespan_months,
+        'Average Purchase Value': avg_purchase_value,
+        'Average Purchase Frequency': avg_purchase_frequency,
+        'Average Customer LifeSpan(Months)': avg_customer_lifespan_months
+    }
+
+
+def reference_weekly_breakdown(df, df_original):
+    """ The original per-week loop implementation of weekly_breakdown(), used as the correctness oracle """
+    df = df.copy()
+    df_original = df_original.copy()
+    df['visit_date'] = pd.to_datetime(df['visit_date'], errors='coerce').dt.tz_localize(None)
+    df_original['visit_date'] = pd.to_datetime(df_original['visit_date'], errors='coerce').dt.tz_localize(None)
+
+    cutoff = pd.to_datetime('2023-08-28')
+    df = df[df['visit_date'] >= cutoff]
+    df_original = df_original[df_original['visit_date'] >= cutoff]
+
+    email_min_dates = df.groupby('email')['visit_date'].min().reset_index()
+    email_min_dates.rename(columns={'visit_date': 'first_visit_date'}, inplace=True)
+    df = pd.merge(df, email_min_dates, on='email', how='left')
+
+    start_date = df['visit_date'].min()
+    end_date = df['visit_date'].max()
+    week_starts = pd.date_range(start=start_date, end=end_date, freq='W-MON')
+    week_ends = week_starts + pd.Timedelta(days=6)
+    week_labels = [f"{s.strftime('%b %d, %Y')} - {e.strftime('%b %d, %Y')}" for s, e in zip(week_starts, week_ends)]
+    bins = [start_date - pd.Timedelta(days=1)] + list(week_starts[1:]) + [end_date + pd.Timedelta(days=1)]
+
+    df['week_label'] = pd.cut(df['visit_date'], bins=bins, labels=week_labels, right=False)
+    df['first_visit_week'] = pd.cut(df['first_visit_date'], bins=bins, labels=week_labels, right=False)
+    df_original['week_label'] = pd.cut(df_original['visit_date'], bins=bins, labels=week_labels, right=False)
+
+    weekly_results = []
+    for week in sorted(df['week_label'].dropna().unique(), key=lambda x: week_labels.index(x)):
+        week_data = df[df['week_label'] == week]
+        week_data_original = df_original[df_original['week_label'] == week]
+
+        total_customers = week_data['email'].nunique()
+        new_customer_mask = week_data['week_label'].astype(str) == week_data['first_visit_week'].astype(str)
+        new_customers = week_data.loc[new_customer_mask, 'email'].nunique()
+        returning_customers = total_customers - new_customers
+        new_revenue = week_data.loc[new_customer_mask, 'purchase_value'].sum()
+
+        weekly_results.append({
+            'week': week,
+            'total_customers': total_customers,
+            'new_customers': new_customers,
+            'returning_customers': returning_customers,
+            'new_percentage': round((new_customers / total_customers * 100), 2) if total_customers else 0,
+            'returning_percentage': round((returning_customers / total_customers * 100), 2) if total_customers else 0,
+            'total_revenue': week_data_original['purchase_value'].sum(),
+            'new_customer_revenue': new_revenue,
+            'returning_customer_revenue': week_data['purchase_value'].sum() - new_revenue
+        })
+
+    return pd.DataFrame(weekly_results)
+
+
+def legacy_get_dataframe(results):
+    """ The original get_dataframe(): object string columns, the customer rows as a second copy """
+    df = pd.DataFrame(results["records"])
+    df = df[["Bnow__Customer_Email__c", "Bnow__All_Products_Processed__c", "Bnow__Balance_Paid__c", "Bnow__Customer_ID__c"]]
+    df.columns = ["email", "visit_date", "purchase_value", "customer_id"]
+    df["visit_date"] = pd.to_datetime(df["visit_date"])
+    df["purchase_value"] = df["purchase_value"].astype(float)
+    df_customers = df[df['customer_id'].notna() & (df['customer_id'] != '')]
+    df_cleaned = df_customers[df_customers['email'].notna() & (df_customers['email'] != '')]
+    return [df_cleaned[~df_cleaned['email'].isin(metric_params().excluded_emails)], df]
+
+
+def legacy_prepare_bookings(df, df_original):
+    """ The BookingFrame as built before the compact representation: two separately typed copies """
+    def typed(frame):
+        return pd.DataFrame({
+            'email': frame['email'].astype('category'),
+            'visit_date': frame['visit_date'].dt.tz_localize(None),
+            'purchase_value': frame['purchase_value'].astype('float64'),
+            'customer_id': frame['customer_id'],
+        }, index=frame.index).reset_index(drop=True)
+    return BookingFrame(customers=with_first_visits(typed(df)), original=typed(df_original))
+
+
+def _compact_bookings(results):
+    frame = booking_frame(results)
+    return bookings_from_frame(frame, customer_mask(frame))
+
+
+MEMORY_BUILDS = {
+    'before': lambda results: legacy_prepare_bookings(*legacy_get_dataframe(results)),
+    'after': _compact_bookings,
+}
+
+
+def _peak_rss_since_reset():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return peak_rss_bytes()
+
+
+def _release_free_memory():
+    # Hands memory glibc's malloc keeps cached back to the OS, so RSS reflects live objects
+    try:
+        ctypes.CDLL('libc.so.6').malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+def _measure_build(spec, name):
+    """ Peak RSS bytes added while building one MEMORY_BUILDS entry; runs in a fresh process """
+    # A small warm-up build first, so lazily loaded modules are not counted
+    MEMORY_BUILDS[name](synthetic_records(replace(spec, bookings=1000, customers=250)))
+    results = synthetic_records(spec)
+    gc.collect()
+    _release_free_memory()
+    try:
+        # Resets the peak RSS (VmHWM) to the current RSS (Linux)
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+    start = rss_bytes()
+    bookings = MEMORY_BUILDS[name](results)
+    peak = _peak_rss_since_reset() - start
+    del bookings
+    return peak
+
+
+def _column_values(series):
+    # The numpy data behind a column, or None for Arrow-backed strings
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        return series.array.codes
+    if series.dtype.kind in 'iufM':
+        return series.to_numpy()
+    return None
+
+
+def live_bytes(bookings):
+    """ Memory held by a BookingFrame, counting columns the customers share with the original once """
+    total = bookings.original.memory_usage(deep=True, index=False).sum()
+    for column in bookings.customers.columns:
+        values = _column_values(bookings.customers[column])
+        if column in bookings.original and values is not None:
+            original_values = _column_values(bookings.original[column])
+            if original_values is not None and np.shares_memory(values, original_values):
+                continue
+        total += bookings.customers[column].memory_usage(deep=True, index=False)
+    return int(total)
+
+
+def memory_report(spec):
+    """ Memory of the booking frames before and after the compact representation, for one data set """
+    results = synthetic_records(spec)
+    report = {'bookings': spec.bookings}
+    for name, build in MEMORY_BUILDS.items():
+        # Process RSS counts Arrow string buffers too (tracemalloc does not); each build
+        # runs in a fresh process so neither reuses memory the other freed
+        with multiprocessing.get_context('spawn').Pool(1) as pool:
+            peak = pool.apply(_measure_build, (spec, name))
+        bookings = build(results)
+        report[name] = {
+            'live_mb': round(live_bytes(bookings) / 2 ** 20, 2),
+            'peak_rss_mb': round(peak / 2 ** 20, 2),
+            # Per column; a column the customers share with the original is counted in both
+            'columns': {
+                f"{frame}.{column}": round(getattr(bookings, frame)[column].memory_usage(deep=True, index=False) / 2 ** 20, 2)
+                for frame in ('customers', 'original') for column in getattr(bookings, frame).columns
+            },
+        }
+        del bookings
+    return report
+
+
+def reference_cohort_activity(df):
+    """ Cohort table of a customers frame by plain grouping, used as the correctness oracle for cohort_activity() """
+    df = df[df['visit_date'].notna()]
+    month = df['visit_date'].dt.to_period('M')
+    cohort = df['first_visit_date'].dt.to_period('M')
+    grouped = df.groupby([cohort.astype(str).rename('cohort'),
+                          (month - cohort).map(lambda offset: offset.n).rename('months_since_first')], observed=True)
+    return grouped.agg(customers=('email', 'nunique'), revenue=('purchase_value', 'sum')).reset_index()[COHORT_COLUMNS]
+
+
+def _assert_frames_match(name, actual, expected):
+    actual = actual.reset_index(drop=True)
+    expected = expected.reset_index(drop=True)
+    for column in ('month', 'week', 'period'):
+        # Period keys are compared by their labels
+        if column in actual:
+            actual[column] = actual[column].astype(str)
+        if column in expected:
+            expected[column] = expected[column].astype(str)
+    try:
+        pd.testing.assert_frame_equal(actual, expected, check_dtype=False, check_column_type=False,
+                                      check_exact=False, rtol=1e-9, atol=1e-6)
+    except AssertionError as exc:
+        raise AssertionError(f"{name} differs from the reference implementation: {exc}") from None
+
+
+def _assert_ltv_match(name, actual, expected):
+    for key, value in expected.items():
+        if key == 'monthly_breakdown':
+            continue
+        if abs(actual[key] - value) > 1e-9 * max(1, abs(value)):
+            raise AssertionError(f"{name} {key} is {actual[key]}, the reference gives {value}")
+
+
+def check_outputs(results):
+    """ Pins every metric path (breakdowns, period engine, cohorts, metric state) to the reference implementations """
+    df, df_original = get_dataframe(results)
+    expected_monthly = reference_monthly_breakdown(df, df_original)
+    expected_weekly = reference_weekly_breakdown(df, df_original)
+
+    bookings = prepare_bookings(df, df_original)
+    monthly = monthly_breakdown(bookings)
+    _assert_frames_match('monthly_breakdown', monthly['monthly_breakdown'], expected_monthly['monthly_breakdown'])
+    _assert_ltv_match('monthly_breakdown', monthly, expected_monthly)
+    _assert_frames_match('weekly_breakdown', weekly_breakdown(bookings), expected_weekly)
+
+    engine = period_breakdown(daily_aggregates(bookings), 'month')
+    engine = engine.drop(columns='period_start').rename(columns={'period': 'month'})
+    _assert_frames_match('period_breakdown', engine, expected_monthly['monthly_breakdown'])
+
+    _assert_frames_match('cohort_activity', cohort_activity(bookings), reference_cohort_activity(bookings.customers))
+
+    state = state_data(build_state(bookings))
+    _assert_frames_match('metric state monthly', state['monthly_breakdown'], expected_monthly['monthly_breakdown'])
+    _assert_frames_match('metric state weekly', state['weekly_breakdown'], expected_weekly)
+    _assert_ltv_match('metric state', state, expected_monthly)
+
+    # Chunks far smaller than the data, so customers and weeks straddle chunk boundaries
+    check_streaming(results, chunk_rows=max(1, len(results['records']) // 7))
+    check_rollup(results)
+
+
+def _date_ordered(records):
+    # The order a streaming load reads bookings in
+    return sorted(records, key=lambda record: (record['Bnow__All_Products_Processed__c'], record['Id']))
+
+
+def _streamed(records, chunk_rows=STREAM_CHUNK_ROWS):
+    # Date ordered records folded chunk by chunk like a streaming load
+    chunks = (booking_frame({'records': records[i:i + chunk_rows]}) for i in range(0, len(records), chunk_rows))
+    return stream_metrics(chunks)
+
+
+def check_streaming(results, chunk_rows):
+    """ Pins the streaming load to the full load over the same bookings in visit date order """
+    records = _date_ordered(results['records'])
+    streamed = _streamed(records, chunk_rows)
+    bookings = _compact_bookings({'records': records})
+    monthly = monthly_breakdown(bookings)
+    _assert_frames_match('streamed monthly', streamed['monthly_breakdown'], monthly['monthly_breakdown'])
+    _assert_ltv_match('streamed', streamed, monthly)
+    _assert_frames_match('streamed weekly', streamed['weekly_breakdown'], weekly_breakdown(bookings))
+    _assert_frames_match('streamed cohort_activity', streamed['cohort_activity'], cohort_activity(bookings))
+
+
+def check_rollup(results, sites=3):
+    """ Pins the all-sites rollup to the pipeline over the bookings of every site in one set """
+    # Bookings are dealt out to the sites in turn, so most customers visit several of them
+    site_records = [results['records'][i::sites] for i in range(sites)]
+    site_data = {f"site {i}": {'daily_aggregates': daily_aggregates(_compact_bookings({'records': records}))}
+                 for i, records in enumerate(site_records)}
+    rolled_up = rollup(site_data)
+
+    bookings = _compact_bookings({'records': [record for records in site_records for record in records]})
+    monthly = monthly_breakdown(bookings)
+    _assert_frames_match('rollup monthly', rolled_up['monthly_breakdown'], monthly['monthly_breakdown'])
+    _assert_ltv_match('rollup', rolled_up, monthly)
+    _assert_frames_match('rollup cohort_activity', rolled_up['cohort_activity'], cohort_activity(bookings))
+    weeks = period_breakdown(daily_aggregates(bookings), 'week', new_revenue='all')
+    _assert_frames_match('rollup weekly', rolled_up['weekly_breakdown'].drop(columns='week'),
+                         weeks.drop(columns=['period', 'period_start']))
+
+
+def measure(stage, memory=True):
+    """ Runs stage() and returns (its result, {'seconds', 'peak_mb'}) """
+    gc.collect()
+    started = time.perf_counter()
+    result = stage()
+    seconds = time.perf_counter() - started
+    timing = {'seconds': round(seconds, 4)}
+
+    if memory:
+        # A second run under tracemalloc, so tracing does not slow down the timed run
+        del result
+        gc.collect()
+        tracemalloc.start()
+        try:
+            result = stage()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        timing['peak_mb'] = round(peak / 2 ** 20, 2)
+    return result, timing
+
+
+_app = None
+
+
+def _app_module(snapshot):
+    """ Imports app.py against a throwaway snapshot store, so importing it never starts a Salesforce load """
+    global _app
+    if _app is None:
+        cache_dir = tempfile.mkdtemp(prefix='benchmark-snapshots-')
+        os.environ['SNAPSHOT_CACHE_DIR'] = cache_dir
+        os.environ['REFRESH_INTERVAL_MINUTES'] = '0'
+        os.environ['STARTUP_MODE'] = 'lazy'
+        from snapshot_store import SnapshotStore
+        SnapshotStore(cache_dir).save(snapshot)
+        import app
+        _app = app
+    return _app
+
+
+def run_size(spec, memory=True):
+    """ Times every pipeline stage for one synthetic data set """
+    stages = {}
+    records, stages['generate'] = measure(lambda: synthetic_records(spec), memory=False)
+    ordered = _date_ordered(records['records'])
+    _, stages['stream_metrics'] = measure(lambda: _streamed(ordered), memory)
+    del ordered
+
+    frames, stages['get_dataframe'] = measure(lambda: get_dataframe(records), memory)
+    del records
+    bookings, stages['prepare_bookings'] = measure(lambda: prepare_bookings(*frames), memory)
+    del frames
+
+    monthly, stages['monthly_breakdown'] = measure(lambda: monthly_breakdown(bookings), memory)
+    weekly, stages['weekly_breakdown'] = measure(lambda: weekly_breakdown(bookings), memory)
+    daily, stages['daily_aggregates'] = measure(lambda: daily_aggregates(bookings), memory)
+    _, stages['period_breakdown'] = measure(lambda: period_breakdown(daily, 'week'), memory)
+    _, stages['build_state'] = measure(lambda: build_state(bookings), memory)
+    cohorts, stages['cohort_activity'] = measure(lambda: cohort_activity(bookings), memory)
+
+    data = {**monthly, 'weekly_breakdown': weekly, 'daily_aggregates': daily, 'cohort_activity': cohorts}
+    snapshot, stages['build_snapshot'] = measure(lambda: build_snapshot(data, 1), memory)
+
+    app = _app_module(snapshot)
+    for page, build in app.PAGE_BUILDERS.items():
+        _, stages[f"layout {page}"] = measure(lambda: build(snapshot), memory)
+    # The monthly and weekly pages are static; their per-snapshot cost is the chart series
+    _, stages['chart_data'] = measure(lambda: series_update(chart_series(snapshot), None), memory)
+
+    return {
+        'bookings': spec.bookings,
+        'customers': spec.customers,
+        'customer_rows': len(bookings.customers),
+        'frame_mb': round((bookings.customers.memory_usage(deep=True).sum()
+                           + bookings.original.memory_usage(deep=True).sum()) / 2 ** 20, 2),
+        'stages': stages,
+    }
+
+
+def compare(current, baseline, tolerance):
+    """ Stages that got slower than `tolerance` times the baseline, as printable lines """
+    regressions = []
+    baseline_runs = {run['bookings']: run for run in baseline['runs']}
+    for run in current['runs']:
+        previous = baseline_runs.get(run['bookings'])
+        if previous is None:
+            continue
+        for stage, timing in run['stages'].items():
+            before = previous['stages'].get(stage)
+            if before is None or before['seconds'] < 0.01:
+                continue
+            ratio = timing['seconds'] / before['seconds']
+            print(f"{run['bookings']:>10} {stage:<24} {before['seconds']:>9.3f}s -> {timing['seconds']:>9.3f}s ({ratio:.2f}x)")
+            if ratio > tolerance:
+                regressions.append(f"{stage} at {run['bookings']} bookings: {ratio:.2f}x slower")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks the analytics pipeline on synthetic bookings")
+    parser.add_argument('--sizes', default=','.join(str(size) for size in DEFAULT_SIZES),
+                        help="comma separated booking counts")
+    parser.add_argument('--customers-per-booking', type=float, default=0.25)
+    parser.add_argument('--repeat-skew', type=float, default=1.0)
+    parser.add_argument('--null-email-rate', type=float, default=0.05)
+    parser.add_argument('--null-customer-id-rate', type=float, default=0.03)
+    parser.add_argument('--span-days', type=int, default=730)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-memory', action='store_true', help="skip the tracemalloc runs")
+    parser.add_argument('--check-max', type=int, default=CHECK_MAX_BOOKINGS,
+                        help="check outputs against the reference implementations up to this size")
+    parser.add_argument('--memory-report', action='store_true',
+                        help="also compare the memory of the old and the compact booking frames")
+    parser.add_argument('--output', help="results file (default: a timestamped file in BENCHMARK_DIR)")
+    parser.add_argument('--compare', help="earlier results file to compare against")
+    parser.add_argument('--tolerance', type=float, default=1.25,
+                        help="slowdown factor that counts as a regression")
+    args = parser.parse_args(argv)
+
+    runs = []
+    checks = {}
+    for size in (int(size) for size in args.sizes.split(',')):
+        spec = SyntheticSpec(
+            bookings=size,
+            customers=max(1, int(size * args.customers_per_booking)),
+            repeat_skew=args.repeat_skew,
+            null_email_rate=args.null_email_rate,
+            null_customer_id_rate=args.null_customer_id_rate,
+            span_days=args.span_days,
+            seed=args.seed,
+        )
+        if size <= args.check_max:
+            check_outputs(synthetic_records(spec))
+            checks[size] = 'ok'
+        run = run_size(spec, memory=not args.no_memory)
+        run['spec'] = asdict(spec)
+        if args.memory_report:
+            run['memory_report'] = memory_report(spec)
+            before, after = run['memory_report']['before'], run['memory_report']['after']
+            print(f"{size:>10} booking frames {before['live_mb']:.1f} MB -> {after['live_mb']:.1f} MB, "
+                  f"peak RSS while building {before['peak_rss_mb']:.1f} MB -> {after['peak_rss_mb']:.1f} MB")
+        runs.append(run)
+        for stage, timing in run['stages'].items():
+            peak = f"{timing['peak_mb']:>10.1f} MB" if 'peak_mb' in timing else ''
+            print(f"{size:>10} {stage:<24} {timing['seconds']:>9.3f}s {peak}")
+
+    results = {
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'checks': checks,
+        'runs': runs,
+    }
+    output = args.output
+    if output is None:
+        os.makedirs(BENCHMARK_DIR, exist_ok=True)
+        output = os.path.join(BENCHMARK_DIR, f"benchmark-{datetime.now():%Y%m%d-%H%M%S}.json")
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print("Regressions:\n  " + "\n  ".join(regressions))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,104 @@
+import os
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+# Local columnar copy of the Bnow__Booking__c rows we have already pulled.
+# Rows are kept with their raw Salesforce field names so get_dataframe() can
+# read them exactly as it reads a live query_all() response.
+STORE_PATH = os.getenv('BOOKING_STORE_PATH', os.path.join('data', 'bookings.parquet'))
+
+ID_FIELD = 'Id'
+MODSTAMP_FIELD = 'SystemModstamp'
+VISIT_FIELD = 'Bnow__All_Products_Processed__c'
+HIGH_WATER_MARK_KEY = b'high_water_mark'
+
+# Rows per Parquet row group; a streamed read holds about one row group at a time
+ROW_GROUP_ROWS = 100_000
+
+
+def records_to_frame(records, columns):
+    """ Turns a list of Salesforce record dicts into a frame with the given columns """
+    df = pd.DataFrame(records)
+    if df.empty:
+        return pd.DataFrame(columns=columns)
+    return df.reindex(columns=columns)
+
+
+def load_store(path=STORE_PATH):
+    """ Returns (bookings, high_water_mark); (None, None) if nothing is stored yet """
+    if not os.path.exists(path):
+        return None, None
+
+    table = pq.read_table(path)
+    metadata = table.schema.metadata or {}
+    high_water_mark = metadata.get(HIGH_WATER_MARK_KEY)
+    if high_water_mark is not None:
+        high_water_mark = high_water_mark.decode()
+
+    return table.to_pandas(), high_water_mark
+
+
+def save_store(df, high_water_mark, path=STORE_PATH):
+    """ Writes the store atomically so a crashed sync never leaves a half-written file; returns the rows as written """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    if VISIT_FIELD in df.columns:
+        # Rows are kept in visit date order so the store can be streamed chunk by chunk (see streaming.py);
+        # Salesforce ISO timestamps sort lexicographically
+        df = df.sort_values([VISIT_FIELD, ID_FIELD] if ID_FIELD in df.columns else VISIT_FIELD, kind='stable')
+        df = df.reset_index(drop=True)
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    metadata = dict(table.schema.metadata or {})
+    if high_water_mark is not None:
+        metadata[HIGH_WATER_MARK_KEY] = high_water_mark.encode()
+    table = table.replace_schema_metadata(metadata)
+
+    tmp_path = f"{path}.tmp"
+    pq.write_table(table, tmp_path, row_group_size=ROW_GROUP_ROWS)
+    os.replace(tmp_path, path)
+    return df
+
+
+def iter_store_batches(columns, batch_rows, path=STORE_PATH):
+    """ The stored rows as frames of at most batch_rows rows, without reading the whole file """
+    if not os.path.exists(path):
+        return
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=batch_rows, columns=columns):
+        yield batch.to_pandas()
+
+
+def merge_bookings(store_df, delta_df, deleted_field=None):
+    """ Applies a delta pull on top of the stored rows, keyed on the booking Id """
+    if store_df is None or store_df.empty:
+        merged = delta_df
+    elif delta_df.empty:
+        merged = store_df
+    else:
+        # Later rows win, so updated bookings (status changes, new balances) replace the stored version
+        merged = pd.concat([store_df, delta_df], ignore_index=True)
+        merged = merged.drop_duplicates(subset=ID_FIELD, keep='last')
+
+    if deleted_field is not None and deleted_field in merged.columns:
+        merged = merged[merged[deleted_field] != True]  # noqa: E712 - column may hold None
+        merged = merged.drop(columns=[deleted_field])
+
+    return merged.reset_index(drop=True)
+
+
+def high_water_mark_of(df, previous=None):
+    """ Latest SystemModstamp seen so far; Salesforce ISO timestamps sort lexicographically """
+    if df is None or df.empty or MODSTAMP_FIELD not in df.columns:
+        return previous
+    stamps = df[MODSTAMP_FIELD].dropna()
+    if stamps.empty:
+        return previous
+    latest = stamps.max()
+    if previous is None or latest > previous:
+        return latest
+    return previous
@@ -0,0 +1,69 @@
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+
+# Shared preprocessing stage: bookings are parsed and typed once per load and
+# then handed to every breakdown. The frames are treated as read-only; the
+# breakdowns derive their own period keys instead of adding columns to them.
+#
+# Only one copy of the bookings is kept. Customer bookings are moved to the
+# front of `original` (keeping their order), so `customers` is a slice of it
+# that shares its memory rather than a second copy.
+
+@dataclass(frozen=True)
+class BookingFrame:
+    # Bookings with a valid customer ID and email (minus the excluded emails),
+    # plus each customer's first visit date; the leading rows of `original`
+    customers: pd.DataFrame
+    # Every fetched booking, used for total revenue
+    original: pd.DataFrame
+
+    def customer_codes(self):
+        """ int32 customer number of every customer booking (its email category code) """
+        return self.customers['email'].cat.codes.to_numpy().astype('int32', copy=False)
+
+
+def _typed(df):
+    visit_date = pd.to_datetime(df['visit_date'], errors='coerce')
+    if visit_date.dt.tz is not None:
+        # Remove timezone info
+        visit_date = visit_date.dt.tz_localize(None)
+
+    # Purchase values stay float64: revenue sums must not lose cents
+    return pd.DataFrame({
+        'email': df['email'].astype('category'),
+        'visit_date': visit_date,
+        'purchase_value': df['purchase_value'].astype('float64'),
+        'customer_id': df['customer_id'].astype('category'),
+    }, index=df.index)
+
+
+def with_first_visits(customers):
+    """ Adds (or recomputes) each customer's first visit date """
+    first_visit_date = customers.groupby('email', observed=True)['visit_date'].transform('min')
+    return customers.assign(first_visit_date=first_visit_date)
+
+
+def bookings_from_frame(df_original, customer_mask, first_visits=True):
+    """ Builds the typed BookingFrame from all bookings and a boolean mask of the customer bookings
+
+    With first_visits=False the customers get no first_visit_date column;
+    incremental syncs take first visits from their metric state instead.
+    """
+    customer_mask = np.asarray(customer_mask, dtype=bool)
+    # Stable partition: customer bookings first, in their original order
+    order = np.concatenate([np.flatnonzero(customer_mask), np.flatnonzero(~customer_mask)])
+    original = _typed(df_original.take(order)).reset_index(drop=True)
+    customers = original.iloc[:int(customer_mask.sum())]
+    if first_visits:
+        customers = with_first_visits(customers)
+    return BookingFrame(customers=customers, original=original)
+
+
+def prepare_bookings(df, df_original):
+    """ Builds the typed BookingFrame from the two frames returned by get_dataframe() """
+    # df holds rows of df_original (same index labels), so it only contributes the mask
+    return bookings_from_frame(df_original, df_original.index.isin(df.index))
+
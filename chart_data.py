@@ -0,0 +1,93 @@
+import hashlib
+import json
+
+from dash import Patch
+
+
+# Series behind the monthly and weekly charts, pushed to the browser once per
+# snapshot (and site) into a dcc.Store the charts render from client-side.
+# Every series is digested in blocks of rows; the browser keeps the digests of
+# what it holds, so a refresh sends a Patch with only the rows from the first
+# changed block onwards instead of the whole store. A refresh mostly touches
+# the latest periods, so that is usually the last block or two.
+
+# Store key -> Snapshot frame
+CHART_FRAMES = {
+    'monthly': 'monthly_df',
+    'weekly': 'weekly_df',
+}
+
+BLOCK_ROWS = 8
+
+
+def _values(column):
+    # JSON-ready list; NaN becomes null
+    return column.astype(object).where(column.notna(), None).tolist()
+
+
+def chart_series(snapshot):
+    """ {store key: {column: values}} of every charted frame of `snapshot` """
+    return {key: {column: _values(frame[column]) for column in frame.columns}
+            for key, frame in ((key, getattr(snapshot, name)) for key, name in CHART_FRAMES.items())}
+
+
+def _digest(values):
+    return hashlib.blake2b(json.dumps(values, default=str).encode(), digest_size=8).hexdigest()
+
+
+def series_digests(series):
+    """ {store key: {column: [rows, block digests]}} of chart_series() output """
+    return {key: {column: [len(values), [_digest(values[start:start + BLOCK_ROWS])
+                                         for start in range(0, len(values), BLOCK_ROWS)]]
+                  for column, values in columns.items()}
+            for key, columns in series.items()}
+
+
+def _first_changed_row(old, new):
+    # Rows before the first block whose digest differs are already in the browser
+    (_, old_blocks), (_, new_blocks) = old, new
+    for block, (before, after) in enumerate(zip(old_blocks, new_blocks)):
+        if before != after:
+            return block * BLOCK_ROWS
+    return min(len(old_blocks), len(new_blocks)) * BLOCK_ROWS
+
+
+def series_update(series, previous_digests):
+    """ (store update, digests) taking the browser from `previous_digests` to `series`
+
+    The update is the whole series when the browser holds nothing yet, None
+    when it already holds exactly `series`, and otherwise a Patch that assigns
+    the changed rows and appends the new ones.
+    """
+    digests = series_digests(series)
+    if not previous_digests:
+        return series, digests
+
+    patch = Patch()
+    changed = False
+    for key, columns in series.items():
+        if key not in previous_digests:
+            patch[key] = columns
+            changed = True
+            continue
+        for column, values in columns.items():
+            old = previous_digests[key].get(column)
+            if old is None:
+                patch[key][column] = values
+                changed = True
+                continue
+            old_rows = old[0]
+            start = min(_first_changed_row(old, digests[key][column]), old_rows)
+            if start == old_rows == len(values):
+                continue
+            changed = True
+            if len(values) < old_rows or 2 * (old_rows - start) > len(values):
+                # Lists cannot be truncated in a Patch, and one assignment per row costs
+                # more than the values themselves; such series are sent whole
+                patch[key][column] = values
+                continue
+            for row in range(start, old_rows):
+                patch[key][column][row] = values[row]
+            if len(values) > old_rows:
+                patch[key][column].extend(values[old_rows:])
+    return (patch if changed else None), digests
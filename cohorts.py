@@ -0,0 +1,98 @@
+import numpy as np
+import pandas as pd
+
+
+# Monthly cohort retention. Customers are grouped by the month of their first
+# visit; for every cohort and every month since then we count the customers
+# that came back and the revenue they brought. The sparse customer x month
+# activity index is built once per load with integer keys and np.bincount,
+# so the cost is a sort over the bookings rather than a scan per cohort.
+
+COHORT_COLUMNS = ['cohort', 'months_since_first', 'customers', 'revenue']
+
+# Months after the first visit shown on the cohorts page
+MAX_COHORT_MONTHS = 12
+
+
+def _month_numbers(dates):
+    # Months since 1970-01 as int64; NaT becomes a very negative number
+    return dates.to_numpy().astype('datetime64[M]').astype('int64')
+
+
+def cohort_activity(bookings):
+    """ Long-form cohort table: customers and revenue per (first-visit month, months since it) """
+    df = bookings.customers
+    valid = df['visit_date'].notna().to_numpy()
+    return _activity(
+        bookings.customer_codes()[valid].astype('int64'),
+        _month_numbers(df['visit_date'])[valid],
+        _month_numbers(df['first_visit_date'])[valid],
+        np.nan_to_num(df['purchase_value'].to_numpy()[valid]),
+    )
+
+
+def daily_cohort_activity(daily):
+    """ cohort_activity() from daily aggregates (e.g. merged over sites) instead of the bookings """
+    days = daily.customer_days
+    return _activity(
+        days['email'].cat.codes.to_numpy().astype('int64'),
+        _month_numbers(days['day']),
+        _month_numbers(days['first_visit_day']),
+        days['revenue'].to_numpy(),
+    )
+
+
+def _activity(codes, month, first_month, revenue):
+    # codes, month and first month of every booking (or customer day) with its revenue
+    if len(codes) == 0:
+        return pd.DataFrame(columns=COHORT_COLUMNS)
+
+    base = first_month.min()
+    cohort = first_month - base
+    offset = month - first_month
+    n_offsets = int(offset.max()) + 1
+    n_cells = (int(cohort.max()) + 1) * n_offsets
+
+    # Cell of the (cohort, months since first visit) matrix each booking falls in
+    cell = cohort * n_offsets + offset
+
+    # Sparse activity index: one entry per (customer, month active); a customer
+    # counts once per cell however many bookings they made that month
+    active = np.sort(codes * n_cells + cell)
+    active = active[np.r_[True, active[1:] != active[:-1]]]
+    customers = np.bincount(active % n_cells, minlength=n_cells)
+    cell_revenue = np.bincount(cell, weights=revenue, minlength=n_cells)
+
+    cells = np.flatnonzero(customers)
+    return pd.DataFrame({
+        'cohort': pd.PeriodIndex.from_ordinals(cells // n_offsets + base, freq='M').astype(str),
+        'months_since_first': (cells % n_offsets).astype('int32'),
+        'customers': customers[cells],
+        'revenue': cell_revenue[cells],
+    }, columns=COHORT_COLUMNS)
+
+
+def cohort_matrices(activity, max_months=None):
+    """ (cohort sizes, customer retention %, revenue retention %) with cohorts as rows and months since first visit as columns
+
+    Retention of month k is relative to month 0: the share of the cohort's
+    customers active in month k, and month k revenue over month 0 revenue.
+    """
+    # Months after the last month with data stay empty; earlier months without a returning customer are 0
+    ordinals = pd.PeriodIndex(activity['cohort'], freq='M').asi8
+    last_month = (ordinals + activity['months_since_first'].to_numpy()).max()
+    if max_months is not None:
+        activity = activity[activity['months_since_first'] <= max_months]
+
+    months = range(int(activity['months_since_first'].max()) + 1)
+    customers = activity.pivot(index='cohort', columns='months_since_first', values='customers').reindex(columns=months)
+    revenue = activity.pivot(index='cohort', columns='months_since_first', values='revenue').reindex(columns=months)
+    months_observed = last_month - pd.PeriodIndex(customers.index, freq='M').asi8
+    observed = months_observed[:, None] >= np.arange(len(months))[None, :]
+    customers = customers.fillna(0).where(observed)
+    revenue = revenue.fillna(0).where(observed)
+
+    sizes = customers[0].astype('int64')
+    retention = customers.div(sizes, axis=0).mul(100).round(2)
+    revenue_retention = revenue.div(revenue[0].where(revenue[0] != 0), axis=0).mul(100).round(2)
+    return sizes, retention, revenue_retention
@@ -1,91 +1,78 @@
+import numpy as np
 import pandas as pd
 
-def monthly_breakdown(df, df_original):
-    # Ensure visit_date is datetime
-    df['visit_date'] = pd.to_datetime(df['visit_date'], errors='coerce')
-    df_original['visit_date'] = pd.to_datetime(df_original['visit_date'], errors='coerce')
+from bookings import BookingFrame, prepare_bookings
+from metric_params import metric_params
+from period_engine import daily_aggregates, period_breakdown, BREAKDOWN_COLUMNS
 
-    # Remove timezone info
-    df['visit_date'] = df['visit_date'].dt.tz_localize(None)
-    df_original['visit_date'] = df_original['visit_date'].dt.tz_localize(None)
 
-    # Convert to month period
-    df['month'] = df['visit_date'].dt.to_period('M')
-    df_original['month'] = df_original['visit_date'].dt.to_period('M')
+MONTHLY_COLUMNS = ['month'] + BREAKDOWN_COLUMNS
 
-    # Compute first visit date per customer
-    first_visits = df.groupby('email')['visit_date'].min().reset_index()
-    first_visits.columns = ['email', 'first_visit_date']
-    first_visits['first_visit_month'] = first_visits['first_visit_date'].dt.to_period('M')
 
-    # Merge first visit info back
-    df = df.merge(first_visits, on='email', how='left')
+def monthly_rows(daily):
+    """ Monthly breakdown rows (indexed by month) of daily aggregates """
+    monthly = period_breakdown(daily, 'month').drop(columns='period_start').rename(columns={'period': 'month'})
+    monthly.index = pd.PeriodIndex(monthly['month'], freq='M', name='month')
+    return monthly
 
-    # Prepare results container
-    monthly_results = []
 
-    # Iterate over each month
-    for month in sorted(df['month'].unique()):
-        month_data = df[df['month'] == month]
-        month_data_original = df_original[df_original['month'] == month]
-
-        total_customers = month_data['email'].nunique()
+def ltv_metrics(total_revenue_all, unique_customers, total_bookings, avg_days_between_visits, churn_threshold):
+    basic_ltv = total_revenue_all / unique_customers if unique_customers > 0 else 0
+    avg_purchase_value = total_revenue_all / total_bookings if total_bookings > 0 else 0
+    avg_purchase_frequency = total_bookings / unique_customers if unique_customers > 0 else 0
 
-        # New customers: first visit in this month
-        new_customers_df = month_data[month_data['first_visit_month'] == month]
-        new_customers = new_customers_df['email'].nunique()
+    avg_customer_lifespan_months = churn_threshold / avg_days_between_visits if avg_days_between_visits > 0 else 1
 
-        returning_customers = total_customers - new_customers
+    advanced_ltv = avg_purchase_value * avg_purchase_frequency * avg_customer_lifespan_months
 
-        new_percentage = round((new_customers / total_customers * 100), 2) if total_customers > 0 else 0
-        returning_percentage = round((returning_customers / total_customers * 100), 2) if total_customers > 0 else 0
+    return {
+        'Basic LTV': basic_ltv,
+        'Advanced LTV': advanced_ltv,
+        'Average Purchase Value': avg_purchase_value,
+        'Average Purchase Frequency': avg_purchase_frequency,
+        'Average Customer LifeSpan(Months)': avg_customer_lifespan_months
+    }
 
-        # Revenue calculations
-        month_revenue = month_data['purchase_value'].sum()
-        total_revenue = month_data_original['purchase_value'].sum()
 
-        # Revenue from new vs returning customers
-        new_revenue = new_customers_df.groupby('email').first()['purchase_value'].sum()
-        returning_revenue = month_revenue - new_revenue
+def daily_ltv(daily, params=None):
+    """ The LTV block of monthly_breakdown() from daily aggregates (e.g. merged over sites) """
+    params = params or metric_params()
+    days = daily.customer_days.sort_values(['email', 'day'])
+    email = days['email'].cat.codes.to_numpy()
+    same_customer = email[1:] == email[:-1]
+    # Visits on the same day are less than a day apart (0 days); across days the gap
+    # runs from the last visit of one day to the first visit of the next
+    gaps_across_days = (days['first_visit_at'].to_numpy()[1:] - days['last_visit_at'].to_numpy()[:-1])[same_customer]
+    gap_days = (gaps_across_days // np.timedelta64(1, 'D')).sum()
+    gap_count = same_customer.sum() + (days['visits'].to_numpy() - 1).sum()
+    avg_days_between_visits = gap_days / gap_count if gap_count > 0 else 1
 
-        monthly_results.append({
-            'month': month,
-            'total_customers': total_customers,
-            'new_customers': new_customers,
-            'returning_customers': returning_customers,
-            'new_percentage': new_percentage,
-            'returning_percentage': returning_percentage,
-            'total_revenue': total_revenue,
-            'new_customer_revenue': new_revenue,
-            'returning_customer_revenue': returning_revenue
-        })
+    return ltv_metrics(days['revenue'].sum(), days['email'].nunique(), int(days['visits'].sum()),
+                       avg_days_between_visits, params.churn_threshold_days)
 
-    monthly_df = pd.DataFrame(monthly_results)
 
-    # LTV calculations
-    total_revenue_all = df['purchase_value'].sum()
-    unique_customers = df['email'].nunique()
+def monthly_breakdown(bookings, df_original=None, daily=None, params=None):
+    params = params or metric_params()
+    # Accept the raw (df, df_original) pair from get_dataframe() as well as a prepared BookingFrame
+    if not isinstance(bookings, BookingFrame):
+        bookings = prepare_bookings(bookings, df_original)
+    df = bookings.customers
 
-    basic_ltv = total_revenue_all / unique_customers if unique_customers > 0 else 0
-    avg_purchase_value = total_revenue_all / len(df) if len(df) > 0 else 0
-    avg_purchase_frequency = len(df) / unique_customers if unique_customers > 0 else 0
+    # The months come from the daily aggregates (pass them in when they are already built)
+    if daily is None:
+        daily = daily_aggregates(bookings)
+    monthly_df = monthly_rows(daily).reset_index(drop=True)
 
     # Customer lifespan calculation
-    df_sorted = df.sort_values(['email', 'visit_date'])
-    df_sorted['next_visit'] = df_sorted.groupby('email')['visit_date'].shift(-1)
-    df_sorted['days_between_visits'] = (df_sorted['next_visit'] - df_sorted['visit_date']).dt.days
-
-    avg_days_between_visits = df_sorted['days_between_visits'].dropna().mean() if not df_sorted['days_between_visits'].dropna().empty else 1
-    churn_threshold = 180  # days
-    avg_customer_lifespan_months = churn_threshold / avg_days_between_visits if avg_days_between_visits > 0 else 1
+    df_sorted = df[['email', 'visit_date']].sort_values(['email', 'visit_date'])
+    next_visit = df_sorted.groupby('email', observed=True)['visit_date'].shift(-1)
+    days_between_visits = (next_visit - df_sorted['visit_date']).dt.days.dropna()
 
-    advanced_ltv = avg_purchase_value * avg_purchase_frequency * avg_customer_lifespan_months
+    avg_days_between_visits = days_between_visits.mean() if not days_between_visits.empty else 1
 
+    # LTV calculations
     return {
         'monthly_breakdown': monthly_df,
-        'Basic LTV': basic_ltv,
-        'Advanced LTV': advanced_ltv,
-        'Average Purchase Value': avg_purchase_value,
-        'Average Purchase Frequency': avg_purchase_frequency,
-        'Average Customer LifeSpan(Months)': avg_customer_lifespan_months
+        **ltv_metrics(df['purchase_value'].sum(), df['email'].nunique(), len(df), avg_days_between_visits,
+                      params.churn_threshold_days),
     }
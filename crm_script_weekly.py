@@ -1,97 +1,102 @@
 import pandas as pd
 
-
-DATE_FORMAT = '%Y-%m-%d'
-def weekly_breakdown(df, df_original):
-
-    
-    df['visit_date'] = pd.to_datetime(df['visit_date'], format=DATE_FORMAT, errors='coerce')
-    df_original['visit_date'] = pd.to_datetime(df_original['visit_date'], format=DATE_FORMAT, errors='coerce')
+from bookings import BookingFrame, prepare_bookings, with_first_visits
+from period_engine import daily_aggregates, period_breakdown, BREAKDOWN_COLUMNS
 
 
-  
-    df['visit_date'] = df['visit_date'].dt.tz_localize(None)
-    df_original['visit_date'] = df_original['visit_date'].dt.tz_localize(None)
+DATE_FORMAT = '%Y-%m-%d'
+CUTOFF_DATE = '2023-08-28'
+WEEKLY_COLUMNS = ['week'] + BREAKDOWN_COLUMNS
 
 
-    # Cutoff date
-    cutoff = pd.to_datetime('2023-08-28')
-    df = df[df['visit_date'] >= cutoff]
-    df_original = df_original[df_original['visit_date'] >= cutoff]
+def week_label(week_start):
+    week_end = week_start + pd.Timedelta(days=6)
+    return f"{week_start.strftime('%b %d, %Y')} - {week_end.strftime('%b %d, %Y')}"
 
 
-    email_min_dates = df.groupby('email')['visit_date'].min().reset_index()
-    email_min_dates.rename(columns={'visit_date': 'first_visit_date'}, inplace=True)
-    df = pd.merge(df, email_min_dates, on='email', how='left')
+def week_ordinals(dates, week_edges):
+    """ Index of the [edge_i, edge_i+1) bucket each date falls in, -1 when outside the bins or missing """
+    ordinals = week_edges.searchsorted(dates, side='right') - 1
+    outside = (ordinals >= len(week_edges) - 1) | dates.isna().to_numpy()
+    ordinals[outside] = -1
+    return ordinals
 
 
-    # --- Step 3: Create weekly bins (shared between both dfs) ---
-    start_date = df['visit_date'].min()
-    end_date = df['visit_date'].max()
+def week_bins(visit_dates):
+    """ (week_starts, week_edges) of the weekly report for these visit dates, or None when there is no week """
+    if visit_dates.isna().all():
+        return None
 
+    start_date = visit_dates.min()
+    end_date = visit_dates.max()
 
     week_starts = pd.date_range(start=start_date, end=end_date, freq='W-MON')
-    week_ends = week_starts + pd.Timedelta(days=6)
-    week_labels = [f"{s.strftime('%b %d, %Y')} - {e.strftime('%b %d, %Y')}" for s, e in zip(week_starts, week_ends)]
-
-
-    bins = [start_date - pd.Timedelta(days=1)] + list(week_starts[1:]) + [end_date + pd.Timedelta(days=1)]
-
+    if len(week_starts) == 0:
+        return None
 
-    # Apply bins to df (for customers)
-    df['week_label'] = pd.cut(df['visit_date'], bins=bins, labels=week_labels, right=False)
-    df['first_visit_week'] = pd.cut(df['first_visit_date'], bins=bins, labels=week_labels, right=False)
+    # Visits are bucketed into integer week ordinals; edge i is the (inclusive)
+    # start of week i, matching the left-closed bins the labels were built for
+    week_edges = pd.DatetimeIndex(
+        [start_date - pd.Timedelta(days=1)] + list(week_starts[1:]) + [end_date + pd.Timedelta(days=1)]
+    )
+    return week_starts, week_edges
 
 
-    # Apply bins to df_original (for revenue)
-    df_original['week_label'] = pd.cut(df_original['visit_date'], bins=bins, labels=week_labels, right=False)
-   
+def week_days(week_edges):
+    """ (day offset, day edges) of week bins: the weeks start at the first visit's time of day, so their days do too
 
-    # --- Step 4: Weekly analysis ---
-    weekly_results = []
-    for week in sorted(df['week_label'].dropna().unique(), key=lambda x: week_labels.index(x)):
-        week_data = df[df['week_label'] == week]
-        week_data_original = df_original[df_original['week_label'] == week]
+    Every edge but the last is a shifted midnight; the last one is rounded up
+    to the next, so bookings at or past week_edges[-1] must be left out before
+    they are aggregated into days (see weekly_daily()).
+    """
+    day_offset = week_edges[0] - week_edges[0].floor('D')
+    return day_offset, (week_edges - day_offset).ceil('D')
 
 
-        # Customers (only with valid emails)
-        total_customers = week_data['email'].nunique()
+def weekly_daily(df, df_original, week_edges):
+    """ Daily aggregates of the weekly report's frames on the days of its week bins """
+    day_offset, _ = week_days(week_edges)
+    bookings = BookingFrame(customers=df, original=df_original[df_original['visit_date'] < week_edges[-1]])
+    return daily_aggregates(bookings, day_offset=day_offset)
 
 
-        new_customer_mask = week_data['week_label'].astype(str) == week_data['first_visit_week'].astype(str)
-        new_customers = week_data.loc[new_customer_mask, 'email'].nunique()
-        returning_customers = total_customers - new_customers
+def weekly_rows(daily, week_starts, week_edges):
+    """ Weekly breakdown rows (indexed by week ordinal) of weekly_daily() aggregates """
+    _, day_edges = week_days(week_edges)
+    weekly = period_breakdown(daily, new_revenue='all', edges=day_edges)
+    weeks = pd.Index(weekly['period'].to_numpy(), name='week_ordinal')
+    # Labels are only formatted for the weeks that are actually reported
+    weekly['week'] = [week_label(week_starts[i]) for i in weeks]
+    weekly.index = weeks
+    return weekly[WEEKLY_COLUMNS]
 
 
-        new_percentage = round((new_customers / total_customers * 100), 2) if total_customers else 0
-        returning_percentage = round((returning_customers / total_customers * 100), 2) if total_customers else 0
-
-
-        # Revenue (from df_original)
-        total_revenue = week_data_original['purchase_value'].sum()
-        total_revenue_ = week_data['purchase_value'].sum()
-
-
-        # For new vs returning revenue:
-        # safer to filter week_data_original using emails from df (since NaN emails can't be tracked as new/returning)
-        new_revenue = week_data.loc[new_customer_mask, 'purchase_value'].sum()
-        returning_revenue = total_revenue_ - new_revenue
-
-
-        weekly_results.append({
-            'week': week,
-            'total_customers': total_customers,
-            'new_customers': new_customers,
-            'returning_customers': returning_customers,
-            'new_percentage': new_percentage,
-            'returning_percentage': returning_percentage,
-            'total_revenue': total_revenue,
-            'new_customer_revenue': new_revenue,
-            'returning_customer_revenue': returning_revenue
-        })
+def weekly_frames(bookings):
+    """ The customers and original frames the weekly report is computed from (bookings from the cutoff on) """
+    df = bookings.customers
+    df_original = bookings.original
 
+    # Cutoff date
+    cutoff = pd.to_datetime(CUTOFF_DATE)
+    df_original = df_original[df_original['visit_date'] >= cutoff]
+    after_cutoff = df['visit_date'] >= cutoff
+    if not after_cutoff.all():
+        # First visits are counted from the cutoff onwards
+        df = with_first_visits(df[after_cutoff])
+    return df, df_original
 
-    return pd.DataFrame(weekly_results)
 
+def weekly_breakdown(bookings, df_original=None):
+    # Accept the raw (df, df_original) pair from get_dataframe() as well as a prepared BookingFrame
+    if not isinstance(bookings, BookingFrame):
+        bookings = prepare_bookings(bookings, df_original)
+    df, df_original = weekly_frames(bookings)
 
+    # --- Step 3: Create weekly bins (shared between both dfs) ---
+    bins = week_bins(df['visit_date'])
+    if bins is None:
+        return pd.DataFrame(columns=WEEKLY_COLUMNS)
+    week_starts, week_edges = bins
 
+    daily = weekly_daily(df, df_original, week_edges)
+    return weekly_rows(daily, week_starts, week_edges).reset_index(drop=True)
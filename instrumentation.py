@@ -0,0 +1,166 @@
+import os
+import resource
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+
+# Lightweight per-stage instrumentation of the refresh pipeline and the page
+# builders: duration, row count and memory of every stage, grouped per
+# refresh run. By default memory is the process RSS (cheap to read); with
+# INSTRUMENT_TRACEMALLOC=1 each stage inside a run also reports its own peak
+# Python/numpy allocation, at the cost of slower refreshes.
+TRACEMALLOC = os.getenv('INSTRUMENT_TRACEMALLOC', '0') == '1'
+
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def rss_bytes():
+    """ Current resident set size of this process """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return peak_rss_bytes()
+
+
+def peak_rss_bytes():
+    """ Highest resident set size this process has reached """
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Instrumentation:
+    """ Collects stage timings; stages recorded on a thread inside run() belong to that run """
+
+    def __init__(self, tracemalloc_stages=TRACEMALLOC):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._tracemalloc = tracemalloc_stages
+        # Per stage name: last record plus cumulative count and seconds
+        self.stages = {}
+        # Per run name: the last finished run, how many ran and how many failed
+        self.runs = {}
+        self.run_counts = {}
+        self.run_failures = {}
+
+    @contextmanager
+    def stage(self, name, rows=None):
+        """ Times the block; set record['rows'] inside it when the row count is only known afterwards """
+        run = getattr(self._local, 'run', None)
+        record = {'stage': name, 'rows': rows}
+        traced = run is not None and tracemalloc.is_tracing()
+        if traced:
+            tracemalloc.reset_peak()
+        started = time.perf_counter()
+        try:
+            yield record
+        except Exception as exc:
+            record['error'] = repr(exc)
+            raise
+        finally:
+            record['seconds'] = time.perf_counter() - started
+            record['rss_bytes'] = rss_bytes()
+            if traced:
+                record['peak_traced_bytes'] = tracemalloc.get_traced_memory()[1]
+            self.add(record)
+
+    def add(self, record):
+        """ Records a finished stage measured elsewhere (e.g. in a worker process) """
+        run = getattr(self._local, 'run', None)
+        with self._lock:
+            previous = self.stages.get(record['stage'], {})
+            self.stages[record['stage']] = {
+                **record,
+                'count': previous.get('count', 0) + 1,
+                'total_seconds': previous.get('total_seconds', 0.0) + record['seconds'],
+            }
+        if run is not None:
+            run['stages'].append(record)
+
+    def timed(self, name, function):
+        """ Wraps function so every call is recorded as stage `name` """
+        def wrapper(*args, **kwargs):
+            with self.stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+
+    @contextmanager
+    def run(self, name):
+        """ Groups the stages recorded on this thread into one run (e.g. one refresh) """
+        run = {'run': name, 'started_at': time.time(), 'stages': [], 'error': None}
+        self._local.run = run
+        traced = self._tracemalloc and not tracemalloc.is_tracing()
+        if traced:
+            tracemalloc.start()
+        started = time.perf_counter()
+        try:
+            yield run
+        except Exception as exc:
+            run['error'] = repr(exc)
+            raise
+        finally:
+            run['seconds'] = time.perf_counter() - started
+            run['peak_rss_bytes'] = peak_rss_bytes()
+            if traced:
+                tracemalloc.stop()
+            self._local.run = None
+            with self._lock:
+                self.runs[name] = run
+                self.run_counts[name] = self.run_counts.get(name, 0) + 1
+                if run['error'] is not None:
+                    self.run_failures[name] = self.run_failures.get(name, 0) + 1
+
+    def last_run(self, name):
+        with self._lock:
+            return self.runs.get(name)
+
+    def prometheus(self, extra_gauges=()):
+        """ Prometheus text exposition of the collected metrics; extra_gauges is (name, help, value) """
+        with self._lock:
+            stages = {name: dict(record) for name, record in self.stages.items()}
+            runs = {name: dict(run) for name, run in self.runs.items()}
+            run_counts = dict(self.run_counts)
+            run_failures = dict(self.run_failures)
+
+        lines = []
+
+        def metric(metric_name, metric_type, help_text, samples):
+            lines.append(f"# HELP {metric_name} {help_text}")
+            lines.append(f"# TYPE {metric_name} {metric_type}")
+            for labels, value in samples:
+                label_text = ','.join(f'{key}="{_escape(val)}"' for key, val in labels.items())
+                lines.append(f"{metric_name}{{{label_text}}} {value}" if label_text else f"{metric_name} {value}")
+
+        metric('crm_stage_last_duration_seconds', 'gauge', "Duration of the last run of each stage",
+               [({'stage': name}, r['seconds']) for name, r in stages.items()])
+        lines.append("# HELP crm_stage_duration_seconds Time spent in each stage")
+        lines.append("# TYPE crm_stage_duration_seconds summary")
+        for name, r in stages.items():
+            lines.append(f'crm_stage_duration_seconds_sum{{stage="{_escape(name)}"}} {r["total_seconds"]}')
+            lines.append(f'crm_stage_duration_seconds_count{{stage="{_escape(name)}"}} {r["count"]}')
+        metric('crm_stage_last_rows', 'gauge', "Rows produced by the last run of each stage",
+               [({'stage': name}, r['rows']) for name, r in stages.items() if r['rows'] is not None])
+        metric('crm_stage_last_rss_bytes', 'gauge', "Process RSS when each stage last finished",
+               [({'stage': name}, r['rss_bytes']) for name, r in stages.items()])
+        metric('crm_stage_last_peak_traced_bytes', 'gauge', "Peak traced allocation of the last run of each stage",
+               [({'stage': name}, r['peak_traced_bytes']) for name, r in stages.items() if 'peak_traced_bytes' in r])
+        metric('crm_run_last_duration_seconds', 'gauge', "Duration of the last run (e.g. refresh)",
+               [({'run': name}, r['seconds']) for name, r in runs.items()])
+        metric('crm_run_last_peak_rss_bytes', 'gauge', "Process peak RSS at the end of the last run",
+               [({'run': name}, r['peak_rss_bytes']) for name, r in runs.items()])
+        metric('crm_runs_total', 'counter', "Finished runs",
+               [({'run': name}, count) for name, count in run_counts.items()])
+        metric('crm_run_failures_total', 'counter', "Runs that raised",
+               [({'run': name}, run_failures.get(name, 0)) for name in run_counts])
+        metric('crm_process_rss_bytes', 'gauge', "Current process RSS", [({}, rss_bytes())])
+        for name, help_text, value in extra_gauges:
+            if value is not None:
+                metric(name, 'gauge', help_text, [({}, value)])
+
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
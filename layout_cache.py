@@ -0,0 +1,44 @@
+import threading
+
+
+class LayoutCache:
+    """ Page layouts (figures and table payloads) built once per snapshot version """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._layouts = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, page, snapshot, build, site=None):
+        """ Cached layout of `page` for this snapshot (or one of its sites), built with build(snapshot) on a miss """
+        with self._lock:
+            if snapshot.version != self._version:
+                # A new snapshot invalidates every page
+                self._version = snapshot.version
+                self._layouts = {}
+            key = page if site is None else f"{page}@{site}"
+            if key in self._layouts:
+                self.hits += 1
+                return self._layouts[key]
+            self.misses += 1
+            # Built under the lock so concurrent requests for a cold page build it only once
+            layout = build(snapshot.view(site))
+            self._layouts[key] = layout
+            return layout
+
+    def warm(self, snapshot, builders):
+        """ Pre-renders every page of a freshly swapped-in snapshot, for each of its sites """
+        for site in snapshot.site_names() or [None]:
+            for page, build in builders.items():
+                self.get(page, snapshot, build, site)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'version': self._version,
+                'pages': sorted(self._layouts),
+                'hits': self.hits,
+                'misses': self.misses,
+            }
@@ -0,0 +1,33 @@
+import os
+from dataclasses import dataclass
+
+
+# Parameters of the customer metrics. They are read from the environment when
+# a load starts rather than at import, and passed down with every call, so the
+# cache keys and saved metric state always describe the values actually used.
+
+# Days without a visit after which a customer counts as churned (the Advanced LTV lifespan)
+DEFAULT_CHURN_THRESHOLD_DAYS = 180
+# Bookings of these emails are left out of the customer metrics
+DEFAULT_EXCLUDED_EMAILS = ('beth.a.w.1998@gmail.com', 'ellison.melanie@yahoo.co.uk', 'hello@jungleworldpark.com',
+                           'madirose1202@outlook.com')
+
+
+@dataclass(frozen=True)
+class MetricParams:
+    churn_threshold_days: int = DEFAULT_CHURN_THRESHOLD_DAYS
+    excluded_emails: tuple = DEFAULT_EXCLUDED_EMAILS
+
+    def as_dict(self):
+        """ JSON-able form, for cache keys and saved state """
+        return {'churn_threshold_days': self.churn_threshold_days, 'excluded_emails': sorted(self.excluded_emails)}
+
+
+def metric_params():
+    """ MetricParams from CHURN_THRESHOLD_DAYS and SF_EXCLUDED_EMAILS (comma separated; replaces the default list) """
+    excluded_emails = os.getenv('SF_EXCLUDED_EMAILS')
+    return MetricParams(
+        churn_threshold_days=int(os.getenv('CHURN_THRESHOLD_DAYS', str(DEFAULT_CHURN_THRESHOLD_DAYS))),
+        excluded_emails=DEFAULT_EXCLUDED_EMAILS if excluded_emails is None else
+        tuple(email.strip() for email in excluded_emails.split(',') if email.strip()),
+    )
@@ -0,0 +1,165 @@
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import aggregates
+from aggregates import update_metrics
+from bookings import bookings_from_frame
+from cohorts import cohort_activity, daily_cohort_activity
+from crm_script_monthly import monthly_breakdown, monthly_rows, daily_ltv
+from crm_script_weekly import weekly_breakdown, week_label, WEEKLY_COLUMNS
+from instrumentation import Instrumentation
+from metric_params import metric_params
+from period_engine import daily_aggregates, merge_daily_aggregates, period_breakdown
+from result_cache import ResultCache, result_key
+from salesforce_data import booking_frame, customer_mask, get_data, iter_booking_chunks, site_slug, SITE_NAME, SYNC_MODE
+from streaming import StreamingAggregates
+
+
+logger = logging.getLogger(__name__)
+
+# The load of one site (fetch, typed bookings, breakdowns and aggregates) and
+# the load of every configured site. Sites are loaded in parallel in worker
+# processes, one site per process, and the all-sites rollup is merged from
+# their daily aggregates rather than from the bookings.
+ALL_SITES = 'All sites'
+
+# Worker processes for a multi-site load; 0 uses one per site (up to the CPU count), 1 loads them in turn
+SITE_WORKERS = int(os.getenv('SF_SITE_WORKERS', '0'))
+
+# Results of full loads by booking set and parameters; a refresh that fetches the same bookings computes nothing
+result_cache = ResultCache()
+
+
+def load_streamed(site=SITE_NAME, instrumentation=None, params=None):
+    """ load_site() for histories larger than memory: bookings are folded chunk by chunk """
+    instrumentation = instrumentation or Instrumentation()
+    streamed = StreamingAggregates(params)
+    with instrumentation.stage('stream_bookings') as record:
+        for chunk in iter_booking_chunks(site=site):
+            streamed.fold(chunk)
+        record['rows'] = streamed.rows
+    with instrumentation.stage('stream_results'):
+        return streamed.result()
+
+
+def load_site(site=SITE_NAME, instrumentation=None, params=None):
+    """ Every metric of one site with `params` (metric_params() by default), each stage recorded on `instrumentation` """
+    instrumentation = instrumentation or Instrumentation()
+    params = params or metric_params()
+    if SYNC_MODE == 'stream':
+        return load_streamed(site, instrumentation, params)
+    with instrumentation.stage('get_data') as record:
+        results = get_data(site=site)
+        record['rows'] = results['totalSize']
+    with instrumentation.stage('get_dataframe') as record:
+        frame = booking_frame(results)
+        record['rows'] = len(frame)
+    # The record dicts are by far the largest object of a load; drop them as soon as the frame is built
+    results['records'] = None
+    if 'changed_records' not in results:
+        # Incremental syncs keep their own persisted state (see update_metrics)
+        with instrumentation.stage('result_cache') as record:
+            # The reporting window decides which bookings were fetched, so the booking digest covers it
+            key = result_key(frame, **params.as_dict())
+            cached = result_cache.get(key)
+            record['rows'] = len(frame)
+        if cached is not None:
+            logger.info("Bookings of %s unchanged; served the cached results", site)
+            return cached
+    # Parse and type the bookings once; both breakdowns read the same frames
+    with instrumentation.stage('prepare_bookings') as record:
+        # Incremental syncs take first visits from their metric state rather than a groupby over every booking
+        bookings = bookings_from_frame(frame, customer_mask(frame, params.excluded_emails), first_visits='changed_records' not in results)
+        del frame
+        record['rows'] = len(bookings.customers)
+    if 'changed_records' in results:
+        # Incremental sync: only the days, customers, months and weeks the delta touched are recomputed
+        # (the store and the state files are still read and written whole)
+        slug = site_slug(site)
+        directory = os.path.join(aggregates.AGGREGATES_DIR, slug) if slug else aggregates.AGGREGATES_DIR
+        with instrumentation.stage('update_metrics', rows=len(results['changed_records'])):
+            return update_metrics(bookings, results, directory, params)
+    # Daily aggregates back the date-range explorer; ad-hoc ranges never rescan the bookings
+    with instrumentation.stage('daily_aggregates') as record:
+        daily = daily_aggregates(bookings)
+        record['rows'] = len(daily.customer_days)
+    with instrumentation.stage('cohort_activity') as record:
+        cohorts = cohort_activity(bookings)
+        record['rows'] = len(cohorts)
+    with instrumentation.stage('monthly_breakdown') as record:
+        monthly_data = monthly_breakdown(bookings, daily=daily, params=params)
+        record['rows'] = len(monthly_data['monthly_breakdown'])
+    with instrumentation.stage('weekly_breakdown') as record:
+        weekly_data = weekly_breakdown(bookings)
+        record['rows'] = len(weekly_data)
+
+    data = {
+        **monthly_data,
+        'weekly_breakdown': weekly_data,
+        'daily_aggregates': daily,
+        'cohort_activity': cohorts,
+    }
+    result_cache.put(key, data)
+    return data
+
+
+def _load_site_in_worker(site, params):
+    # Runs in a worker process; the stage records go back with the result
+    instrumentation = Instrumentation()
+    with instrumentation.run('site'):
+        data = load_site(site, instrumentation, params)
+    return data, instrumentation.last_run('site')['stages']
+
+
+def rollup(site_data, params=None):
+    """ The all-sites load_site() result, merged from the daily aggregates of every site """
+    daily = merge_daily_aggregates([data['daily_aggregates'] for data in site_data.values()])
+
+    monthly = monthly_rows(daily).reset_index(drop=True)
+    # Calendar weeks (Monday to Sunday): each site's own weekly report is anchored on its first visit
+    weekly = period_breakdown(daily, 'week', new_revenue='all')
+    weekly = weekly.drop(columns='period_start').assign(period=[week_label(start) for start in weekly['period_start']])
+    weekly = weekly.rename(columns={'period': 'week'})[WEEKLY_COLUMNS]
+
+    return {
+        'monthly_breakdown': monthly,
+        **daily_ltv(daily, params),
+        'weekly_breakdown': weekly,
+        'daily_aggregates': daily,
+        'cohort_activity': daily_cohort_activity(daily),
+    }
+
+
+def load_sites(sites, instrumentation, workers=SITE_WORKERS, params=None):
+    """ load_site() of every site, plus the all-sites rollup under 'site' when there are several """
+    # Read once, so every site and the rollup use the same parameters
+    params = params or metric_params()
+    if len(sites) == 1:
+        return load_site(sites[0], instrumentation, params)
+
+    site_data = {}
+    workers = workers or min(len(sites), os.cpu_count() or 1)
+    if workers == 1:
+        for site in sites:
+            site_data[site] = load_site(site, instrumentation, params)
+    else:
+        # spawn: the app process runs threads (refresh, gunicorn) that a fork would copy mid-flight
+        with instrumentation.stage('load_sites', rows=len(sites)):
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+                futures = {site: pool.submit(_load_site_in_worker, site, params) for site in sites}
+                for site, future in futures.items():
+                    data, stages = future.result()
+                    for record in stages:
+                        instrumentation.add({**record, 'stage': f"{site}: {record['stage']}"})
+                    site_data[site] = data
+
+    if SYNC_MODE == 'stream':
+        # Streaming loads keep no daily aggregates to merge; the first site is shown by default
+        logger.info("No all-sites rollup for streaming loads")
+        return {**site_data[sites[0]], 'site': sites[0], 'sites': site_data}
+    with instrumentation.stage('rollup') as record:
+        data = rollup(site_data, params)
+        record['rows'] = len(data['daily_aggregates'].customer_days)
+    return {**data, 'site': ALL_SITES, 'sites': site_data}
@@ -0,0 +1,159 @@
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+from datetime import datetime
+
+import pandas as pd
+import pytz
+import requests
+
+import bulk_extract
+
+
+logger = logging.getLogger(__name__)
+
+# Record/replay of Salesforce responses. In "record" mode the live client is
+# wrapped and every query response is written to a gzip-compressed JSON file
+# keyed on a hash of the call; in "replay" mode those files are served back
+# without credentials or network, so loads are fast and repeatable.
+# SF_DATA_SOURCE is "live" (default), "record" or "replay".
+DATA_SOURCE = os.getenv('SF_DATA_SOURCE', 'live')
+RECORDINGS_DIR = os.getenv('SF_RECORDINGS_DIR', os.path.join('data', 'recordings'))
+
+# When the recording was made; replayed loads query the same date window
+CLOCK_FILE = 'clock.json'
+
+
+class MissingRecordingError(LookupError):
+    pass
+
+
+def _call_key(method, query, **kwargs):
+    # Whitespace in the SOQL is layout only, so it does not change the key
+    call = [method, ' '.join(str(query).split()), kwargs]
+    return hashlib.sha256(json.dumps(call, sort_keys=True).encode()).hexdigest()
+
+
+def _recording_path(directory, key, extension='.json.gz'):
+    return os.path.join(directory, key + extension)
+
+
+def _read_clock(path):
+    with open(path) as f:
+        return datetime.fromisoformat(json.load(f)['now'])
+
+
+def now(directory=RECORDINGS_DIR, source=DATA_SOURCE):
+    """ The current UTC time; the recording's time when recording or replaying
+
+    The first call of a recording writes the clock and every later one (site
+    workers, refreshes) reads it back, so the whole recording queries one
+    date window. Remove clock.json, or record to a new directory, to start
+    a new recording.
+    """
+    path = os.path.join(directory, CLOCK_FILE)
+    if source == 'replay':
+        if not os.path.exists(path):
+            raise MissingRecordingError(f"No recording in {directory} (run once with SF_DATA_SOURCE=record)")
+        return _read_clock(path)
+    current_time = datetime.now(pytz.utc)
+    if source == 'record':
+        if not os.path.exists(path):
+            os.makedirs(directory, exist_ok=True)
+            tmp_path = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+            with open(tmp_path, 'w') as f:
+                json.dump({'now': current_time.isoformat()}, f)
+            # Readers see the old file or the new one, never a partly written one
+            os.replace(tmp_path, path)
+        # Workers starting together may each write one, moments apart; the window is cut at midnight either way
+        return _read_clock(path)
+    return current_time
+
+
+class RecordingClient:
+    """ Wraps a live Salesforce client and saves every query response under `directory` """
+
+    def __init__(self, client, directory=RECORDINGS_DIR):
+        self.client = client
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def __getattr__(self, name):
+        # session, session_id, sf_instance, ... come from the live client
+        return getattr(self.client, name)
+
+    def _record(self, method, query, response, **kwargs):
+        path = _recording_path(self.directory, _call_key(method, query, **kwargs))
+        with gzip.open(path, 'wt', encoding='utf-8') as f:
+            json.dump(response, f, default=str)
+        return response
+
+    def query_all(self, query, include_deleted=False, **kwargs):
+        response = self.client.query_all(query, include_deleted=include_deleted, **kwargs)
+        return self._record('query_all', query, response, include_deleted=include_deleted)
+
+    def query(self, query, include_deleted=False, **kwargs):
+        response = self.client.query(query, include_deleted=include_deleted, **kwargs)
+        return self._record('query', query, response, include_deleted=include_deleted)
+
+    def query_more(self, next_records_identifier, identifier_is_url=False, include_deleted=False, **kwargs):
+        response = self.client.query_more(next_records_identifier, identifier_is_url=identifier_is_url,
+                                          include_deleted=include_deleted, **kwargs)
+        return self._record('query_more', next_records_identifier, response,
+                            identifier_is_url=identifier_is_url, include_deleted=include_deleted)
+
+
+class ReplayClient:
+    """ Serves the responses a RecordingClient saved under `directory`; never touches the network """
+
+    def __init__(self, directory=RECORDINGS_DIR):
+        self.directory = directory
+        # sharded_fetch mounts its connection pool on the client's session
+        self.session = requests.Session()
+
+    def _replay(self, method, query, **kwargs):
+        path = _recording_path(self.directory, _call_key(method, query, **kwargs))
+        if not os.path.exists(path):
+            raise MissingRecordingError(
+                f"No recorded {method} response in {self.directory} for: {' '.join(str(query).split())}")
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            return json.load(f)
+
+    def query_all(self, query, include_deleted=False, **kwargs):
+        return self._replay('query_all', query, include_deleted=include_deleted)
+
+    def query(self, query, include_deleted=False, **kwargs):
+        return self._replay('query', query, include_deleted=include_deleted)
+
+    def query_more(self, next_records_identifier, identifier_is_url=False, include_deleted=False, **kwargs):
+        return self._replay('query_more', next_records_identifier,
+                            identifier_is_url=identifier_is_url, include_deleted=include_deleted)
+
+
+def query_bookings(client, soql, include_deleted=False, base_url=None):
+    """ bulk_extract.query_bookings(), recorded or replayed as Parquet when `client` is a recording or replay client """
+    if isinstance(client, ReplayClient):
+        path = _recording_path(client.directory, _call_key('bulk', soql, include_deleted=include_deleted), '.parquet')
+        if not os.path.exists(path):
+            raise MissingRecordingError(f"No recorded bulk response in {client.directory} for: {' '.join(soql.split())}")
+        return pd.read_parquet(path)
+    if isinstance(client, RecordingClient):
+        records = bulk_extract.query_bookings(client.client, soql, include_deleted, base_url)
+        path = _recording_path(client.directory, _call_key('bulk', soql, include_deleted=include_deleted), '.parquet')
+        records.to_parquet(path, compression='zstd')
+        return records
+    return bulk_extract.query_bookings(client, soql, include_deleted, base_url)
+
+
+def wrap_client(connect, source=DATA_SOURCE, directory=RECORDINGS_DIR):
+    """ The client for `source`: connect() itself when live, wrapped to record, or a replay client (connect() is not called) """
+    if source == 'replay':
+        logger.info("Replaying Salesforce responses from %s", directory)
+        return ReplayClient(directory)
+    if source == 'record':
+        logger.info("Recording Salesforce responses to %s", directory)
+        return RecordingClient(connect(), directory)
+    return connect()
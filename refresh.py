@@ -0,0 +1,169 @@
+import logging
+import os
+import threading
+import time
+from contextlib import nullcontext
+from datetime import datetime
+
+from snapshot import build_snapshot
+
+
+logger = logging.getLogger(__name__)
+
+# Minutes between scheduled refreshes; 0 turns the schedule off (manual refresh only)
+REFRESH_INTERVAL_MINUTES = float(os.getenv('REFRESH_INTERVAL_MINUTES', '60'))
+
+
+class SnapshotRefresher:
+    """ Rebuilds snapshots on a background thread and swaps them in atomically """
+
+    def __init__(self, load_data, interval_minutes=REFRESH_INTERVAL_MINUTES, store=None, instrumentation=None):
+        self._load_data = load_data
+        self._interval_seconds = interval_minutes * 60
+        # Optional SnapshotStore shared with the other workers
+        self._store = store
+        # Optional Instrumentation; each load is recorded as a 'refresh' run
+        self._instrumentation = instrumentation
+        self._snapshot = None
+        self._swap_lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._scheduler = None
+        self.last_error = None
+        self.last_refreshed = None
+        # time.monotonic() when the first snapshot became available in this process
+        self.first_snapshot_at = None
+        # Called with each snapshot this process loads itself, on the refresh thread
+        self.on_swap = None
+
+    def current(self):
+        """ The snapshot pages should render from (None until the first load finishes) """
+        if self._store is not None:
+            self._adopt_published()
+        return self._snapshot
+
+    def _adopt_published(self):
+        # Picks up a snapshot published by another worker (a stat() when nothing changed)
+        version = self._store.latest_version()
+        snapshot = self._snapshot
+        if version is None or (snapshot is not None and snapshot.version >= version):
+            return
+        published = self._store.load(version)
+        with self._swap_lock:
+            if self._snapshot is None or self._snapshot.version < published.version:
+                self._swap(published)
+
+    def _swap(self, snapshot):
+        if self._snapshot is None:
+            self.first_snapshot_at = time.monotonic()
+        self._snapshot = snapshot
+
+    def stale(self):
+        """ True when there is no snapshot yet or it is older than the refresh interval """
+        if self._store is not None:
+            age = self._store.age_seconds()
+            if age is None:
+                return True
+            return self._interval_seconds > 0 and age > self._interval_seconds
+        return self._snapshot is None
+
+    @property
+    def refreshing(self):
+        return self._refresh_lock.locked()
+
+    def refresh(self, wait_for_loader=False):
+        """ Loads data and swaps in a new snapshot; returns False if a refresh was already running
+
+        With a shared store only one worker loads at a time. wait_for_loader=True waits for a
+        worker that is already loading and adopts its snapshot instead of loading again.
+        """
+        if not self._refresh_lock.acquire(blocking=False):
+            return False
+        self._refresh_locked(wait_for_loader)
+        return True
+
+    def _refresh_locked(self, wait_for_loader=False):
+        try:
+            if self._store is None:
+                self._load_and_swap(self._next_version())
+            else:
+                self._refresh_shared(wait_for_loader)
+            self.last_error = None
+            self.last_refreshed = datetime.now()
+        except Exception as exc:
+            # Keep serving the previous snapshot when Salesforce or the breakdowns fail
+            logger.exception("Snapshot refresh failed")
+            self.last_error = exc
+        finally:
+            self._refresh_lock.release()
+
+    def _next_version(self):
+        current = self._snapshot
+        version = current.version + 1 if current is not None else 1
+        if self._store is not None:
+            version = max(version, (self._store.latest_version() or 0) + 1)
+        return version
+
+    def _stage(self, name):
+        if self._instrumentation is None:
+            return nullcontext({})
+        return self._instrumentation.stage(name)
+
+    def _load_and_swap(self, version):
+        run = self._instrumentation.run('refresh') if self._instrumentation is not None else nullcontext()
+        with run:
+            data = self._load_data()
+            with self._stage('build_snapshot'):
+                snapshot = build_snapshot(data, version)
+            if self._store is not None:
+                with self._stage('snapshot_store'):
+                    self._store.save(snapshot)
+                    # Serve the mapped copy like every other worker does
+                    snapshot = self._store.load(snapshot.version)
+            # Readers only ever see the old or the new snapshot, never a half-built one
+            with self._swap_lock:
+                self._swap(snapshot)
+            if self.on_swap is not None:
+                try:
+                    self.on_swap(snapshot)
+                except Exception:
+                    logger.exception("Snapshot swap hook failed")
+
+    def _refresh_shared(self, wait_for_loader):
+        seen_version = self._store.latest_version()
+        with self._store.loader_lock(blocking=wait_for_loader) as acquired:
+            if not acquired:
+                # Another worker is loading; its snapshot shows up through current()
+                return
+            if wait_for_loader and self._store.latest_version() != seen_version:
+                # Published while we were waiting for the lock
+                self._adopt_published()
+                return
+            self._load_and_swap(self._next_version())
+
+    def trigger(self):
+        """ Starts a refresh in the background without waiting for it; False if one is already running """
+        # The lock is taken here, not in the thread, so `refreshing` is true as soon as this returns
+        if not self._refresh_lock.acquire(blocking=False):
+            return False
+        threading.Thread(target=self._refresh_locked, name='snapshot-refresh', daemon=True).start()
+        return True
+
+    def start(self):
+        """ Starts the refresh schedule (no-op when the interval is 0 or it is already running) """
+        if self._interval_seconds <= 0 or self._scheduler is not None:
+            return
+        self._scheduler = threading.Thread(target=self._run_schedule, name='snapshot-scheduler', daemon=True)
+        self._scheduler.start()
+
+    def stop(self):
+        self._wakeup.set()
+
+    def _run_schedule(self):
+        while not self._wakeup.wait(self._interval_seconds):
+            if self._store is not None:
+                age = self._store.age_seconds()
+                if age is not None and age < self._interval_seconds / 2:
+                    # Another worker refreshed recently; no need to hit Salesforce again
+                    continue
+            self.refresh()
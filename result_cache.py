@@ -0,0 +1,213 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from period_engine import DailyAggregates
+
+
+logger = logging.getLogger(__name__)
+
+# Content-addressed cache of load results. The key is a digest of the fetched
+# booking set and of every parameter the metrics depend on, so a refresh that
+# gets the same bookings back (or goes back to an earlier parameter set) is
+# served without recomputing anything. Results live in a small in-memory LRU
+# and on disk, both bounded in size and expiring after a TTL.
+#
+#   <cache dir>/<key>/meta.json          format, stored_at, scalar results, frame names
+#   <cache dir>/<key>/<frame>.parquet
+RESULT_CACHE_DIR = os.getenv('RESULT_CACHE_DIR', os.path.join('data', 'results'))
+RESULT_CACHE_TTL_SECONDS = int(os.getenv('RESULT_CACHE_TTL_SECONDS', str(7 * 24 * 3600)))
+RESULT_CACHE_MEMORY_MB = int(os.getenv('RESULT_CACHE_MEMORY_MB', '256'))
+RESULT_CACHE_DISK_MB = int(os.getenv('RESULT_CACHE_DISK_MB', '2048'))
+
+# Part of every key; bump it when the computed results change for the same inputs
+RESULT_FORMAT = 1
+
+
+def booking_set_digest(frame):
+    """ Digest of the rows of a booking frame, whatever order Salesforce returned them in """
+    rows = pd.util.hash_pandas_object(frame, index=False).to_numpy()
+    return hashlib.sha256(np.sort(rows).tobytes()).hexdigest()
+
+
+def result_key(frame, **params):
+    """ Cache key of the results computed from `frame` with `params` (JSON-able values) """
+    key = {'format': RESULT_FORMAT, 'bookings': booking_set_digest(frame), 'params': params}
+    return hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _frames(result):
+    # (file name, frame) of every frame in a load result, DailyAggregates included
+    for name, value in result.items():
+        if isinstance(value, pd.DataFrame):
+            yield name, value
+        elif isinstance(value, DailyAggregates):
+            yield f"{name}.customer_days", value.customer_days
+            yield f"{name}.day_totals", value.day_totals
+
+
+def _result_bytes(result):
+    return int(sum(frame.memory_usage(deep=True).sum() for _, frame in _frames(result)))
+
+
+def _directory_bytes(directory):
+    return sum(entry.stat().st_size for entry in os.scandir(directory) if entry.is_file())
+
+
+class ResultCache:
+    """ In-memory LRU in front of an on-disk store of load results, both with TTL and size limits """
+
+    def __init__(self, cache_dir=RESULT_CACHE_DIR, ttl_seconds=RESULT_CACHE_TTL_SECONDS,
+                 memory_bytes=RESULT_CACHE_MEMORY_MB * 2 ** 20, disk_bytes=RESULT_CACHE_DISK_MB * 2 ** 20):
+        self.cache_dir = cache_dir
+        self.ttl_seconds = ttl_seconds
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self._lock = threading.Lock()
+        # key -> (stored_at, bytes, result), least recently used first
+        self._memory = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _expired(self, stored_at):
+        return time.time() - stored_at > self.ttl_seconds
+
+    def get(self, key):
+        """ The cached result for `key`, or None """
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and self._expired(entry[0]):
+                del self._memory[key]
+                entry = None
+            if entry is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return entry[2]
+
+        loaded = self._read(key)
+        with self._lock:
+            if loaded is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            stored_at, result = loaded
+            self._remember(key, stored_at, result)
+            return result
+
+    def put(self, key, result):
+        """ Stores `result` in both tiers """
+        stored_at = time.time()
+        with self._lock:
+            self._remember(key, stored_at, result)
+        try:
+            self._write(key, stored_at, result)
+        except OSError as error:
+            # The memory tier still has it; a full or read-only disk only costs a recompute later
+            logger.warning("Could not write cached result %s: %s", key, error)
+
+    def _remember(self, key, stored_at, result):
+        size = _result_bytes(result)
+        self._memory[key] = (stored_at, size, result)
+        self._memory.move_to_end(key)
+        used = sum(entry[1] for entry in self._memory.values())
+        # The newest entry is kept even when it alone is over the limit
+        while used > self.memory_bytes and len(self._memory) > 1:
+            _, (_, evicted_size, _) = self._memory.popitem(last=False)
+            used -= evicted_size
+
+    def _read(self, key):
+        directory = os.path.join(self.cache_dir, key)
+        meta_path = os.path.join(directory, 'meta.json')
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            return None
+        if meta.get('format') != RESULT_FORMAT or self._expired(meta['stored_at']):
+            # Written by a version that computed the results differently, or too old
+            shutil.rmtree(directory, ignore_errors=True)
+            return None
+
+        result = dict(meta['scalars'])
+        try:
+            for name in meta['frames']:
+                result[name] = pd.read_parquet(os.path.join(directory, f"{name}.parquet"))
+        except FileNotFoundError:
+            # Evicted by another process while being read
+            return None
+        for name in meta['aggregates']:
+            result[name] = DailyAggregates(customer_days=result.pop(f"{name}.customer_days"),
+                                           day_totals=result.pop(f"{name}.day_totals"))
+        # Last use decides what the disk tier evicts first
+        os.utime(meta_path)
+        return meta['stored_at'], result
+
+    def _write(self, key, stored_at, result):
+        directory = os.path.join(self.cache_dir, key)
+        tmp_dir = f"{directory}.tmp-{os.getpid()}-{threading.get_ident()}"
+        os.makedirs(tmp_dir, exist_ok=True)
+
+        frames = []
+        for name, frame in _frames(result):
+            frame.to_parquet(os.path.join(tmp_dir, f"{name}.parquet"), index=False)
+            frames.append(name)
+        meta = {
+            'format': RESULT_FORMAT,
+            'stored_at': stored_at,
+            'scalars': {name: value.item() if isinstance(value, np.generic) else value
+                        for name, value in result.items()
+                        if not isinstance(value, (pd.DataFrame, DailyAggregates))},
+            'frames': frames,
+            'aggregates': [name for name, value in result.items() if isinstance(value, DailyAggregates)],
+        }
+        # meta.json is written last, so an entry without it is never read
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+        shutil.rmtree(directory, ignore_errors=True)
+        os.replace(tmp_dir, directory)
+        self._prune()
+
+    def _prune(self):
+        # Expired entries go first, then the least recently used until the disk tier fits
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            meta_path = os.path.join(entry.path, 'meta.json')
+            if not entry.is_dir():
+                continue
+            try:
+                with open(meta_path) as f:
+                    stored_at = json.load(f)['stored_at']
+                if self._expired(stored_at):
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                    continue
+                entries.append((os.stat(meta_path).st_mtime, _directory_bytes(entry.path), entry.path))
+            except FileNotFoundError:
+                # Being written (no meta.json yet) or removed by another process
+                continue
+
+        used = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries)[:-1]:
+            if used <= self.disk_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            used -= size
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._memory),
+                'memory_bytes': sum(entry[1] for entry in self._memory.values()),
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+            }
@@ -1,37 +1,150 @@
 from simple_salesforce import Salesforce
-import requests
 import pandas as pd
-from io import StringIO
 from dotenv import load_dotenv
 import os
+import re
+import threading
 from datetime import datetime
 import pytz
 
+import booking_store
+import recorded_client
+import sharded_fetch
+from metric_params import metric_params
+
 # Load environment variables from .env file
 load_dotenv()
 
-# Connect to Salesforce
-sf = Salesforce(
-    username=os.getenv('SF_USERNAME'),
-    password=os.getenv('SF_PASSWORD'),
-    security_token=os.getenv('SF_SECURITY_TOKEN')
-)
+# The Salesforce connection is opened on first use rather than at import, so
+# importing this module (and booting the app) never waits on Salesforce
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    global _client
+    with _client_lock:
+        if _client is None:
+            # Connect to Salesforce (or record or replay its responses, see SF_DATA_SOURCE)
+            _client = recorded_client.wrap_client(lambda: Salesforce(
+                username=os.getenv('SF_USERNAME'),
+                password=os.getenv('SF_PASSWORD'),
+                security_token=os.getenv('SF_SECURITY_TOKEN')
+            ))
+        return _client
+
+# "full" re-queries every booking on each load, "incremental" keeps a local
+# Parquet store and only pulls rows modified since the last sync
+SYNC_MODE = os.getenv('SF_SYNC_MODE', 'full')
+
+# Extraction backend for full loads: "rest" (query_all) or "bulk" (Bulk API 2.0 CSV results).
+# SF_BULK_BASE_URL points the bulk backend somewhere other than the org's REST endpoint.
+EXTRACT_BACKEND = os.getenv('SF_EXTRACT_BACKEND', 'rest')
+BULK_BASE_URL = os.getenv('SF_BULK_BASE_URL')
 
-def get_data():
+# Streaming loads (SF_SYNC_MODE=stream) fold the bookings chunk by chunk instead of
+# building one frame of them; SF_STREAM_SOURCE is "salesforce" (the paged REST
+# query) or "store" (the local Parquet store as last synced)
+STREAM_SOURCE = os.getenv('SF_STREAM_SOURCE', 'salesforce')
+STREAM_CHUNK_ROWS = int(os.getenv('SF_STREAM_CHUNK_ROWS', '50000'))
 
-    # Get the current date and time, and set it to midnight UTC
-    current_time = datetime.now(pytz.utc)
+# Threads for the month-sharded REST fetch; 0 keeps the single query_all() over the whole range
+FETCH_WORKERS = int(os.getenv('SF_FETCH_WORKERS', '0'))
+
+BOOKING_FIELDS = [
+    "Id",
+    "Bnow__Customer_Email__c",
+    "Bnow__All_Products_Processed__c",
+    "Bnow__Balance_Paid__c",
+    "Bnow__Status__c",
+    "Bnow__Customer_ID__c",
+    "SystemModstamp",
+]
+BOOKING_STATUSES = ['Booked', 'Cancelled', 'Checked In', 'Moved', 'Not Paid', 'Parked', 'Pending', '']
+SITE_NAME = 'Jungle World'
+# Parks served by this deployment (comma separated); each is fetched and computed on its own
+SITE_NAMES = [site.strip() for site in os.getenv('SF_SITE_NAMES', SITE_NAME).split(',') if site.strip()]
+
+# Define the start date (2023-08-28) and ensure it is set to midnight UTC
+START_DATE = datetime(2023, 8, 28, 0, 0, 0, 0).replace(tzinfo=pytz.utc)
+
+
+def query_window():
+    """ (start, end) of the reported bookings: START_DATE to last midnight UTC """
+    # Get the current date and time (the recording's when replaying), and set it to midnight UTC
+    current_time = recorded_client.now()
     current_time_midnight = current_time.replace(hour=0, minute=0, second=0, microsecond=0)
+    return START_DATE, current_time_midnight
+
 
-    # Define the start date (2023-08-27) and ensure it is set to midnight UTC
-    start_date = datetime(2023, 8, 28, 0, 0, 0, 0).replace(tzinfo=pytz.utc)
+def site_slug(site):
+    """ File name friendly site name; empty for SITE_NAME, whose files keep their original names """
+    if site == SITE_NAME:
+        return ''
+    return re.sub(r'[^a-z0-9]+', '-', site.lower()).strip('-')
 
+
+def site_store_path(site, path=booking_store.STORE_PATH):
+    """ The local booking store of one site """
+    slug = site_slug(site)
+    if not slug:
+        return path
+    root, extension = os.path.splitext(path)
+    return f"{root}-{slug}{extension}"
+
+
+def _soql_string(value):
+    return value.replace('\\', '\\\\').replace("'", "\\'")
+
+
+def _booking_filters(start_date, current_time_midnight, site=SITE_NAME):
+    """ (status and site filter, full WHERE clause) of the reported bookings in the window """
     # Format the dates in the required format 'YYYY-MM-DDTHH:MM:SS.000+00:00'
     start_date_str = start_date.isoformat()  # e.g. "2023-08-27T00:00:00+00:00"
     current_time_str = current_time_midnight.isoformat()  # e.g. "2025-03-13T00:00:00+00:00"
+    statuses = ", ".join(f"'{status}'" for status in BOOKING_STATUSES)
+    filters = f"""
+            Bnow__Booking__c.Bnow__Status__c IN ({statuses})
+            AND Bnow__Booking__c.Bnow__Site_Name__c = '{_soql_string(site)}'
+    """
+    where = f"""
+            Bnow__Booking__c.Bnow__All_Products_Processed__c >= {start_date_str}
+            AND Bnow__Booking__c.Bnow__All_Products_Processed__c <= {current_time_str}
+            AND {filters}
+    """
+    return filters, where
+
+
+def get_data(client=None, site=SITE_NAME):
+    client = client or get_client()
+    if SYNC_MODE == 'incremental':
+        return get_data_incremental(client, site_store_path(site), site)
+
+    start_date, current_time_midnight = query_window()
+    filters, where = _booking_filters(start_date, current_time_midnight, site)
+
+    if EXTRACT_BACKEND == 'bulk':
+        # Bulk API 2.0: CSV result pages streamed into a typed frame, no per-record dicts
+        records = recorded_client.query_bookings(
+            client,
+            f"SELECT {', '.join(BOOKING_FIELDS)} FROM Bnow__Booking__c WHERE {where}",
+            base_url=BULK_BASE_URL,
+        )
+        return {"totalSize": len(records), "done": True, "records": records}
+
+    if FETCH_WORKERS > 0:
+        # One query per month of history, run concurrently and merged on the booking Id
+        return sharded_fetch.fetch_sharded(
+            client,
+            f"SELECT {', '.join(BOOKING_FIELDS)} FROM Bnow__Booking__c",
+            filters,
+            start_date,
+            current_time_midnight,
+            max_workers=FETCH_WORKERS,
+        )
 
     # Now remove quotes around the DateTime fields in the query:
-    results = sf.query_all(f"""
+    results = client.query_all(f"""
         SELECT
             Bnow__Booking__c.Bnow__Customer_Email__c,
             Bnow__Booking__c.Bnow__All_Products_Processed__c,
@@ -39,61 +152,166 @@ def get_data():
             Bnow__Booking__c.Bnow__Status__c,
             Bnow__Customer_ID__c
         FROM Bnow__Booking__c
-        WHERE
-            Bnow__Booking__c.Bnow__All_Products_Processed__c >= {start_date_str}
-            AND Bnow__Booking__c.Bnow__All_Products_Processed__c <= {current_time_str}
-            AND Bnow__Booking__c.Bnow__Status__c IN ('Booked', 'Cancelled', 'Checked In', 'Moved', 'Not Paid', 'Parked', 'Pending', '')
-            AND Bnow__Booking__c.Bnow__Site_Name__c = 'Jungle World'
+        WHERE {where}
     """)
     return results
 
-def get_dataframe(results):
 
-    # Extract records from the Salesforce response
-    records = results["records"]
+def iter_booking_chunks(client=None, source=STREAM_SOURCE, chunk_rows=STREAM_CHUNK_ROWS, site=SITE_NAME):
+    """ The bookings get_data() returns, as booking_frame() chunks in visit date order """
+    start_date, current_time_midnight = query_window()
+    if source == 'store':
+        # Row groups of the synced store (kept in visit date order), filtered like get_data_incremental()
+        columns = list(BOOKING_COLUMNS) + ["Bnow__Status__c"]
+        for rows in booking_store.iter_store_batches(columns, chunk_rows, site_store_path(site)):
+            rows = rows[_in_window(rows, start_date, current_time_midnight)]
+            if len(rows):
+                yield booking_frame({"records": rows})
+        return
 
-    # Convert to DataFrame
-    df = pd.DataFrame(records)
+    _, where = _booking_filters(start_date, current_time_midnight, site)
+    client = client or get_client()
+    # query() returns one page and a nextRecordsUrl; pages are collected up to chunk_rows and then released
+    page = client.query(f"""
+        SELECT {', '.join(BOOKING_COLUMNS)}
+        FROM Bnow__Booking__c
+        WHERE {where}
+        ORDER BY Bnow__All_Products_Processed__c, Id
+    """)
+    records = []
+    while True:
+        records.extend(page["records"])
+        while len(records) >= chunk_rows:
+            yield booking_frame({"records": records[:chunk_rows]})
+            records = records[chunk_rows:]
+        if page.get("done", True) or not page.get("nextRecordsUrl"):
+            break
+        page = client.query_more(page["nextRecordsUrl"], identifier_is_url=True)
+    if records:
+        yield booking_frame({"records": records})
 
-    # Select only relevant columns
-    df = df[["Bnow__Customer_Email__c", "Bnow__All_Products_Processed__c", "Bnow__Balance_Paid__c", "Bnow__Customer_ID__c"]]
-    
-    # Rename columns for better readability
-    df.columns = ["email", "visit_date", "purchase_value", "customer_id"]
 
-    # Convert Booking Date to datetime format
-    df["visit_date"] = pd.to_datetime(df["visit_date"])
+def sync_bookings(client=None, store_path=booking_store.STORE_PATH, site=SITE_NAME):
+    """ Pulls bookings modified since the stored high-water mark and merges them into the local store """
+    client = client or get_client()
+    store_df, high_water_mark = booking_store.load_store(store_path)
 
-    # Convert Balance Paid to float
-    df["purchase_value"] = df["purchase_value"].astype(float)
+    # The store keeps every booking of the site since START_DATE regardless of
+    # status, so a booking that moves out of (or back into) the reported
+    # statuses is updated in place instead of going stale
+    conditions = [
+        f"Bnow__All_Products_Processed__c >= {START_DATE.isoformat()}",
+        f"Bnow__Site_Name__c = '{_soql_string(site)}'",
+    ]
+    if high_water_mark is not None:
+        # >= rather than > : rows committed in the same second as the last pull are re-read and de-duplicated on Id
+        modstamp = pd.Timestamp(high_water_mark).tz_convert('UTC').strftime('%Y-%m-%dT%H:%M:%SZ')
+        conditions.append(f"SystemModstamp >= {modstamp}")
 
+    fields = BOOKING_FIELDS + ['IsDeleted']
+    # include_deleted hits queryAll so deleted bookings come back flagged and can be dropped from the store
+    delta = client.query_all(
+        f"SELECT {', '.join(fields)} FROM Bnow__Booking__c WHERE {' AND '.join(conditions)}",
+        include_deleted=True,
+    )
+    delta_df = booking_store.records_to_frame(delta["records"], fields)
 
-    # Total purchases for null emails but with a valid customer_id
-    # df_null_emails_with_customer = df[(df['email'].isna() | (df['email'] == '')) & (df['customer_id'].notna() & (df['customer_id'] != ''))]
+    # Stored versions of the bookings the delta replaces (or deletes)
+    if store_df is not None and not delta_df.empty:
+        replaced_df = store_df[store_df[booking_store.ID_FIELD].isin(delta_df[booking_store.ID_FIELD])]
+    else:
+        replaced_df = delta_df.iloc[0:0]
 
-    # total_null_email_purchases = df_null_emails_with_customer['purchase_value'].sum()
+    merged = booking_store.merge_bookings(store_df, delta_df, deleted_field='IsDeleted')
+    previous_high_water_mark = high_water_mark
+    high_water_mark = booking_store.high_water_mark_of(delta_df, high_water_mark)
+    # The store's visit date order carries over to the loaded bookings (aggregates.update_state relies on it)
+    merged = booking_store.save_store(merged, high_water_mark, store_path)
 
-    # print(f"Total purchase value for null emails with customer_id: {total_null_email_purchases}")
+    sync = {
+        # New and replaced versions of every booking touched by this sync
+        'changed': pd.concat([delta_df.drop(columns=['IsDeleted']), replaced_df], ignore_index=True),
+        'previous_high_water_mark': previous_high_water_mark,
+        'high_water_mark': high_water_mark,
+    }
+    return merged, sync
 
-    df_customers = df[df['customer_id'].notna() & (df['customer_id'] != '')]
-    df_cleaned = df_customers[df_customers['email'].notna() & (df_customers['email'] != '')]
 
-    emails_to_remove = ['beth.a.w.1998@gmail.com', 'ellison.melanie@yahoo.co.uk', 'hello@jungleworldpark.com', 'madirose1202@outlook.com']
+def _in_window(bookings, start_date, current_time_midnight):
+    # Stored rows the full query would return: reporting window and status filter
+    visit_dates = pd.to_datetime(bookings["Bnow__All_Products_Processed__c"], utc=True)
+    statuses = bookings["Bnow__Status__c"].fillna('')
+    return (
+        (visit_dates >= start_date)
+        & (visit_dates <= current_time_midnight)
+        & statuses.isin(BOOKING_STATUSES)
+    ).to_numpy()
 
-#     df_to_remove = df[df['email'].isin(emails_to_remove)]
 
-# # Sum the purchase values
-#     total_removed_purchases = df_to_remove['purchase_value'].sum()
+def get_data_incremental(client=None, store_path=booking_store.STORE_PATH, site=SITE_NAME):
+    """ Same result shape as get_data(), served from the synced local store """
+    bookings, sync = sync_bookings(client, store_path, site)
 
-#     print(f"Total purchase value for removed emails: {total_removed_purchases}")
+    # Apply the reporting window and status filter of the full query locally
+    start_date, current_time_midnight = query_window()
+    records = bookings[_in_window(bookings, start_date, current_time_midnight)].reset_index(drop=True)
 
-    df_filtered = df_cleaned[~df_cleaned['email'].isin(emails_to_remove)]
+    return {
+        "totalSize": len(records),
+        "done": True,
+        "records": records,
+        # Lets aggregates.update_metrics() recompute only what the delta touched
+        "changed_records": sync['changed'],
+        "previous_high_water_mark": sync['previous_high_water_mark'],
+        "high_water_mark": sync['high_water_mark'],
+        "window_end": current_time_midnight.isoformat(),
+    }
 
-    
-    # total_filtered_purchases = df_filtered['purchase_value'].sum()
+# Salesforce fields of the booking frame and their column names
+BOOKING_COLUMNS = {
+    "Bnow__Customer_Email__c": "email",
+    "Bnow__All_Products_Processed__c": "visit_date",
+    "Bnow__Balance_Paid__c": "purchase_value",
+    "Bnow__Customer_ID__c": "customer_id",
+}
 
-    # print(f"Total purchase value for filtered emails: {total_filtered_purchases}")
-    
-    return [df_filtered, df]
 
+def booking_frame(results):
+    """ Every fetched booking as one compact frame
 
+    Emails and customer IDs are dictionary-encoded (categorical), so each
+    distinct value is stored once and rows hold small integer codes.
+    """
+    # Extract records from the Salesforce response
+    records = results["records"]
+
+    if isinstance(records, pd.DataFrame):
+        # Synced store and Bulk API results are already columnar
+        columns = {name: records[field].array for field, name in BOOKING_COLUMNS.items()}
+    else:
+        # Only the needed fields are pulled out of the record dicts (no frame of every field)
+        columns = {name: [record.get(field) for record in records] for field, name in BOOKING_COLUMNS.items()}
+
+    return pd.DataFrame({
+        "email": pd.Series(columns["email"], dtype="category"),
+        # Convert Booking Date to datetime format
+        "visit_date": pd.to_datetime(pd.Series(columns["visit_date"])),
+        # Convert Balance Paid to float
+        "purchase_value": pd.Series(columns["purchase_value"], dtype="float64"),
+        "customer_id": pd.Series(columns["customer_id"], dtype="category"),
+    })
+
+
+def customer_mask(df, excluded_emails=None):
+    """ Bookings with a customer ID and an email, minus the excluded emails (metric_params() ones by default) """
+    has_customer = df['customer_id'].notna() & (df['customer_id'] != '')
+    has_email = df['email'].notna() & (df['email'] != '')
+    if excluded_emails is None:
+        excluded_emails = metric_params().excluded_emails
+    return (has_customer & has_email & ~df['email'].isin(excluded_emails)).to_numpy()
+
+
+def get_dataframe(results):
+    """ [customer bookings, all bookings] as compact frames (see booking_frame() and customer_mask()) """
+    df = booking_frame(results)
+    return [df[customer_mask(df)], df]
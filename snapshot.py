@@ -0,0 +1,78 @@
+from dataclasses import dataclass, field
+from datetime import datetime
+
+import pandas as pd
+
+from period_engine import DailyAggregates
+
+
+# A snapshot is everything the pages render from, built in one go from a
+# load_data() result. Snapshots are never modified after they are built; a
+# refresh builds a new one and swaps it in.
+
+@dataclass(frozen=True)
+class Snapshot:
+    version: int
+    built_at: datetime
+    monthly_df: pd.DataFrame
+    weekly_df: pd.DataFrame
+    metrics_df: pd.DataFrame
+    # Daily aggregates the ad-hoc period breakdowns are computed from
+    customer_days: pd.DataFrame
+    day_totals: pd.DataFrame
+    # Customers and revenue per (first-visit month, months since it)
+    cohort_df: pd.DataFrame
+    # What the frames cover when several sites are loaded: a site or the all-sites rollup
+    site: str = None
+    # Per-site snapshots (same version) when several sites are loaded
+    sites: dict = field(default_factory=dict)
+
+    @property
+    def daily(self):
+        return DailyAggregates(customer_days=self.customer_days, day_totals=self.day_totals)
+
+    def view(self, site=None):
+        """ The snapshot of one site; this one for its own site or when the site is unknown """
+        return self.sites.get(site, self)
+
+    def site_names(self):
+        """ Sites a page can be shown for, this snapshot's own first """
+        if not self.sites:
+            return []
+        return [self.site] + [site for site in self.sites if site != self.site]
+
+
+def build_metrics_df(data):
+    metrics = {
+        "Basic LTV": data['Basic LTV'],
+        "Advanced LTV": data['Advanced LTV'],
+        "Average Purchase Value": data['Average Purchase Value'],
+        "Average Purchase Frequency": data['Average Purchase Frequency'],
+        "Average Customer Lifespan (Months)": data['Average Customer LifeSpan(Months)']
+    }
+    metrics_df = pd.DataFrame(metrics.items(), columns=["Metric", "Value"])
+    metrics_df["Value"] = metrics_df["Value"].round(2).astype(str)
+    return metrics_df
+
+
+def build_snapshot(data, version):
+    """ Builds the display frames for one load_data() result (and for each of its sites) """
+    monthly_df = data['monthly_breakdown'].copy()
+    monthly_df['month'] = monthly_df['month'].astype(str)
+
+    weekly_df = data['weekly_breakdown'].copy()
+    weekly_df['week'] = weekly_df['week'].astype(str)
+
+    return Snapshot(
+        version=version,
+        built_at=datetime.now(),
+        monthly_df=monthly_df,
+        weekly_df=weekly_df,
+        metrics_df=build_metrics_df(data),
+        customer_days=data['daily_aggregates'].customer_days,
+        day_totals=data['daily_aggregates'].day_totals,
+        cohort_df=data['cohort_activity'],
+        site=data.get('site'),
+        sites={site: build_snapshot({**site_data, 'site': site}, version)
+               for site, site_data in data.get('sites', {}).items()},
+    )
@@ -0,0 +1,162 @@
+import fcntl
+import json
+import os
+import shutil
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+import pandas as pd
+import pyarrow as pa
+
+from snapshot import Snapshot
+
+
+# Snapshots shared between gunicorn workers. One worker loads from Salesforce
+# and writes the display frames as Arrow IPC files under a versioned
+# directory, then publishes the version in CURRENT; every worker memory-maps
+# the files of the published version instead of loading its own copy.
+#
+#   <cache dir>/CURRENT            {"version": 7, "built_at": "..."}
+#   <cache dir>/v7/monthly.arrow
+#   <cache dir>/v7/weekly.arrow
+#   <cache dir>/v7/metrics.arrow
+#   <cache dir>/v7/customer_days.arrow, day_totals.arrow, cohort_df.arrow
+#   <cache dir>/v7/site-0/...      the same frames per site when several sites are loaded
+#   <cache dir>/.lock              held by the worker that is loading
+SNAPSHOT_CACHE_DIR = os.getenv('SNAPSHOT_CACHE_DIR', os.path.join('data', 'snapshots'))
+
+# Older versions are kept for a while so a worker still reading one is not cut off
+KEEP_VERSIONS = 3
+
+FRAMES = ('monthly_df', 'weekly_df', 'metrics_df', 'customer_days', 'day_totals', 'cohort_df')
+
+
+class SnapshotStore:
+
+    def __init__(self, cache_dir=SNAPSHOT_CACHE_DIR):
+        self.cache_dir = cache_dir
+        self._current_path = os.path.join(cache_dir, 'CURRENT')
+        self._lock_path = os.path.join(cache_dir, '.lock')
+        self._current_stamp = None
+        self._current = None
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _version_dir(self, version):
+        return os.path.join(self.cache_dir, f"v{version}")
+
+    def published(self):
+        """ The published {"version", "built_at"} record, or None; only re-read when CURRENT changes """
+        try:
+            stat = os.stat(self._current_path)
+        except FileNotFoundError:
+            return None
+        # CURRENT is replaced by rename, so a new inode (or mtime) means a new version
+        stamp = (stat.st_ino, stat.st_mtime_ns)
+        if stamp != self._current_stamp:
+            with open(self._current_path) as f:
+                self._current = json.load(f)
+            self._current_stamp = stamp
+        return self._current
+
+    def latest_version(self):
+        current = self.published()
+        return current['version'] if current is not None else None
+
+    def age_seconds(self):
+        """ Seconds since the published snapshot was written (None when there is none) """
+        try:
+            return time.time() - os.stat(self._current_path).st_mtime
+        except FileNotFoundError:
+            return None
+
+    def load(self, version=None):
+        """ Memory-maps the frames of a published version (the latest by default) """
+        current = self.published()
+        if current is None:
+            return None
+        if version is None:
+            version = current['version']
+
+        version_dir = self._version_dir(version)
+        with open(os.path.join(version_dir, 'snapshot.json')) as f:
+            record = json.load(f)
+        built_at = datetime.fromisoformat(record['built_at'])
+
+        sites = {
+            site: Snapshot(version=version, built_at=built_at, site=site,
+                           **_read_frames(os.path.join(version_dir, f"site-{i}")))
+            for i, site in enumerate(record.get('sites', []))
+        }
+        return Snapshot(version=version, built_at=built_at, site=record.get('site'), sites=sites,
+                        **_read_frames(version_dir))
+
+    def save(self, snapshot):
+        """ Writes a snapshot and publishes it to every worker """
+        version_dir = self._version_dir(snapshot.version)
+        tmp_dir = f"{version_dir}.tmp-{os.getpid()}"
+        os.makedirs(tmp_dir, exist_ok=True)
+
+        _write_frames(tmp_dir, snapshot)
+        for i, site_snapshot in enumerate(snapshot.sites.values()):
+            _write_frames(os.path.join(tmp_dir, f"site-{i}"), site_snapshot)
+        record = {'version': snapshot.version, 'built_at': snapshot.built_at.isoformat()}
+        with open(os.path.join(tmp_dir, 'snapshot.json'), 'w') as f:
+            json.dump({**record, 'site': snapshot.site, 'sites': list(snapshot.sites)}, f)
+
+        shutil.rmtree(version_dir, ignore_errors=True)
+        os.replace(tmp_dir, version_dir)
+
+        # Publishing is a single rename, so readers see either the old or the new version
+        tmp_current = f"{self._current_path}.tmp-{os.getpid()}"
+        with open(tmp_current, 'w') as f:
+            json.dump(record, f)
+        os.replace(tmp_current, self._current_path)
+
+        self._prune(snapshot.version)
+
+    def _prune(self, latest_version):
+        for entry in os.listdir(self.cache_dir):
+            if not entry.startswith('v') or not entry[1:].isdigit():
+                continue
+            if int(entry[1:]) <= latest_version - KEEP_VERSIONS:
+                shutil.rmtree(os.path.join(self.cache_dir, entry), ignore_errors=True)
+
+    @contextmanager
+    def loader_lock(self, blocking=False):
+        """ Cross-process lock held while loading; yields whether it was acquired """
+        with open(self._lock_path, 'w') as lock_file:
+            flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+            try:
+                fcntl.flock(lock_file, flags)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _write_frames(directory, snapshot):
+    os.makedirs(directory, exist_ok=True)
+    for name in FRAMES:
+        table = pa.Table.from_pandas(getattr(snapshot, name), preserve_index=False)
+        with pa.OSFile(os.path.join(directory, f"{name}.arrow"), 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+
+
+def _read_frames(directory):
+    frames = {}
+    for name in FRAMES:
+        path = os.path.join(directory, f"{name}.arrow")
+        if not os.path.exists(path):
+            # Published before this frame existed; it stays empty until the next refresh
+            frames[name] = pd.DataFrame()
+            continue
+        source = pa.memory_map(path, 'r')
+        table = pa.ipc.open_file(source).read_all()
+        # split_blocks avoids consolidating columns so numeric data can stay on the mapped pages
+        frames[name] = table.to_pandas(split_blocks=True)
+    return frames
@@ -0,0 +1,312 @@
+import numpy as np
+import pandas as pd
+
+from crm_script_monthly import ltv_metrics, MONTHLY_COLUMNS
+from crm_script_weekly import CUTOFF_DATE, WEEKLY_COLUMNS, week_label
+from cohorts import COHORT_COLUMNS
+from metric_params import metric_params
+from period_engine import breakdown_frame, DailyAggregates
+from salesforce_data import customer_mask
+
+
+# Out-of-core load: bookings arrive in chunks ordered by visit date and each
+# chunk is folded into running aggregates, so only one chunk of bookings is
+# ever in memory. What is kept between chunks is per customer (first visit,
+# last period counted, last visit) and per period (customers and revenue),
+# never per booking.
+#
+# The visit date order is what makes one pass enough: a customer's first
+# booking is the first one seen, a customer is counted in a period the first
+# time they show up in it, and the gap to the previous visit is the gap to the
+# last one seen. Results match the full load over the same bookings in visit
+# date order (the full load takes each new customer's "first" booking of the
+# month in fetch order); the daily aggregates behind the explorer are per
+# booking day and not kept.
+
+NO_PERIOD = np.iinfo('int64').min
+DAY_US = 86_400 * 10 ** 6
+WEEK_US = 7 * DAY_US
+
+EMPTY_CUSTOMER_DAYS = ['day', 'email', 'visits', 'revenue', 'first_pos', 'first_visit_day',
+                       'first_visit_at', 'last_visit_at', 'first_value']
+
+
+def _micros(dates):
+    # Microseconds since the epoch as int64; NaT becomes NO_PERIOD
+    return dates.to_numpy().astype('datetime64[us]').astype('int64')
+
+
+def _first_rows(keys, keep='first'):
+    # True on the first (or last) row of every distinct key
+    return ~pd.Series(keys).duplicated(keep=keep).to_numpy()
+
+
+def _add(total, keys, weights=None):
+    # Running per-key sums; keys is an array or a list of arrays (one per index level)
+    if weights is None:
+        weights = np.ones(len(keys[0]) if isinstance(keys, list) else len(keys), dtype='int64')
+    part = pd.Series(weights).groupby(keys).sum()
+    return part if total is None else total.add(part, fill_value=0)
+
+
+class _PeriodFold:
+    """ Running new/returning breakdown over one integer period key (months or week ordinals) """
+
+    def __init__(self, new_revenue):
+        # 'first': each new customer's first priced booking of their first period, 'all': every booking in it
+        self.new_revenue = new_revenue
+        self.first_period = np.empty(0, dtype='int64')
+        self.last_period = np.empty(0, dtype='int64')
+        self.unpriced = np.empty(0, dtype=bool)
+        self.totals = dict.fromkeys(('total_customers', 'new_customers', 'customer_revenue',
+                                     'new_revenue', 'total_revenue'))
+
+    def _grow(self, customers):
+        extra = customers - len(self.first_period)
+        if extra > 0:
+            extra = max(extra, len(self.first_period))
+            self.first_period = np.concatenate([self.first_period, np.full(extra, NO_PERIOD)])
+            self.last_period = np.concatenate([self.last_period, np.full(extra, NO_PERIOD)])
+            self.unpriced = np.concatenate([self.unpriced, np.zeros(extra, dtype=bool)])
+
+    def fold(self, codes, periods, values):
+        """ Folds customer bookings in visit date order; returns (rows that count a customer in a period, first periods) """
+        totals = self.totals
+        if len(codes) == 0:
+            return np.zeros(0, dtype=bool), periods
+        self._grow(int(codes.max()) + 1)
+
+        new = _first_rows(codes) & (self.first_period[codes] == NO_PERIOD)
+        self.first_period[codes[new]] = periods[new]
+        self.unpriced[codes[new]] = True
+        first = self.first_period[codes]
+
+        # A customer counts once per period: on their first row of it, unless an earlier chunk already counted them
+        span = int(periods.max() - periods.min()) + 1
+        counted = _first_rows(codes * span + (periods - periods.min())) & (periods != self.last_period[codes])
+        last = _first_rows(codes, keep='last')
+        self.last_period[codes[last]] = periods[last]
+
+        is_new = periods == first
+        totals['total_customers'] = _add(totals['total_customers'], periods[counted])
+        totals['new_customers'] = _add(totals['new_customers'], periods[counted & is_new])
+        totals['customer_revenue'] = _add(totals['customer_revenue'], periods, values)
+
+        if self.new_revenue == 'all':
+            totals['new_revenue'] = _add(totals['new_revenue'], periods[is_new], values[is_new])
+        else:
+            candidates = np.flatnonzero(is_new & ~np.isnan(values) & self.unpriced[codes])
+            firsts = candidates[_first_rows(codes[candidates])]
+            totals['new_revenue'] = _add(totals['new_revenue'], periods[firsts], values[firsts])
+            self.unpriced[codes[firsts]] = False
+        return counted, first
+
+    def fold_original(self, periods, values):
+        self.totals['total_revenue'] = _add(self.totals['total_revenue'], periods, values)
+
+    def series(self):
+        """ The per-period totals aligned on the periods with customers """
+        totals = self.totals
+        if totals['total_customers'] is None:
+            periods = pd.Index([], dtype='int64')
+        else:
+            periods = totals['total_customers'].index
+        aligned = {}
+        for name, total in totals.items():
+            total = pd.Series(dtype='float64') if total is None else total
+            aligned[name] = total.reindex(periods, fill_value=0)
+        for name in ('total_customers', 'new_customers'):
+            aligned[name] = aligned[name].astype('int64')
+        return periods, aligned
+
+
+class StreamingAggregates:
+    """ Folds booking_frame() chunks (in visit date order) into the load_data() metrics """
+
+    def __init__(self, params=None):
+        self.params = params or metric_params()
+        # Email -> customer number, the only per-customer state that is not a numpy array
+        self._customer_numbers = {}
+        self.monthly = _PeriodFold('first')
+        self.weekly = _PeriodFold('all')
+        self._cohort_customers = None
+        self._cohort_revenue = None
+        self._last_visit = np.empty(0, dtype='int64')
+        self._latest = NO_PERIOD
+        self.rows = 0
+        self.customer_rows = 0
+        self.customer_revenue = 0.0
+        self.gap_days = 0
+        self.gaps = 0
+        # Weekly bins are anchored on the first customer visit from the cutoff on
+        self._cutoff = _micros(pd.DatetimeIndex([pd.to_datetime(CUTOFF_DATE)]))[0]
+        self._anchor = None
+        self._week_zero = None
+        self._last_customer_visit = NO_PERIOD
+        # Bookings whose week is not known yet: before the anchor is found, or after the last customer visit so far
+        self._pending_before = (np.empty(0, dtype='int64'), np.empty(0))
+        self._pending_after = (np.empty(0, dtype='int64'), np.empty(0))
+
+    def _customer_codes(self, emails):
+        emails = emails.astype('category').cat.remove_unused_categories()
+        lookup = self._customer_numbers
+        numbers = np.array([lookup.setdefault(email, len(lookup)) for email in emails.cat.categories], dtype='int64')
+        return numbers[emails.cat.codes.to_numpy()]
+
+    def fold(self, chunk):
+        """ Folds one chunk of bookings; chunks must not go back in visit date """
+        visit_date = pd.to_datetime(chunk['visit_date'], errors='coerce')
+        if visit_date.dt.tz is not None:
+            visit_date = visit_date.dt.tz_localize(None)
+        times = _micros(visit_date)
+        values = chunk['purchase_value'].to_numpy(dtype='float64')
+        valid = times != NO_PERIOD
+
+        order = np.argsort(np.where(valid, times, np.iinfo('int64').max), kind='stable')
+        times, values, valid = times[order], values[order], valid[order]
+        is_customer = customer_mask(chunk, self.params.excluded_emails)[order]
+        if valid.any():
+            if times[valid][0] < self._latest:
+                raise ValueError("Streamed bookings must arrive in visit date order; "
+                                 "a chunk starts before the end of the previous one")
+            self._latest = times[valid][-1]
+        self.rows += len(times)
+
+        months = times.astype('datetime64[us]').astype('datetime64[M]').astype('int64')
+        self.monthly.fold_original(months[valid], values[valid])
+
+        codes = self._customer_codes(chunk['email'].take(order[is_customer]))
+        customer_times, customer_values = times[is_customer], values[is_customer]
+        self.customer_rows += len(codes)
+        self.customer_revenue += np.nansum(customer_values)
+
+        dated = valid[is_customer]
+        codes, customer_times, customer_values = codes[dated], customer_times[dated], customer_values[dated]
+        self._fold_months(codes, months[is_customer][dated], customer_values)
+        self._fold_gaps(codes, customer_times)
+        self._fold_weeks(codes, customer_times, customer_values, times[valid], values[valid])
+
+    def _fold_months(self, codes, months, values):
+        counted, first_months = self.monthly.fold(codes, months, values)
+        # Cohort cells: (first visit month, months since it)
+        offsets = months - first_months
+        self._cohort_customers = _add(self._cohort_customers, [first_months[counted], offsets[counted]])
+        self._cohort_revenue = _add(self._cohort_revenue, [first_months, offsets], values)
+
+    def _fold_gaps(self, codes, times):
+        # Days between consecutive visits of a customer, continuing from their last visit in earlier chunks
+        if len(codes) == 0:
+            return
+        extra = int(codes.max()) + 1 - len(self._last_visit)
+        if extra > 0:
+            self._last_visit = np.concatenate([self._last_visit, np.full(max(extra, len(self._last_visit)), NO_PERIOD)])
+        order = np.lexsort((times, codes))
+        codes, times = codes[order], times[order]
+        same = codes[1:] == codes[:-1]
+        gaps = (times[1:] - times[:-1])[same] // DAY_US
+
+        starts = np.r_[True, ~same]
+        previous = self._last_visit[codes[starts]]
+        seen = previous != NO_PERIOD
+        carried = (times[starts][seen] - previous[seen]) // DAY_US
+
+        self.gap_days += int(gaps.sum()) + int(carried.sum())
+        self.gaps += len(gaps) + len(carried)
+        ends = np.r_[~same, True]
+        self._last_visit[codes[ends]] = times[ends]
+
+    def _week_ordinals(self, times):
+        # Week of the weekly report: 0 from a day before the anchor, then Monday to Monday at the anchor's time of day
+        ordinals = np.maximum((times - self._week_zero) // WEEK_US, 0)
+        ordinals[times < self._anchor - DAY_US] = -1
+        return ordinals
+
+    def _fold_weeks(self, codes, times, values, original_times, original_values):
+        after_cutoff = times >= self._cutoff
+        codes, times, values = codes[after_cutoff], times[after_cutoff], values[after_cutoff]
+        in_range = original_times >= self._cutoff
+        original_times = np.concatenate([self._pending_before[0], self._pending_after[0], original_times[in_range]])
+        original_values = np.concatenate([self._pending_before[1], self._pending_after[1], original_values[in_range]])
+
+        if self._anchor is None:
+            if len(times) == 0:
+                # Only bookings within a day of the (still unknown) anchor can fall in its first week
+                if len(original_times):
+                    keep = original_times >= original_times.max() - DAY_US
+                    original_times, original_values = original_times[keep], original_values[keep]
+                self._pending_before = (original_times, original_values)
+                return
+            self._anchor = times[0]
+            anchor = pd.Timestamp(self._anchor, unit='us')
+            self._week_zero = _micros(pd.date_range(start=anchor, periods=1, freq='W-MON'))[0]
+            self._pending_before = (np.empty(0, dtype='int64'), np.empty(0))
+
+        if len(times):
+            self._last_customer_visit = times[-1]
+            self.weekly.fold(codes, self._week_ordinals(times), values)
+
+        # The last week ends a day after the last customer visit, which later chunks can still move
+        known = original_times < self._last_customer_visit + DAY_US
+        self._pending_after = (original_times[~known], original_values[~known])
+        original_times, original_values = original_times[known], original_values[known]
+        weeks = self._week_ordinals(original_times)
+        self.weekly.fold_original(weeks[weeks >= 0], original_values[weeks >= 0])
+
+    def result(self):
+        """ The load_data() result of everything folded so far """
+        periods, monthly = self.monthly.series()
+        months = pd.PeriodIndex.from_ordinals(periods.to_numpy(dtype='int64'), freq='M').rename('month')
+        monthly_df = breakdown_frame('month', months, monthly['total_customers'], monthly['new_customers'],
+                                     monthly['total_revenue'], monthly['customer_revenue'], monthly['new_revenue'])
+        if monthly_df.empty:
+            monthly_df = pd.DataFrame(columns=MONTHLY_COLUMNS)
+
+        avg_days_between_visits = self.gap_days / self.gaps if self.gaps else 1
+        return {
+            'monthly_breakdown': monthly_df,
+            **ltv_metrics(self.customer_revenue, len(self._customer_numbers), self.customer_rows,
+                          avg_days_between_visits, self.params.churn_threshold_days),
+            'weekly_breakdown': self._weekly_result(),
+            'daily_aggregates': DailyAggregates(customer_days=pd.DataFrame(columns=EMPTY_CUSTOMER_DAYS),
+                                                day_totals=pd.DataFrame(columns=['day', 'revenue'])),
+            'cohort_activity': self._cohort_result(),
+        }
+
+    def _weekly_result(self):
+        if self._anchor is None or self._last_customer_visit < self._week_zero:
+            # No Monday between the first and the last visit: the weekly report has no week
+            return pd.DataFrame(columns=WEEKLY_COLUMNS)
+        # Bookings after the last customer visit count up to a day after it
+        pending_times, pending_values = self._pending_after
+        last = pending_times < self._last_customer_visit + DAY_US
+        weeks = self._week_ordinals(pending_times[last])
+        weekly = _PeriodFold('all')
+        weekly.totals = dict(self.weekly.totals)
+        weekly.fold_original(weeks, pending_values[last])
+
+        weeks, totals = weekly.series()
+        week_zero = pd.Timestamp(self._week_zero, unit='us')
+        labels = [week_label(week_zero + pd.Timedelta(weeks=int(week))) for week in weeks]
+        return breakdown_frame('week', labels, totals['total_customers'], totals['new_customers'],
+                               totals['total_revenue'], totals['customer_revenue'], totals['new_revenue'])
+
+    def _cohort_result(self):
+        if self._cohort_customers is None or self._cohort_customers.empty:
+            return pd.DataFrame(columns=COHORT_COLUMNS)
+        customers = self._cohort_customers[self._cohort_customers > 0].sort_index()
+        revenue = self._cohort_revenue.reindex(customers.index, fill_value=0)
+        first_months = customers.index.get_level_values(0).to_numpy(dtype='int64')
+        return pd.DataFrame({
+            'cohort': pd.PeriodIndex.from_ordinals(first_months, freq='M').astype(str),
+            'months_since_first': customers.index.get_level_values(1).to_numpy().astype('int32'),
+            'customers': customers.to_numpy().astype('int64'),
+            'revenue': revenue.to_numpy(dtype='float64'),
+        }, columns=COHORT_COLUMNS)
+
+
+def stream_metrics(chunks, params=None):
+    """ load_data() result of an iterable of booking_frame() chunks in visit date order """
+    aggregates = StreamingAggregates(params)
+    for chunk in chunks:
+        aggregates.fold(chunk)
+    return aggregates.result()
@@ -0,0 +1,103 @@
+import pandas as pd
+
+
+# Backend paging, sorting and filtering for DataTables with
+# page_action/sort_action/filter_action='custom'. Only the requested page is
+# formatted and sent to the browser.
+
+PAGE_SIZE = 25
+
+OPERATORS = [['ge ', '>='],
+             ['le ', '<='],
+             ['lt ', '<'],
+             ['gt ', '>'],
+             ['ne ', '!='],
+             ['eq ', '='],
+             ['contains '],
+             ['datestartswith ']]
+
+
+def split_filter_part(filter_part):
+    """ Splits one '{column} op value' clause of a DataTable filter_query """
+    for operator_type in OPERATORS:
+        for operator in operator_type:
+            if operator not in filter_part:
+                continue
+            name_part, value_part = filter_part.split(operator, 1)
+            name = name_part[name_part.find('{') + 1: name_part.rfind('}')]
+
+            value_part = value_part.strip()
+            v0 = value_part[0] if value_part else ''
+            if v0 and v0 == value_part[-1] and v0 in ("'", '"', '`'):
+                value = value_part[1: -1].replace('\\' + v0, v0)
+            elif operator_type[0] in ('contains ', 'datestartswith '):
+                # Text matches keep the value as typed ('2024' must not become '2024.0')
+                value = value_part
+            else:
+                try:
+                    value = float(value_part)
+                except ValueError:
+                    value = value_part
+
+            # word operators need spaces after them in the filter string,
+            # but we don't want these later
+            return name, operator_type[0].strip(), value
+
+    return None, None, None
+
+
+def filter_frame(df, filter_query):
+    if not filter_query:
+        return df
+
+    for filter_part in filter_query.split(' && '):
+        col_name, operator, filter_value = split_filter_part(filter_part)
+        if col_name not in df.columns:
+            continue
+        column = df[col_name]
+        if operator in ('eq', 'ne', 'lt', 'le', 'gt', 'ge'):
+            if isinstance(filter_value, str) and pd.api.types.is_numeric_dtype(column):
+                continue
+            df = df.loc[getattr(column, operator)(filter_value)]
+        elif operator == 'contains':
+            df = df.loc[column.astype(str).str.contains(str(filter_value), regex=False)]
+        elif operator == 'datestartswith':
+            df = df.loc[column.astype(str).str.startswith(str(filter_value))]
+
+    return df
+
+
+def sort_frame(df, sort_by, order_columns=()):
+    """ Applies DataTable sort_by; order_columns keep their chronological row order instead of sorting as text """
+    if not sort_by:
+        return df
+
+    keys = []
+    ascending = []
+    for sort in sort_by:
+        if sort['column_id'] not in df.columns:
+            continue
+        keys.append(sort['column_id'])
+        ascending.append(sort['direction'] == 'asc')
+    if not keys:
+        return df
+
+    positions = pd.Series(range(len(df)), index=df.index)
+    sort_keys = pd.DataFrame({
+        key: positions if key in order_columns else df[key] for key in keys
+    }, index=df.index)
+    order = sort_keys.sort_values(keys, ascending=ascending, kind='stable').index
+    return df.loc[order]
+
+
+def query_page(df, page_current, page_size, sort_by, filter_query, order_columns=()):
+    """ Returns (records of the requested page, page_count) for a custom-paged DataTable """
+    page_size = page_size or PAGE_SIZE
+    page_current = page_current or 0
+
+    df = filter_frame(df, filter_query)
+    df = sort_frame(df, sort_by, order_columns)
+
+    page_count = max(1, -(-len(df) // page_size))
+    page = df.iloc[page_current * page_size: (page_current + 1) * page_size]
+    return page.round(2).astype(str).to_dict('records'), page_count
@@ -0,0 +1,118 @@
+import random
+
+import pandas as pd
+import pytest
+
+import aggregates
+import salesforce_data
+from bookings import bookings_from_frame, with_first_visits, BookingFrame
+from metric_params import metric_params
+from test_sync_bookings import StubSalesforce, booking
+
+
+WINDOW_END = pd.Timestamp('2024-04-01', tz='UTC')
+
+
+def random_booking(rng, booking_id, modstamp):
+    visit = pd.Timestamp('2023-09-01') + pd.Timedelta(minutes=rng.randrange(200 * 24 * 60))
+    email = rng.choice([f"c{rng.randrange(60)}@example.com"] * 12 + [None, '', 'hello@jungleworldpark.com'])
+    record = booking(booking_id, modstamp, visit=visit.strftime('%Y-%m-%dT%H:%M:%S.000+0000'),
+                     status=rng.choice(['Booked', 'Checked In', 'Cancelled', 'Refunded']),
+                     paid=rng.choice([None, round(rng.uniform(5, 80), 2)]), email=email or 'x')
+    record['Bnow__Customer_Email__c'] = email
+    if rng.random() < 0.05:
+        record['Bnow__Customer_ID__c'] = None
+    return record
+
+
+def load(client, store_path, directory, window_end):
+    results = salesforce_data.get_data_incremental(client, store_path)
+    frame = salesforce_data.booking_frame(results)
+    # As in pipeline.load_site(): first visits come from the metric state
+    bookings = bookings_from_frame(frame, salesforce_data.customer_mask(frame), first_visits=False)
+    return bookings, aggregates.update_metrics(bookings, results, directory)
+
+
+def assert_state_matches_full_build(directory, bookings):
+    state = aggregates.load_state(directory)
+    assert aggregates.verify_state(state, bookings) == []
+    return state
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_incremental_state_matches_a_full_build(tmp_path, monkeypatch, seed):
+    rng = random.Random(seed)
+    window_end = [WINDOW_END]
+    monkeypatch.setattr(salesforce_data, 'query_window', lambda: (salesforce_data.START_DATE, window_end[0]))
+    store_path, directory = str(tmp_path / 'bookings.parquet'), str(tmp_path / 'aggregates')
+
+    records = [random_booking(rng, f"b{i}", '2024-01-01T00:00:00.000+0000') for i in range(800)]
+    client = StubSalesforce(records)
+    bookings, _ = load(client, store_path, directory, window_end)
+    assert_state_matches_full_build(directory, bookings)
+
+    for sync in range(6):
+        modstamp = f"2024-02-{10 + sync:02d}T00:00:00.000+0000"
+        for _ in range(25):
+            index = rng.randrange(len(records))
+            change = rng.random()
+            if change < 0.5:
+                # Anything about a booking can change, including its customer and day
+                records[index] = random_booking(rng, records[index]['Id'], modstamp)
+            elif change < 0.65:
+                records[index] = {**records[index], 'SystemModstamp': modstamp, 'IsDeleted': True}
+            else:
+                records.append(random_booking(rng, f"n{sync}-{len(records)}", modstamp))
+        # The window moves on by a day now and then; bookings already stored enter it
+        window_end[0] += pd.Timedelta(days=sync % 2)
+        bookings, data = load(client, store_path, directory, window_end)
+        state = assert_state_matches_full_build(directory, bookings)
+        assert data['daily_aggregates'].customer_days['visits'].sum() == len(bookings.customers)
+        assert len(state.customers) == bookings.customers['email'].nunique()
+
+
+def test_state_outputs_match_the_full_load(tmp_path, monkeypatch):
+    from cohorts import cohort_activity
+    from crm_script_monthly import monthly_breakdown
+    from crm_script_weekly import weekly_breakdown
+    from period_engine import daily_aggregates, period_breakdown
+
+    rng = random.Random(7)
+    monkeypatch.setattr(salesforce_data, 'query_window', lambda: (salesforce_data.START_DATE, WINDOW_END))
+    store_path, directory = str(tmp_path / 'bookings.parquet'), str(tmp_path / 'aggregates')
+    records = [random_booking(rng, f"b{i}", '2024-01-01T00:00:00.000+0000') for i in range(500)]
+    client = StubSalesforce(records)
+    load(client, store_path, directory, WINDOW_END)
+    records += [random_booking(rng, f"n{i}", '2024-02-01T00:00:00.000+0000') for i in range(30)]
+    bookings, data = load(client, store_path, directory, WINDOW_END)
+    bookings = BookingFrame(customers=with_first_visits(bookings.customers), original=bookings.original)
+
+    monthly = monthly_breakdown(bookings)
+    pd.testing.assert_frame_equal(data['monthly_breakdown'], monthly['monthly_breakdown'], check_dtype=False)
+    for name, value in monthly.items():
+        if name != 'monthly_breakdown':
+            assert data[name] == pytest.approx(value)
+    pd.testing.assert_frame_equal(data['weekly_breakdown'], weekly_breakdown(bookings), check_dtype=False)
+    pd.testing.assert_frame_equal(data['cohort_activity'], cohort_activity(bookings), check_dtype=False)
+    for granularity in ('day', 'week', 'month'):
+        for new_revenue in ('first', 'all'):
+            pd.testing.assert_frame_equal(period_breakdown(data['daily_aggregates'], granularity, new_revenue=new_revenue),
+                                          period_breakdown(daily_aggregates(bookings), granularity,
+                                                           new_revenue=new_revenue),
+                                          check_dtype=False)
+
+
+def test_changed_parameters_rebuild_the_state(tmp_path, monkeypatch):
+    rng = random.Random(3)
+    monkeypatch.setattr(salesforce_data, 'query_window', lambda: (salesforce_data.START_DATE, WINDOW_END))
+    store_path, directory = str(tmp_path / 'bookings.parquet'), str(tmp_path / 'aggregates')
+    client = StubSalesforce([random_booking(rng, f"b{i}", '2024-01-01T00:00:00.000+0000') for i in range(200)])
+    load(client, store_path, directory, WINDOW_END)
+    assert aggregates.load_state(directory).params == metric_params()
+
+    # Read when the load runs, not when the modules were imported
+    monkeypatch.setenv('SF_EXCLUDED_EMAILS', 'c1@example.com')
+    bookings, _ = load(client, store_path, directory, WINDOW_END)
+    state = assert_state_matches_full_build(directory, bookings)
+    assert state.params.excluded_emails == ('c1@example.com',)
+    assert 'c1@example.com' not in set(state.customers['email'])
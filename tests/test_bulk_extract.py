@@ -0,0 +1,129 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pandas as pd
+import pytest
+import requests
+
+import bulk_extract
+
+
+JOB_ID = '750000000000001'
+HEADER = ','.join(bulk_extract.BOOKING_COLUMN_TYPES)
+# Results pages keyed on the locator that fetches them; each names the next one
+PAGES = {
+    None: ('p2', [
+        'b1,a@example.com,2024-01-05T10:00:00.000Z,10.5,Booked,C1,2024-01-05T10:00:00.000Z',
+        'b2,,2024-01-06T11:30:00.000Z,,Cancelled,,2024-01-06T11:30:00.000Z',
+    ]),
+    'p2': ('p3', [
+        'b3,"b,c@example.com",2024-02-01T09:00:00.000Z,7,Checked In,C3,2024-02-01T09:00:00.000Z',
+    ]),
+    'p3': ('null', []),
+}
+
+
+class BulkHandler(BaseHTTPRequestHandler):
+    """ The Bulk API 2.0 query endpoints: create a job, poll it, page through its CSV results """
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body, content_type='application/json', headers=None):
+        body = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.server.requests.append(('POST', self.path, self.headers.get('Authorization')))
+        job = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self.server.jobs.append(job)
+        self._send(200, json.dumps({'id': JOB_ID, 'state': 'UploadComplete'}))
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        self.server.requests.append(('GET', self.path, self.headers.get('Authorization')))
+        if url.path == f'/jobs/query/{JOB_ID}':
+            self.server.polls += 1
+            state = 'InProgress' if self.server.polls < 2 else 'JobComplete'
+            self._send(200, json.dumps({'id': JOB_ID, 'state': state}))
+        elif url.path == f'/jobs/query/{JOB_ID}/results':
+            params = parse_qs(url.query)
+            locator, rows = PAGES[params.get('locator', [None])[0]]
+            body = '\n'.join([HEADER] + rows) + '\n' if rows else ''
+            self._send(200, body, 'text/csv', {'Sforce-Locator': locator, 'Sforce-NumberOfRecords': str(len(rows))})
+        else:
+            self._send(404, '{}')
+
+
+@pytest.fixture
+def bulk_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), BulkHandler)
+    server.requests, server.jobs, server.polls = [], [], 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+class Client:
+    session_id = 'token'
+
+    def __init__(self):
+        self.session = requests.Session()
+
+
+def test_query_bookings_runs_job_polls_and_follows_locators(bulk_server, monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(bulk_extract.time, 'sleep', sleeps.append)
+    base_url = f'http://127.0.0.1:{bulk_server.server_address[1]}/'
+
+    df = bulk_extract.query_bookings(Client(), 'SELECT Id FROM Bnow__Booking__c', include_deleted=True,
+                                     base_url=base_url)
+
+    assert bulk_server.jobs == [{'operation': 'queryAll', 'query': 'SELECT Id FROM Bnow__Booking__c',
+                                 'contentType': 'CSV', 'columnDelimiter': 'COMMA', 'lineEnding': 'LF'}]
+    # Polled until complete, sleeping between polls
+    assert bulk_server.polls == 2
+    assert sleeps == [bulk_extract.POLL_INTERVAL_SECONDS]
+    results = [path for method, path, _ in bulk_server.requests if '/results' in path]
+    assert len(results) == 3
+    assert 'locator=p2' in results[1] and 'locator=p3' in results[2]
+    assert all(auth == 'Bearer token' for _, _, auth in bulk_server.requests)
+
+    assert list(df.columns) == list(bulk_extract.BOOKING_COLUMN_TYPES)
+    assert list(df['Id']) == ['b1', 'b2', 'b3']
+    assert df['Bnow__Customer_Email__c'].isna().tolist() == [False, True, False]
+    assert df.loc[2, 'Bnow__Customer_Email__c'] == 'b,c@example.com'
+    assert df['Bnow__Balance_Paid__c'].iloc[[0, 2]].tolist() == [10.5, 7.0]
+    assert pd.isna(df.loc[1, 'Bnow__Balance_Paid__c'])
+    assert df.loc[0, 'Bnow__All_Products_Processed__c'] == pd.Timestamp('2024-01-05T10:00:00', tz='UTC')
+
+
+def test_empty_result_keeps_the_columns(bulk_server, monkeypatch):
+    monkeypatch.setattr(bulk_extract.time, 'sleep', lambda seconds: None)
+    monkeypatch.setitem(PAGES, None, ('null', []))
+    base_url = f'http://127.0.0.1:{bulk_server.server_address[1]}'
+
+    df = bulk_extract.query_bookings(Client(), 'SELECT Id FROM Bnow__Booking__c', base_url=base_url)
+
+    assert bulk_server.jobs[0]['operation'] == 'query'
+    assert df.empty
+    assert list(df.columns) == list(bulk_extract.BOOKING_COLUMN_TYPES)
+
+
+def test_failed_job_raises(bulk_server, monkeypatch):
+    monkeypatch.setattr(BulkHandler, 'do_GET', lambda handler: handler._send(
+        200, json.dumps({'id': JOB_ID, 'state': 'Failed', 'errorMessage': 'INVALID_FIELD'})))
+    base_url = f'http://127.0.0.1:{bulk_server.server_address[1]}'
+
+    with pytest.raises(bulk_extract.BulkQueryError, match='INVALID_FIELD'):
+        bulk_extract.query_bookings(Client(), 'SELECT Id FROM Bnow__Booking__c', base_url=base_url)
@@ -0,0 +1,91 @@
+import copy
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import pytest
+from dash import Patch
+
+from chart_data import chart_series, series_update, BLOCK_ROWS
+
+
+def snapshot(months, weeks, seed=0):
+    rng = np.random.default_rng(seed)
+    return SimpleNamespace(
+        monthly_df=pd.DataFrame({'month': [f"M{i}" for i in range(months)],
+                                 'total_revenue': rng.uniform(0, 100, months).round(2)}),
+        weekly_df=pd.DataFrame({'week': [f"W{i}" for i in range(weeks)],
+                                'new_revenue': rng.uniform(0, 100, weeks).round(2)}),
+    )
+
+
+def apply_patch(data, patch):
+    """ What the browser does with a Patch sent to a dcc.Store """
+    data = copy.deepcopy(data)
+    for operation in patch.to_plotly_json()['operations']:
+        *path, last = operation['location']
+        target = data
+        for key in path:
+            target = target[key]
+        value = operation['params']['value']
+        if operation['operation'] == 'Assign':
+            target[last] = value
+        elif operation['operation'] == 'Extend':
+            target[last].extend(value)
+        else:
+            raise AssertionError(f"Unexpected operation {operation['operation']}")
+    return data
+
+
+def browser_after(old, new):
+    # The browser store after a refresh from snapshot `old` to `new`
+    held, digests = series_update(chart_series(old), None)
+    update, _ = series_update(chart_series(new), digests)
+    return update, (apply_patch(held, update) if isinstance(update, Patch) else update)
+
+
+def test_the_first_update_is_the_whole_series():
+    new = snapshot(10, 40)
+    update, digests = series_update(chart_series(new), None)
+    assert update == chart_series(new)
+    assert digests['weekly']['week'][0] == 40
+
+
+def test_an_unchanged_series_sends_nothing():
+    update, _ = browser_after(snapshot(10, 40), snapshot(10, 40))
+    assert update is None
+
+
+def test_an_appended_row():
+    old = snapshot(10, 4 * BLOCK_ROWS)
+    new = snapshot(10, 4 * BLOCK_ROWS + 1)
+    new.weekly_df = pd.concat([old.weekly_df, new.weekly_df.tail(1)], ignore_index=True)
+    update, held = browser_after(old, new)
+
+    assert isinstance(update, Patch)
+    assert held == chart_series(new)
+    # Only the new week travels
+    assert len(update.to_plotly_json()['operations']) == 2
+
+
+@pytest.mark.parametrize('row', [1, 3 * BLOCK_ROWS + 2])
+def test_an_edited_row(row):
+    old = snapshot(10, 4 * BLOCK_ROWS)
+    new = snapshot(10, 4 * BLOCK_ROWS)
+    new.weekly_df = old.weekly_df.copy()
+    new.weekly_df.loc[row, 'new_revenue'] += 1
+    update, held = browser_after(old, new)
+
+    assert isinstance(update, Patch)
+    assert held == chart_series(new)
+
+
+def test_a_shrinking_series():
+    old = snapshot(12, 4 * BLOCK_ROWS)
+    new = snapshot(12, 4 * BLOCK_ROWS)
+    new.monthly_df = old.monthly_df.head(9)
+    new.weekly_df = old.weekly_df.head(3 * BLOCK_ROWS)
+    update, held = browser_after(old, new)
+
+    assert isinstance(update, Patch)
+    assert held == chart_series(new)
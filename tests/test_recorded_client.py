@@ -0,0 +1,70 @@
+import json
+import os
+
+import pytest
+
+import recorded_client
+
+
+SOQL = """SELECT Id, Bnow__Customer_Email__c
+          FROM Bnow__Booking__c
+          WHERE Bnow__All_Products_Processed__c >= 2023-08-28T00:00:00+00:00"""
+
+
+class StubSalesforce:
+    """ query/query_more/query_all returning canned pages; counts the calls """
+
+    def __init__(self):
+        self.calls = 0
+        self.session = object()
+
+    def query_all(self, query, include_deleted=False, **kwargs):
+        self.calls += 1
+        return {'totalSize': 1, 'done': True, 'records': [{'Id': 'b1', 'deleted': include_deleted}]}
+
+    def query(self, query, include_deleted=False, **kwargs):
+        self.calls += 1
+        return {'totalSize': 2, 'done': False, 'nextRecordsUrl': '/next/1', 'records': [{'Id': 'b1'}]}
+
+    def query_more(self, next_records_identifier, identifier_is_url=False, include_deleted=False, **kwargs):
+        self.calls += 1
+        return {'totalSize': 2, 'done': True, 'records': [{'Id': 'b2'}]}
+
+
+def test_recorded_responses_replay_without_a_client(tmp_path):
+    directory = str(tmp_path)
+    live = StubSalesforce()
+    recording = recorded_client.wrap_client(lambda: live, source='record', directory=directory)
+    recorded = [
+        recording.query_all(SOQL),
+        recording.query_all(SOQL, include_deleted=True),
+        recording.query(SOQL),
+        recording.query_more('/next/1', identifier_is_url=True),
+    ]
+    assert recording.session is live.session
+
+    def connect():
+        raise AssertionError("replay must not connect")
+    replay = recorded_client.wrap_client(connect, source='replay', directory=directory)
+    # The key ignores SOQL layout, so a reformatted query is the same call
+    assert replay.query_all(' '.join(SOQL.split())) == recorded[0]
+    assert replay.query_all(SOQL, include_deleted=True) == recorded[1]
+    assert replay.query(SOQL) == recorded[2]
+    assert replay.query_more('/next/1', identifier_is_url=True) == recorded[3]
+    assert live.calls == 4
+
+    with pytest.raises(recorded_client.MissingRecordingError):
+        replay.query_more('/next/1')
+
+
+def test_a_recording_keeps_the_clock_of_its_first_call(tmp_path):
+    directory = str(tmp_path)
+    with pytest.raises(recorded_client.MissingRecordingError):
+        recorded_client.now(directory, source='replay')
+
+    first = recorded_client.now(directory, source='record')
+    assert recorded_client.now(directory, source='record') == first
+    assert recorded_client.now(directory, source='replay') == first
+    assert os.listdir(directory) == [recorded_client.CLOCK_FILE]
+    with open(os.path.join(directory, recorded_client.CLOCK_FILE)) as f:
+        assert json.load(f) == {'now': first.isoformat()}
@@ -0,0 +1,114 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import result_cache
+from metric_params import MetricParams
+from period_engine import DailyAggregates
+from result_cache import ResultCache, result_key
+
+
+def result(value):
+    return {
+        'monthly_breakdown': pd.DataFrame({'month': ['2024-01', '2024-02'], 'total_revenue': [value, value + 1.0]}),
+        'Basic LTV': np.float64(value),
+        'daily_aggregates': DailyAggregates(customer_days=pd.DataFrame({'day': pd.to_datetime(['2024-01-01']),
+                                                                        'visits': [1]}),
+                                            day_totals=pd.DataFrame({'day': pd.to_datetime(['2024-01-01']),
+                                                                     'revenue': [value]})),
+    }
+
+
+def assert_same(cached, expected):
+    pd.testing.assert_frame_equal(cached['monthly_breakdown'], expected['monthly_breakdown'])
+    assert cached['Basic LTV'] == expected['Basic LTV']
+    pd.testing.assert_frame_equal(cached['daily_aggregates'].day_totals, expected['daily_aggregates'].day_totals)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1_000_000.0]
+    monkeypatch.setattr(result_cache.time, 'time', lambda: now[0])
+    return now
+
+
+def test_memory_tier_evicts_the_least_recently_used(tmp_path, clock):
+    size = result_cache._result_bytes(result(1.0))
+    cache = ResultCache(str(tmp_path), ttl_seconds=60, memory_bytes=2 * size, disk_bytes=2 ** 30)
+    cache.put('a', result(1.0))
+    cache.put('b', result(2.0))
+    cache.get('a')
+    cache.put('c', result(3.0))
+
+    assert list(cache._memory) == ['a', 'c']
+    # Evicted from memory only; the disk tier still serves it
+    assert_same(cache.get('b'), result(2.0))
+    assert (cache.hits, cache.disk_hits, cache.misses) == (1, 1, 0)
+
+
+def test_disk_tier_prunes_the_least_recently_used(tmp_path, clock):
+    cache = ResultCache(str(tmp_path), ttl_seconds=60, memory_bytes=0, disk_bytes=2 ** 30)
+    cache.put('a', result(1.0))
+    size = result_cache._directory_bytes(os.path.join(str(tmp_path), 'a'))
+    cache.put('b', result(2.0))
+    cache.put('c', result(3.0))
+    for age, key in enumerate(['c', 'a', 'b']):
+        # Oldest use first: c, then a, then b
+        os.utime(os.path.join(str(tmp_path), key, 'meta.json'), (100 + age, 100 + age))
+
+    cache.disk_bytes = int(3.5 * size)
+    cache.put('d', result(4.0))
+
+    assert sorted(os.listdir(str(tmp_path))) == ['a', 'b', 'd']
+    assert ResultCache(str(tmp_path), ttl_seconds=60).get('c') is None
+
+
+def test_entries_expire_after_the_ttl(tmp_path, clock):
+    cache = ResultCache(str(tmp_path), ttl_seconds=60)
+    cache.put('a', result(1.0))
+    clock[0] += 30
+    assert_same(cache.get('a'), result(1.0))
+    assert_same(ResultCache(str(tmp_path), ttl_seconds=60).get('a'), result(1.0))
+
+    clock[0] += 31
+    assert cache.get('a') is None
+    assert not os.path.exists(os.path.join(str(tmp_path), 'a'))
+    assert cache.misses == 1
+
+
+def test_entries_of_another_format_are_rejected(tmp_path, clock, monkeypatch):
+    ResultCache(str(tmp_path)).put('a', result(1.0))
+    assert_same(ResultCache(str(tmp_path)).get('a'), result(1.0))
+
+    monkeypatch.setattr(result_cache, 'RESULT_FORMAT', result_cache.RESULT_FORMAT + 1)
+    assert ResultCache(str(tmp_path)).get('a') is None
+    assert not os.path.exists(os.path.join(str(tmp_path), 'a'))
+
+
+def test_stored_meta_records_the_format(tmp_path, clock):
+    ResultCache(str(tmp_path)).put('a', result(1.0))
+    with open(os.path.join(str(tmp_path), 'a', 'meta.json')) as f:
+        assert json.load(f)['format'] == result_cache.RESULT_FORMAT
+
+
+def test_result_key_ignores_row_order_and_follows_the_parameters():
+    rng = np.random.default_rng(0)
+    frame = pd.DataFrame({
+        'email': pd.Series([f"c{i % 7}@example.com" for i in range(50)], dtype='category'),
+        'visit_date': pd.Timestamp('2024-01-01') + pd.to_timedelta(rng.integers(0, 90, 50), unit='D'),
+        'purchase_value': rng.uniform(5, 80, 50),
+    })
+    params = MetricParams()
+    shuffled = frame.sample(frac=1, random_state=1).reset_index(drop=True)
+
+    assert result_key(shuffled, **params.as_dict()) == result_key(frame, **params.as_dict())
+    assert result_key(frame, **MetricParams(excluded_emails=tuple(reversed(params.excluded_emails))).as_dict()) == \
+        result_key(frame, **params.as_dict())
+    assert result_key(frame, **MetricParams(churn_threshold_days=90).as_dict()) != result_key(frame, **params.as_dict())
+    assert result_key(frame, **MetricParams(excluded_emails=('c1@example.com',)).as_dict()) != \
+        result_key(frame, **params.as_dict())
+    changed = frame.assign(purchase_value=frame['purchase_value'].where(frame.index != 3, 0.0))
+    assert result_key(changed, **params.as_dict()) != result_key(frame, **params.as_dict())
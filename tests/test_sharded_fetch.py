@@ -0,0 +1,92 @@
+import re
+from datetime import datetime
+
+import pandas as pd
+import pytest
+import requests
+from simple_salesforce.exceptions import SalesforceGeneralError, SalesforceMalformedRequest
+
+import sharded_fetch
+
+
+SELECT = "SELECT Id, Bnow__Booking__c.Bnow__All_Products_Processed__c FROM Bnow__Booking__c"
+START = datetime(2024, 1, 15)
+END = datetime(2024, 3, 10)
+
+
+class StubSalesforce:
+    """ query_all() answering each month shard with the records whose visit falls in its range """
+
+    def __init__(self, records, failures=()):
+        self.records = records
+        # Exceptions raised by the first calls, in order
+        self.failures = list(failures)
+        self.queries = []
+
+    def query_all(self, query, include_deleted=False, **kwargs):
+        self.queries.append(query)
+        if self.failures:
+            raise self.failures.pop(0)
+        lower = pd.Timestamp(re.search(r">= (\S+)", query).group(1))
+        upper_op, upper = re.search(r"(<=?) (\S+) AND", query).groups()
+        upper = pd.Timestamp(upper)
+        records = [record for record in self.records
+                   if record.get('always') or lower <= pd.Timestamp(record['visit'])
+                   and (pd.Timestamp(record['visit']) <= upper if upper_op == '<=' else pd.Timestamp(record['visit']) < upper)]
+        return {'totalSize': len(records), 'done': True, 'records': [dict(record) for record in records]}
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(sharded_fetch.time, 'sleep', lambda seconds: None)
+
+
+def fetch(client, max_workers=1):
+    return sharded_fetch.fetch_sharded(client, SELECT, "Bnow__Site_Name__c = 'x'", START, END, max_workers)
+
+
+def test_a_shard_that_fails_then_succeeds_is_retried():
+    client = StubSalesforce([{'Id': 'b1', 'visit': '2024-01-20'}],
+                            failures=[requests.ConnectionError('reset'),
+                                      SalesforceGeneralError('url', 503, 'query', b'unavailable')])
+    result = fetch(client)
+
+    assert [record['Id'] for record in result['records']] == ['b1']
+    assert result['shard_timings'][0]['attempts'] == 3
+    assert len(client.queries) == 3 + 2
+
+
+@pytest.mark.parametrize('error', [
+    SalesforceMalformedRequest('url', 400, 'query', b'MALFORMED_QUERY'),
+    SalesforceGeneralError('url', 404, 'query', b'not found'),
+])
+def test_errors_that_cannot_pass_on_a_retry_are_raised_at_once(error):
+    client = StubSalesforce([], failures=[error])
+    with pytest.raises(type(error)):
+        fetch(client)
+    assert client.queries.count(client.queries[0]) == 1
+
+
+def test_the_last_attempt_raises():
+    client = StubSalesforce([], failures=[requests.Timeout('slow')] * sharded_fetch.MAX_ATTEMPTS)
+    with pytest.raises(requests.Timeout):
+        fetch(client)
+    # The other shards still run; the failing one is tried MAX_ATTEMPTS times
+    assert client.queries.count(client.queries[0]) == sharded_fetch.MAX_ATTEMPTS
+
+
+def test_shards_cover_the_window_and_rows_dedup_on_id():
+    client = StubSalesforce([
+        {'Id': 'b1', 'visit': '2024-01-15'},
+        # On a month boundary: only the shard it starts belongs to
+        {'Id': 'b2', 'visit': '2024-02-01'},
+        {'Id': 'b3', 'visit': '2024-03-10'},
+        # Returned by every shard (e.g. moved while the shards ran)
+        {'Id': 'b4', 'visit': '2024-02-20', 'always': True},
+    ])
+    result = fetch(client, max_workers=3)
+
+    assert len(client.queries) == 3
+    assert sorted(record['Id'] for record in result['records']) == ['b1', 'b2', 'b3', 'b4']
+    assert result['totalSize'] == 4
+    assert [timing['rows'] for timing in result['shard_timings']] == [2, 2, 2]
@@ -0,0 +1,151 @@
+import re
+
+import pandas as pd
+import pytest
+
+import booking_store
+import salesforce_data
+
+
+class StubSalesforce:
+    """ query_all() over an in-memory list of booking records, honouring the SystemModstamp filter """
+
+    def __init__(self, records):
+        self.records = records
+        self.queries = []
+
+    def query_all(self, query, include_deleted=False, **kwargs):
+        self.queries.append((query, include_deleted))
+        records = [record for record in self.records if include_deleted or not record.get('IsDeleted')]
+        since = re.search(r"SystemModstamp >= (\S+)", query)
+        if since is not None:
+            records = [record for record in records
+                       if pd.Timestamp(record['SystemModstamp']) >= pd.Timestamp(since.group(1))]
+        return {'totalSize': len(records), 'done': True, 'records': [dict(record) for record in records]}
+
+
+def booking(booking_id, modstamp, visit='2024-01-05T10:00:00.000+0000', status='Booked', paid=10.0,
+            email='a@example.com', deleted=False):
+    return {
+        'Id': booking_id,
+        'Bnow__Customer_Email__c': email,
+        'Bnow__All_Products_Processed__c': visit,
+        'Bnow__Balance_Paid__c': paid,
+        'Bnow__Status__c': status,
+        'Bnow__Customer_ID__c': 'C-' + email,
+        'SystemModstamp': modstamp,
+        'IsDeleted': deleted,
+    }
+
+
+@pytest.fixture
+def store_path(tmp_path):
+    return str(tmp_path / 'bookings.parquet')
+
+
+def stored(store_path):
+    df, high_water_mark = booking_store.load_store(store_path)
+    return df.set_index('Id'), high_water_mark
+
+
+def test_first_sync_pulls_everything(store_path):
+    client = StubSalesforce([booking('b1', '2024-01-05T10:00:00.000+0000'),
+                             booking('b2', '2024-01-06T09:00:00.000+0000')])
+    merged, sync = salesforce_data.sync_bookings(client, store_path)
+
+    query, include_deleted = client.queries[0]
+    assert 'SystemModstamp >=' not in query
+    assert include_deleted
+    assert sorted(merged['Id']) == ['b1', 'b2']
+    assert 'IsDeleted' not in merged.columns
+    assert sync['previous_high_water_mark'] is None
+    assert sync['high_water_mark'] == '2024-01-06T09:00:00.000+0000'
+    assert stored(store_path)[1] == '2024-01-06T09:00:00.000+0000'
+
+
+def test_sync_merges_from_the_high_water_mark(store_path):
+    records = [booking('b1', '2024-01-05T10:00:00.000+0000'), booking('b2', '2024-01-06T09:00:00.000+0000')]
+    client = StubSalesforce(records)
+    salesforce_data.sync_bookings(client, store_path)
+
+    # Committed in the same second as the last pull, and one after it
+    records.append(booking('b3', '2024-01-06T09:00:00.000+0000'))
+    records.append(booking('b4', '2024-01-07T12:30:00.000+0000'))
+    merged, sync = salesforce_data.sync_bookings(client, store_path)
+
+    query, _ = client.queries[-1]
+    assert 'SystemModstamp >= 2024-01-06T09:00:00Z' in query
+    # b2 is read again (>=) and de-duplicated on Id
+    assert sorted(merged['Id']) == ['b1', 'b2', 'b3', 'b4']
+    assert sorted(sync['changed']['Id']) == ['b2', 'b2', 'b3', 'b4']
+    assert sync['previous_high_water_mark'] == '2024-01-06T09:00:00.000+0000'
+    assert sync['high_water_mark'] == '2024-01-07T12:30:00.000+0000'
+
+    df, high_water_mark = stored(store_path)
+    assert sorted(df.index) == ['b1', 'b2', 'b3', 'b4']
+    assert high_water_mark == '2024-01-07T12:30:00.000+0000'
+
+
+def test_updated_bookings_replace_the_stored_version(store_path):
+    records = [booking('b1', '2024-01-05T10:00:00.000+0000', paid=10.0),
+               booking('b2', '2024-01-05T11:00:00.000+0000', paid=20.0)]
+    client = StubSalesforce(records)
+    salesforce_data.sync_bookings(client, store_path)
+
+    records[0] = booking('b1', '2024-01-08T08:00:00.000+0000', paid=35.0, visit='2024-01-09T10:00:00.000+0000')
+    merged, sync = salesforce_data.sync_bookings(client, store_path)
+
+    assert len(merged) == 2
+    df, _ = stored(store_path)
+    assert df.loc['b1', 'Bnow__Balance_Paid__c'] == 35.0
+    assert df.loc['b1', 'Bnow__All_Products_Processed__c'] == '2024-01-09T10:00:00.000+0000'
+    assert df.loc['b2', 'Bnow__Balance_Paid__c'] == 20.0
+    # Both the new and the replaced version are reported as changed
+    changed = sync['changed'][sync['changed']['Id'] == 'b1']
+    assert sorted(changed['Bnow__Balance_Paid__c']) == [10.0, 35.0]
+
+
+def test_status_changes_are_kept_and_filtered_by_the_window(store_path, monkeypatch):
+    start = salesforce_data.START_DATE
+    monkeypatch.setattr(salesforce_data, 'query_window', lambda: (start, pd.Timestamp('2024-02-01', tz='UTC')))
+    records = [booking('b1', '2024-01-05T10:00:00.000+0000'), booking('b2', '2024-01-05T11:00:00.000+0000')]
+    client = StubSalesforce(records)
+    salesforce_data.get_data_incremental(client, store_path)
+
+    # Out of the reported statuses, and later back into them
+    records[0] = booking('b1', '2024-01-06T10:00:00.000+0000', status='Deleted By Admin')
+    results = salesforce_data.get_data_incremental(client, store_path)
+    assert list(results['records']['Id']) == ['b2']
+    df, _ = stored(store_path)
+    assert df.loc['b1', 'Bnow__Status__c'] == 'Deleted By Admin'
+
+    records[0] = booking('b1', '2024-01-07T10:00:00.000+0000', status='Checked In')
+    results = salesforce_data.get_data_incremental(client, store_path)
+    assert sorted(results['records']['Id']) == ['b1', 'b2']
+    assert results['totalSize'] == 2
+
+
+def test_deleted_bookings_leave_the_store(store_path):
+    records = [booking('b1', '2024-01-05T10:00:00.000+0000'), booking('b2', '2024-01-05T11:00:00.000+0000')]
+    client = StubSalesforce(records)
+    salesforce_data.sync_bookings(client, store_path)
+
+    records[1] = booking('b2', '2024-01-06T10:00:00.000+0000', deleted=True)
+    merged, sync = salesforce_data.sync_bookings(client, store_path)
+
+    assert list(merged['Id']) == ['b1']
+    assert list(stored(store_path)[0].index) == ['b1']
+    # The stored version of the deleted booking is reported, so its metrics can be taken out
+    assert sorted(sync['changed']['Id']) == ['b2', 'b2']
+    assert sync['high_water_mark'] == '2024-01-06T10:00:00.000+0000'
+
+
+def test_a_sync_without_changes_keeps_the_store(store_path):
+    client = StubSalesforce([booking('b1', '2024-01-05T10:00:00.000+0000')])
+    salesforce_data.sync_bookings(client, store_path)
+    client.records = []
+    merged, sync = salesforce_data.sync_bookings(client, store_path)
+
+    assert list(merged['Id']) == ['b1']
+    assert sync['changed'].empty
+    assert sync['high_water_mark'] == sync['previous_high_water_mark'] == '2024-01-05T10:00:00.000+0000'
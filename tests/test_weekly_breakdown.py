@@ -0,0 +1,160 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from crm_script_weekly import WEEKLY_COLUMNS, weekly_breakdown
+from salesforce_data import get_dataframe
+
+
+def legacy_weekly_breakdown(df, df_original):
+    """ The weekly report as first written: pd.cut week labels and a loop over the weeks """
+    df = df.copy()
+    df_original = df_original.copy()
+    df['visit_date'] = pd.to_datetime(df['visit_date'], errors='coerce').dt.tz_localize(None)
+    df_original['visit_date'] = pd.to_datetime(df_original['visit_date'], errors='coerce').dt.tz_localize(None)
+
+    cutoff = pd.to_datetime('2023-08-28')
+    df = df[df['visit_date'] >= cutoff]
+    df_original = df_original[df_original['visit_date'] >= cutoff]
+
+    email_min_dates = df.groupby('email', observed=True)['visit_date'].min().reset_index()
+    email_min_dates.rename(columns={'visit_date': 'first_visit_date'}, inplace=True)
+    df = pd.merge(df, email_min_dates, on='email', how='left')
+
+    start_date = df['visit_date'].min()
+    end_date = df['visit_date'].max()
+    week_starts = pd.date_range(start=start_date, end=end_date, freq='W-MON')
+    week_ends = week_starts + pd.Timedelta(days=6)
+    week_labels = [f"{s.strftime('%b %d, %Y')} - {e.strftime('%b %d, %Y')}" for s, e in zip(week_starts, week_ends)]
+    bins = [start_date - pd.Timedelta(days=1)] + list(week_starts[1:]) + [end_date + pd.Timedelta(days=1)]
+
+    df['week_label'] = pd.cut(df['visit_date'], bins=bins, labels=week_labels, right=False)
+    df['first_visit_week'] = pd.cut(df['first_visit_date'], bins=bins, labels=week_labels, right=False)
+    df_original['week_label'] = pd.cut(df_original['visit_date'], bins=bins, labels=week_labels, right=False)
+
+    weekly_results = []
+    for week in sorted(df['week_label'].dropna().unique(), key=lambda x: week_labels.index(x)):
+        week_data = df[df['week_label'] == week]
+        week_data_original = df_original[df_original['week_label'] == week]
+
+        total_customers = week_data['email'].nunique()
+        new_customer_mask = week_data['week_label'].astype(str) == week_data['first_visit_week'].astype(str)
+        new_customers = week_data.loc[new_customer_mask, 'email'].nunique()
+        returning_customers = total_customers - new_customers
+        new_percentage = round((new_customers / total_customers * 100), 2) if total_customers else 0
+        returning_percentage = round((returning_customers / total_customers * 100), 2) if total_customers else 0
+
+        total_revenue = week_data_original['purchase_value'].sum()
+        total_revenue_ = week_data['purchase_value'].sum()
+        new_revenue = week_data.loc[new_customer_mask, 'purchase_value'].sum()
+        returning_revenue = total_revenue_ - new_revenue
+
+        weekly_results.append({
+            'week': week,
+            'total_customers': total_customers,
+            'new_customers': new_customers,
+            'returning_customers': returning_customers,
+            'new_percentage': new_percentage,
+            'returning_percentage': returning_percentage,
+            'total_revenue': total_revenue,
+            'new_customer_revenue': new_revenue,
+            'returning_customer_revenue': returning_revenue
+        })
+    return pd.DataFrame(weekly_results)
+
+
+def booking(visit, email='a@example.com', paid=10.0, customer_id='C1'):
+    return {
+        'Bnow__Customer_Email__c': email,
+        'Bnow__All_Products_Processed__c': pd.Timestamp(visit).strftime('%Y-%m-%dT%H:%M:%S.000+0000'),
+        'Bnow__Balance_Paid__c': paid,
+        'Bnow__Customer_ID__c': customer_id,
+    }
+
+
+def random_bookings(seed, start, days, rows=400, customers=40):
+    rng = np.random.default_rng(seed)
+    emails = [f"c{i}@example.com" for i in range(customers)]
+    records = []
+    for _ in range(rows):
+        visit = pd.Timestamp(start) + pd.Timedelta(minutes=int(rng.integers(0, days * 24 * 60)))
+        email = emails[rng.integers(customers)] if rng.random() > 0.1 else None
+        paid = round(float(rng.uniform(5, 80)), 2) if rng.random() > 0.15 else None
+        customer_id = 'C' if rng.random() > 0.05 else None
+        records.append(booking(visit, email, paid, customer_id))
+    return records
+
+
+def assert_matches_legacy(records):
+    df, df_original = get_dataframe({'records': records})
+    expected = legacy_weekly_breakdown(df, df_original)
+    result = weekly_breakdown(df, df_original)
+
+    assert list(result.columns) == WEEKLY_COLUMNS
+    expected['week'] = expected['week'].astype(str)
+    pd.testing.assert_frame_equal(result.reset_index(drop=True), expected, check_dtype=False)
+    return result
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_matches_legacy_from_a_mid_week_start(seed):
+    # Wednesday afternoon: the first bucket starts a day before it, the next at the following Monday (same time of day)
+    records = [booking('2024-01-03 14:30', email='first@example.com')] + random_bookings(seed, '2024-01-03 15:00', 60)
+    result = assert_matches_legacy(records)
+    assert result['week'].iloc[0] == 'Jan 08, 2024 - Jan 14, 2024'
+
+
+def test_matches_legacy_with_bookings_before_the_cutoff():
+    records = (
+        [booking('2023-08-20 10:00', email='early@example.com'), booking('2023-08-25 09:00', email=None)]
+        + [booking('2023-09-06 11:00', email='early@example.com'), booking('2023-08-30 08:15')]
+        + random_bookings(7, '2023-08-29 12:00', 30)
+    )
+    result = assert_matches_legacy(records)
+    # Visits before the cutoff neither make a customer returning nor add revenue
+    assert result['total_customers'].sum() > 0
+
+
+def test_matches_legacy_with_null_emails_and_values():
+    records = [
+        booking('2024-03-04 09:00', email='a@example.com', paid=None),
+        booking('2024-03-05 10:00', email=None, paid=50.0),
+        booking('2024-03-06 11:00', email='', paid=20.0),
+        booking('2024-03-07 12:00', email='b@example.com', paid=None, customer_id=None),
+        booking('2024-03-12 09:00', email='a@example.com', paid=30.0),
+        booking('2024-03-13 09:00', email=None, paid=None),
+        booking('2024-03-20 09:00', email='b@example.com', paid=12.5),
+        booking('2024-03-21 18:45', email='hello@jungleworldpark.com', paid=99.0),
+    ]
+    result = assert_matches_legacy(records)
+    # Revenue without an email still counts towards the week's total
+    assert result.loc[0, 'total_revenue'] == 70.0
+    assert result.loc[0, 'new_customer_revenue'] == 0.0
+
+
+def test_matches_legacy_for_a_single_week():
+    # Monday to Thursday: one Monday, so one week
+    records = [booking('2024-05-06 08:00'), booking('2024-05-08 10:00', email='b@example.com'),
+               booking('2024-05-09 23:00', email=None, paid=5.0)]
+    result = assert_matches_legacy(records)
+    assert list(result['week']) == ['May 06, 2024 - May 12, 2024']
+
+
+def test_no_monday_gives_an_empty_report():
+    # Tuesday to Saturday of one week: no week start falls in the range
+    records = [booking('2024-05-07 08:00'), booking('2024-05-11 10:00', email='b@example.com')]
+    df, df_original = get_dataframe({'records': records})
+
+    result = weekly_breakdown(df, df_original)
+    assert result.empty
+    assert list(result.columns) == WEEKLY_COLUMNS
+    # The original loop could not bin this at all
+    with pytest.raises(ValueError):
+        legacy_weekly_breakdown(df, df_original)
+
+
+def test_no_customers_gives_an_empty_report():
+    df, df_original = get_dataframe({'records': [booking('2024-05-07 08:00', email=None)]})
+    result = weekly_breakdown(df, df_original)
+    assert result.empty
+    assert list(result.columns) == WEEKLY_COLUMNS